@@ -0,0 +1,268 @@
+"""Materialized per-user monthly aggregates.
+
+Every user has one document per month at users/{userid}/monthly_aggregates/{YYYY-MM}
+holding the income and expense totals, entry counts and per-category sums of that month.
+The documents are updated in the same transaction that writes an income or expense, so
+the read endpoints can answer from O(months) documents instead of rescanning every entry.
+"""
+import logging
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+
+AGGREGATES_COLLECTION = 'monthly_aggregates'
+
+# Entry collections; each one feeds the aggregate field of the same name
+KINDS = ('income', 'expenses')
+
+# Firestore caps a write batch at 500 operations
+BATCH_LIMIT = 500
+
+class PartialWrite(Exception):
+    """Raised when a chunked write fails after some of its chunks were committed.
+
+    `ids` holds the ids of the committed entries, in the order the entries were given.
+    """
+
+    def __init__(self, message, ids):
+        super().__init__(message)
+        self.ids = ids
+
+def firestore_sdk():
+    """Import the Firestore SDK on first use: it is slow to import, and only the Firestore
+    datastore needs it."""
+    from firebase_admin import firestore
+    return firestore
+
+def month_key(date):
+    """Return the 'YYYY-MM' bucket key for a date, e.g. '2024-10'."""
+    return f"{date.year}-{date.month:02d}"
+
+def month_window(now, months):
+    """Return the month keys (newest first) and the [start, end) range covering the last `months` months."""
+    current_month = datetime(now.year, now.month, 1)
+    month_keys = [month_key(current_month - relativedelta(months=i)) for i in range(months)]
+    window_start = current_month - relativedelta(months=months - 1)
+    window_end = current_month + relativedelta(months=1)
+    return month_keys, window_start, window_end
+
+def empty_aggregate(key):
+    """Return the aggregate of a month without any entries."""
+    return {
+        "month": key,
+        "income": 0,
+        "expenses": 0,
+        "income_count": 0,
+        "expenses_count": 0,
+        "count": 0,
+        "categories": {},
+    }
+
+def accumulate(aggregate, kind, entry):
+    """Add a single entry to an aggregate in place."""
+    amount = entry.get('Amount', 0)
+    category = entry.get('Category') or 'Other'
+
+    aggregate[kind] += amount
+    aggregate[f"{kind}_count"] += 1
+    aggregate["count"] += 1
+    category_sums = aggregate["categories"].setdefault(category, {})
+    category_sums[kind] = category_sums.get(kind, 0) + amount
+    return aggregate
+
+def aggregates_ref(db, userid):
+    """Return the collection holding the monthly aggregates of a user."""
+    return db.collection('users').document(userid).collection(AGGREGATES_COLLECTION)
+
+def _increments(kind, entry):
+    """Return the merge payload adding a single entry to its month's aggregate."""
+    firestore = firestore_sdk()
+    amount = entry.get('Amount', 0)
+    category = entry.get('Category') or 'Other'
+    return {
+        "month": month_key(entry['Date']),
+        kind: firestore.Increment(amount),
+        f"{kind}_count": firestore.Increment(1),
+        "count": firestore.Increment(1),
+        "categories": {category: {kind: firestore.Increment(amount)}},
+    }
+
+def _add_entry_in_transaction(transaction, entry_ref, aggregate_ref, kind, entry):
+    transaction.set(entry_ref, entry)
+    transaction.set(aggregate_ref, _increments(kind, entry), merge=True)
+
+def add_entry(db, userid, kind, entry):
+    """Write an income or expense entry and update its monthly aggregate in one transaction."""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown entry kind '{kind}'")
+
+    user_ref = db.collection('users').document(userid)
+    entry_ref = user_ref.collection(kind).document()
+    aggregate_ref = aggregates_ref(db, userid).document(month_key(entry['Date']))
+
+    firestore_sdk().transactional(_add_entry_in_transaction)(db.transaction(), entry_ref, aggregate_ref, kind, entry)
+    return entry_ref.id
+
+def _add_entry_if_absent_in_transaction(transaction, entry_ref, aggregate_ref, kind, entry):
+    # Reads must precede writes in a transaction
+    if entry_ref.get(transaction=transaction).exists:
+        return False
+    transaction.set(entry_ref, entry)
+    transaction.set(aggregate_ref, _increments(kind, entry), merge=True)
+    return True
+
+def add_entry_if_absent(db, userid, kind, entry_id, entry):
+    """Write an entry under a given id unless it exists; return whether it was written.
+
+    The existence check, the write and the aggregate update run in one transaction, so
+    concurrent retries of the same write create a single entry.
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown entry kind '{kind}'")
+
+    entry_ref = db.collection('users').document(userid).collection(kind).document(entry_id)
+    aggregate_ref = aggregates_ref(db, userid).document(month_key(entry['Date']))
+    return firestore_sdk().transactional(_add_entry_if_absent_in_transaction)(
+        db.transaction(), entry_ref, aggregate_ref, kind, entry
+    )
+
+def _month_increments(kind, entries):
+    """Return the merge payloads adding many entries to their months' aggregates, keyed by month."""
+    months = {}
+    for entry in entries:
+        key = month_key(entry['Date'])
+        months.setdefault(key, empty_aggregate(key))
+        accumulate(months[key], kind, entry)
+
+    firestore = firestore_sdk()
+    return {
+        key: {
+            "month": key,
+            kind: firestore.Increment(month[kind]),
+            f"{kind}_count": firestore.Increment(month[f"{kind}_count"]),
+            "count": firestore.Increment(month["count"]),
+            "categories": {
+                category: {kind: firestore.Increment(sums[kind])} for category, sums in month["categories"].items()
+            },
+        }
+        for key, month in months.items()
+    }
+
+def add_entries(db, userid, kind, entries):
+    """Write many entries in chunked write batches and return their ids.
+
+    Each batch holds a chunk of entries plus one aggregate update per month touched by the
+    chunk, and commits atomically. If a later batch fails, earlier ones stay committed and
+    PartialWrite reports their ids.
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown entry kind '{kind}'")
+
+    collection = db.collection('users').document(userid).collection(kind)
+    months_collection = aggregates_ref(db, userid)
+    ids = []
+
+    start = 0
+    while start < len(entries):
+        # Grow the chunk while the entries plus their distinct months fit in one batch
+        end, months = start, set()
+        while end < len(entries):
+            key = month_key(entries[end]['Date'])
+            if (end - start + 1) + len(months | {key}) > BATCH_LIMIT:
+                break
+            months.add(key)
+            end += 1
+        chunk = entries[start:end]
+
+        batch = db.batch()
+        chunk_ids = []
+        for entry in chunk:
+            entry_ref = collection.document()
+            batch.set(entry_ref, entry)
+            chunk_ids.append(entry_ref.id)
+        for key, increments in _month_increments(kind, chunk).items():
+            batch.set(months_collection.document(key), increments, merge=True)
+        try:
+            batch.commit()
+        except Exception as e:
+            if not ids:
+                raise
+            raise PartialWrite(f"Writing entries failed after {len(ids)} of {len(entries)} were added: {e}", ids) from e
+        ids.extend(chunk_ids)
+
+        start = end
+
+    return ids
+
+def get_months(db, userid, keys):
+    """Return the aggregates of the given months in a single batched read, keyed by month."""
+    collection = aggregates_ref(db, userid)
+    months = {key: empty_aggregate(key) for key in keys}
+
+    for snapshot in db.get_all([collection.document(key) for key in keys]):
+        if snapshot.exists:
+            months[snapshot.id].update(snapshot.to_dict())
+
+    return months
+
+def get_totals(db, userid, until_key):
+    """Return the income and expense totals over every month up to and including `until_key`."""
+    totals = {"income": 0, "expenses": 0}
+
+    query = aggregates_ref(db, userid).where('month', '<=', until_key).select(['income', 'expenses'])
+    for snapshot in query.stream():
+        data = snapshot.to_dict()
+        totals["income"] += data.get('income', 0)
+        totals["expenses"] += data.get('expenses', 0)
+
+    return totals
+
+def list_months(db, userid, until_key):
+    """Return every aggregate of a user up to and including `until_key`, keyed by month."""
+    months = {}
+
+    query = aggregates_ref(db, userid).where('month', '<=', until_key)
+    for snapshot in query.stream():
+        months[snapshot.id] = {**empty_aggregate(snapshot.id), **snapshot.to_dict()}
+
+    return months
+
+def rebuild_user(db, userid):
+    """Recompute every monthly aggregate of a user from their entries, in one pass per collection."""
+    user_ref = db.collection('users').document(userid)
+    months = {}
+
+    for kind in KINDS:
+        query = user_ref.collection(kind).select(['Amount', 'Category', 'Date'])
+        for snapshot in query.stream():
+            entry = snapshot.to_dict()
+            if entry.get('Date') is None:
+                continue
+
+            key = month_key(entry['Date'])
+            accumulate(months.setdefault(key, empty_aggregate(key)), kind, entry)
+
+    # Overwrite the aggregates and drop months that no longer have entries
+    collection = aggregates_ref(db, userid)
+    writes = [(doc_ref, None) for doc_ref in collection.list_documents() if doc_ref.id not in months]
+    writes += [(collection.document(key), aggregate) for key, aggregate in months.items()]
+
+    for start in range(0, len(writes), BATCH_LIMIT):
+        batch = db.batch()
+        for doc_ref, aggregate in writes[start:start + BATCH_LIMIT]:
+            if aggregate is None:
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, aggregate)
+        batch.commit()
+
+    logging.info(f"Rebuilt {len(months)} monthly aggregates for user {userid}")
+    return len(months)
+
+def rebuild_all(db):
+    """Recompute the monthly aggregates of every user."""
+    rebuilt = 0
+    for user_ref in db.collection('users').list_documents():
+        rebuild_user(db, user_ref.id)
+        rebuilt += 1
+    return rebuilt
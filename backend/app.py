@@ -1,38 +1,248 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS  # Import CORS
+from werkzeug.exceptions import HTTPException
+import click
 
-import firebase_admin
-from firebase_admin import credentials, firestore
 from datetime import datetime, timedelta
-import calendar
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import zipfile
+from functools import wraps
+from itertools import islice
 
-import os
-from werkzeug.utils import secure_filename
-from PIL import Image
-import base64
-from mistralai import Mistral
+import json
+import time
 import logging
-from config import API_KEY, MODEL_ID
+from config import (API_KEY, MODEL_ID, DATA_BACKEND, DATA_SEED_USERS, DATA_SEED_ENTRIES, FIREBASE_CREDENTIALS,
+                    CACHE_BACKEND, CACHE_REDIS_URL, STATE_REDIS_URL, CACHE_TTL_SECONDS,
+                    CACHE_NEAR_TTL_SECONDS, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES,
+                    OCR_WORKERS, OCR_QUEUE_SIZE, OCR_RESULT_TTL_SECONDS, OCR_RETRY_AFTER_SECONDS,
+                    RECEIPT_CACHE_DIR, RECEIPT_CACHE_MAX_BYTES, PREPROCESS_MAX_EDGE, PREPROCESS_GRAYSCALE,
+                    PREPROCESS_FORMAT, PREPROCESS_TARGET_BYTES, UPLOAD_FOLDER, UPLOAD_MAX_BYTES,
+                    UPLOAD_SPOOL_BYTES, UPLOAD_PERSIST, UPLOAD_RETENTION_SECONDS, BATCH_CONCURRENCY,
+                    BATCH_MAX_FILES, BATCH_MAX_BYTES, BATCH_MAX_UNPACKED_BYTES, MISTRAL_RATE_LIMIT, MISTRAL_RATE_BURST,
+                    MISTRAL_SERVER_URL, MISTRAL_TIMEOUT_SECONDS, MISTRAL_MAX_RETRIES, MISTRAL_BACKOFF_SECONDS,
+                    MISTRAL_BREAKER_THRESHOLD, MISTRAL_BREAKER_RESET_SECONDS, MISTRAL_MAX_CONNECTIONS,
+                    EXTRACTION_MODE, EXTRACTION_LATENCY_BUDGET_SECONDS, LOCAL_OCR_LANGUAGES, REQUEST_MAX_BYTES,
+                    BULK_MAX_ROWS, BULK_MAX_BYTES,
+                    IMPORT_MAX_BYTES, IMPORT_CHUNK_ROWS, IMPORT_WORKERS, IMPORT_QUEUE_SIZE, IMPORT_EXTENSIONS,
+                    IDEMPOTENCY_TTL_SECONDS, ETAG_WINDOW_SECONDS, RECURRENCE_MAX_MISSED_PERIODS, DEBUG, LOG_LEVEL)
+from aggregates import PartialWrite, empty_aggregate, month_key, month_window
+from recurrence import FREQUENCIES, RecurrenceEngine, frequency_of, rule_id
+import cache
+from conditional import ConditionalResponses
+import jobs
+from receipt_cache import ReceiptCache
+from preprocess import PreprocessStats, preprocess_image
+from uploads import (BatchLimits, UploadRetention, UploadTooLarge, cleanup_uploads, is_zip_upload,
+                     persist_upload, spool_upload, spool_zip)
+from ratelimit import RateLimiter
+from mistral_client import ResilientMistralClient
+from extractors import ExtractionPipeline, LocalExtractor, MistralExtractor
+import repositories
+import bulk
+import importer
+import exporter
+import idempotency
+from jsonprovider import JSONProvider, format_datetime
 
 import logging
-logging.basicConfig(level=logging.DEBUG)
-from dateutil.relativedelta import relativedelta
-
-# Set up Mistral API client
-client = Mistral(api_key=API_KEY)
-
-app = Flask(__name__)
-CORS(app)  # Enable CORS for the entire app
-
-# Initialize Firebase Firestore (assuming you already set up Firebase Admin)
-cred = credentials.Certificate("./cachemoney-95b14-e8ba240701ef.json")
-firebase_admin.initialize_app(cred)
+logging.basicConfig(level=LOG_LEVEL)
+
+# Set up Mistral API client, rate limited process-wide however many extractions run concurrently
+mistral_rate_limiter = RateLimiter(MISTRAL_RATE_LIMIT, burst=MISTRAL_RATE_BURST)
+mistral = ResilientMistralClient(
+    API_KEY,
+    MODEL_ID,
+    server_url=MISTRAL_SERVER_URL,
+    timeout_seconds=MISTRAL_TIMEOUT_SECONDS,
+    max_retries=MISTRAL_MAX_RETRIES,
+    backoff_base=MISTRAL_BACKOFF_SECONDS,
+    breaker_threshold=MISTRAL_BREAKER_THRESHOLD,
+    breaker_reset_seconds=MISTRAL_BREAKER_RESET_SECONDS,
+    max_connections=MISTRAL_MAX_CONNECTIONS,
+    rate_limiter=mistral_rate_limiter,
+)
+
+# Receipt extraction: the vision model, with the local OCR extractor as a bounded-latency fallback
+local_extractor = LocalExtractor(languages=LOCAL_OCR_LANGUAGES)
+if EXTRACTION_MODE != 'remote' and not local_extractor.available:
+    logging.warning("pytesseract is not installed, the local receipt extractor will fail")
+extraction_pipeline = ExtractionPipeline(
+    MistralExtractor(mistral),
+    local_extractor,
+    mode=EXTRACTION_MODE,
+    latency_budget=EXTRACTION_LATENCY_BUDGET_SECONDS,
+)
+
+# Routes and CLI commands, registered on the application by create_app()
+api = Blueprint('api', __name__, cli_group=None)
+
+def create_store():
+    """Create the datastore selected by DATA_BACKEND."""
+    if DATA_BACKEND == 'firestore':
+        return repositories.create_data_store(DATA_BACKEND, repositories.create_firestore_client(FIREBASE_CREDENTIALS))
+
+    store = repositories.create_data_store(DATA_BACKEND)
+    # Seed the in-memory datastore so it can be load-tested right away
+    for seed_userid in DATA_SEED_USERS:
+        store.seed(seed_userid, DATA_SEED_ENTRIES)
+    return store
+
+# Repositories all handlers read and write through, created on first use in each process
+store = repositories.LazyDataStore(create_store)
+
+# Responses of writes sent with an Idempotency-Key, kept where the response cache lives
+idempotency_store = idempotency.create_store(CACHE_BACKEND, ttl=IDEMPOTENCY_TTL_SECONDS, redis_url=STATE_REDIS_URL)
+
+def create_job_store(name):
+    """Create the store of a job queue's records, in Redis with CACHE_BACKEND=redis.
+
+    Status polls can reach any worker, so with more than one worker the records must be
+    shared, which takes CACHE_BACKEND=redis (see gunicorn.conf.py).
+    """
+    return jobs.create_store(CACHE_BACKEND, ttl=OCR_RESULT_TTL_SECONDS, redis_url=STATE_REDIS_URL,
+                             prefix=f"cachemoney:jobs:{name}")
+
+# Per-user cache of the read endpoints' responses, invalidated on writes
+response_cache = cache.ResponseCache(cache.create_backend(
+    CACHE_BACKEND,
+    ttl=CACHE_TTL_SECONDS,
+    max_entries=CACHE_MAX_ENTRIES,
+    max_bytes=CACHE_MAX_BYTES,
+    redis_url=CACHE_REDIS_URL,
+    near_cache_ttl=CACHE_NEAR_TTL_SECONDS,
+))
+
+# ETag / Last-Modified validators of the read endpoints, derived from the user's data version
+conditional_responses = ConditionalResponses(lambda userid: store.versions.get(userid), window=ETAG_WINDOW_SECONDS)
+
+def record_recurrence(userid, entries):
+    """After incomes were written: update the rules of their recurring series.
+
+    The incomes are stored by then, so a failure is logged instead of failing the write;
+    `flask rebuild-aggregates <userid>` recomputes the rules from the stored incomes.
+    """
+    try:
+        store.recurrence.record(userid, entries)
+    except Exception as e:
+        logging.error(f"Updating the recurrence rules of user {userid} failed, rebuild them: {e}")
 
-# Initialize Firestore
-db = firestore.client()
+def retry_later(error):
+    """Answer 503 with a Retry-After header: the job queues are full or their store is unreachable."""
+    response = jsonify({"error": str(error)})
+    response.headers['Retry-After'] = str(OCR_RETRY_AFTER_SECONDS)
+    return response, 503
 
-@app.route('/api/expense/last7days', methods=['GET'])
-def get_last_7_days_expenses():
+def data_changed(userid):
+    """After a write: bump the user's data version and drop their cached responses."""
+    try:
+        store.versions.bump(userid)
+    except Exception as e:
+        # The write itself succeeded; the validators still expire within ETAG_WINDOW_SECONDS
+        logging.error(f"Bumping the data version of user {userid} failed: {e}")
+    response_cache.invalidate_user(userid)
+
+# Upper bound for the 'months' parameter of the rollup endpoints
+MAX_ROLLUP_MONTHS = 60
+
+# Page sizes of the paginated list endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Rows encoded per chunk of the streamed list responses
+STREAM_BATCH_ROWS = 500
+
+# Room for the multipart framing and form fields around an uploaded file
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+def body_limit(max_bytes):
+    """Decorate a handler so it accepts request bodies of up to `max_bytes` instead of REQUEST_MAX_BYTES.
+
+    Requests announcing a larger body are rejected with 413 before any of it is read.
+    """
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            request.max_content_length = max_bytes
+            return view(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Sections of /api/dashboard, selectable with ?fields=
+DASHBOARD_SECTIONS = ('summary', 'monthly_income', 'savings', 'recent_expenses')
+
+# Expands the recurring incomes when aggregating, memoized per (rule, month)
+recurrence_engine = RecurrenceEngine(max_missed_periods=RECURRENCE_MAX_MISSED_PERIODS)
+
+# Pool running the independent datastore queries of a request concurrently
+query_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='firestore-query')
+
+def serialize_expense(expense):
+    """Convert an expense entry into its API representation."""
+    return {
+        "id": expense['id'],  # Include the document ID
+        "amount": expense.get('Amount'),
+        "category": expense.get('Category'),
+        "date": format_datetime(expense['Date']),  # Convert timestamp to string
+        "description": expense.get('Description'),
+        "name": expense.get('Name')
+    }
+
+def serialize_income(income):
+    """Convert an income entry into its API representation."""
+    return {
+        "id": income['id'],  # Include the document ID
+        "amount": income.get('Amount'),
+        "category": income.get('Category'),
+        "date": format_datetime(income['Date']),
+        "frequency": income.get('Frequency'),
+        "name": income.get('Name')
+    }
+
+# Export kinds: repository and serializer
+EXPORT_KINDS = {
+    'expenses': ('expenses', serialize_expense),
+    'incomes': ('incomes', serialize_income),
+}
+
+# Used to derive the export columns from the serializers
+EXPORT_SAMPLE_ENTRY = {'id': '', 'Date': datetime.min}
+
+def parse_datetime_arg(name):
+    """Parse an optional ISO 8601 date/datetime query parameter."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid '{name}', expected an ISO 8601 date such as 2024-10-01")
+
+def parse_int_arg(args, name, default, error):
+    """Parse an optional integer query parameter, raising ValueError(error) if it is not an integer."""
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(error)
+
+def parse_page_size():
+    """Parse the 'limit' query parameter, bounded to MAX_PAGE_SIZE."""
+    error = f"'limit' must be between 1 and {MAX_PAGE_SIZE}"
+    limit = parse_int_arg(request.args, 'limit', DEFAULT_PAGE_SIZE, error)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(error)
+    return limit
+
+def expenses_page_response(since=None, paginate=True):
+    """Respond with one page of the user's expenses, filtered by the request's query parameters.
+
+    With `paginate` False, all matching expenses are returned unless ?limit= or ?cursor= asks
+    for a page, as the fixed-window aliases did before pagination existed.
+    """
     try:
         # Get the 'userid' from the request arguments (URL query params)
         userid = request.args.get('userid')
@@ -40,144 +250,242 @@ def get_last_7_days_expenses():
         if not userid:
             return jsonify({"error": "Missing 'userid' in query parameters"}), 400
 
-        # Calculate the date 7 days ago from now
-        now = datetime.now()
-        seven_days_ago = now - timedelta(days=7)
-
-        # Firestore can handle Python's datetime object directly
-        # Query Firestore for expenses in the last 7 days
-        expenses_ref = db.collection('users').document(userid).collection('expenses')
-        query = expenses_ref.where('Date', '>=', seven_days_ago).order_by('Date', direction=firestore.Query.DESCENDING)
-        expenses = query.stream()
-
-        # Collect the results into a list
-        expenses_list = []
-        for expense in expenses:
-            expense_data = expense.to_dict()
-            expenses_list.append({
-                "id": expense.id,  # Include the document ID
-                "amount": expense_data.get('Amount'),
-                "category": expense_data.get('Category'),
-                "date": expense_data.get('Date').strftime("%Y-%m-%d %H:%M:%S"),  # Convert timestamp to string
-                "description": expense_data.get('Description'),
-                "name": expense_data.get('Name')
-            })
-
-        return jsonify({"expenses": expenses_list}), 200
+        try:
+            since = parse_datetime_arg('since') or since
+            until = parse_datetime_arg('until')
+            paginate = paginate or 'limit' in request.args or 'cursor' in request.args
+            limit = parse_page_size() if paginate else None
+            cursor = request.args.get('cursor')
+            if cursor:
+                repositories.decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        category = request.args.get('category')
+        if not paginate:
+            expenses = store.expenses.stream(userid, since=since, until=until)
+            return jsonify({
+                "expenses": [serialize_expense(expense) for expense in expenses
+                             if not category or expense.get('Category') == category]
+            }), 200
+
+        page, next_cursor = store.expenses.page(
+            userid,
+            since=since,
+            until=until,
+            category=category,
+            limit=limit,
+            cursor=cursor,
+        )
+
+        return jsonify({
+            "expenses": [serialize_expense(expense) for expense in page],
+            "next_cursor": next_cursor
+        }), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/expense/last30days', methods=['GET'])
-def get_last_30_days_expenses():
+def stream_entries(entries, key, serialize, stream_format):
+    """Stream serialized entries as a chunked JSON document or as NDJSON.
+
+    Entries are serialized as they arrive from the datastore, so memory stays constant
+    regardless of how many entries there are.
+    """
+    dumps = current_app.json.dumps
+
+    def batches():
+        # Encoding rows a batch at a time saves a call and a chunk per row
+        iterator = iter(entries)
+        while batch := [serialize(entry) for entry in islice(iterator, STREAM_BATCH_ROWS)]:
+            yield batch
+
+    def generate_json():
+        yield f'{{"{key}": ['
+        for index, batch in enumerate(batches()):
+            # Strip the brackets of the encoded list to splice its rows into the document
+            yield (',' if index else '') + dumps(batch)[1:-1]
+        yield ']}'
+
+    def generate_ndjson():
+        for batch in batches():
+            yield ''.join(dumps(row) + '\n' for row in batch)
+
+    if stream_format == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
+
+def entries_list_response(repository, key, serialize):
+    """Respond with all of a user's entries up to now, either in full, one page at a time or streamed.
+
+    ?limit=&cursor= returns a single page and its 'next_cursor'; ?stream=json|ndjson streams
+    the full history instead of building it in memory.
+    """
     try:
-        # Get the 'userid' from the request arguments (URL query params)
+        # Get the 'userid' from the query parameters
         userid = request.args.get('userid')
 
         if not userid:
             return jsonify({"error": "Missing 'userid' in query parameters"}), 400
 
-        # Calculate the date 7 days ago from now
+        try:
+            stream_format = request.args.get('stream')
+            if stream_format not in (None, 'json', 'ndjson'):
+                raise ValueError("'stream' must be 'json' or 'ndjson'")
+            paginated = 'limit' in request.args or 'cursor' in request.args
+            limit = parse_page_size() if paginated else None
+            cursor = request.args.get('cursor')
+            if cursor:
+                repositories.decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Get the current date
         now = datetime.now()
-        seven_days_ago = now - timedelta(days=30)
-
-        # Firestore can handle Python's datetime object directly
-        # Query Firestore for expenses in the last 7 days
-        expenses_ref = db.collection('users').document(userid).collection('expenses')
-        query = expenses_ref.where('Date', '>=', seven_days_ago).order_by('Date', direction=firestore.Query.DESCENDING)
-        expenses = query.stream()
-
-        # Collect the results into a list
-        expenses_list = []
-        for expense in expenses:
-            expense_data = expense.to_dict()
-            expenses_list.append({
-                "id": expense.id,  # Include the document ID
-                "amount": expense_data.get('Amount'),
-                "category": expense_data.get('Category'),
-                "date": expense_data.get('Date').strftime("%Y-%m-%d %H:%M:%S"),  # Convert timestamp to string
-                "description": expense_data.get('Description'),
-                "name": expense_data.get('Name')
-            })
-
-        return jsonify({"expenses": expenses_list}), 200
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500    
+        if paginated:
+            page, next_cursor = repository.page(userid, until=now, limit=limit, cursor=cursor)
+            return jsonify({
+                key: [serialize(entry) for entry in page],
+                "next_cursor": next_cursor
+            }), 200
 
-@app.route('/api/expense/last24hours', methods=['GET'])
-def get_last_24_hours_expenses():
-    try:
-        # Get the 'userid' from the request arguments (URL query params)
-        userid = request.args.get('userid')
+        # All entries up to the current date, newest first
+        entries = repository.stream(userid, until=now)
 
-        if not userid:
-            return jsonify({"error": "Missing 'userid' in query parameters"}), 400
+        if stream_format:
+            return stream_entries(entries, key, serialize, stream_format)
 
-        # Calculate the date 24 hours ago from now
-        now = datetime.now()
-        twenty_four_hours_ago = now - timedelta(hours=24)
-
-        # Firestore can handle Python's datetime object directly
-        # Query Firestore for expenses in the last 24 hours
-        expenses_ref = db.collection('users').document(userid).collection('expenses')
-        query = expenses_ref.where('Date', '>=', twenty_four_hours_ago).order_by('Date', direction=firestore.Query.DESCENDING)
-        expenses = query.stream()
-
-        # Collect the results into a list
-        expenses_list = []
-        for expense in expenses:
-            expense_data = expense.to_dict()
-            expenses_list.append({
-                "id": expense.id,  # Include the document ID
-                "amount": expense_data.get('Amount'),
-                "category": expense_data.get('Category'),
-                "date": expense_data.get('Date').strftime("%Y-%m-%d %H:%M:%S"),  # Convert timestamp to string
-                "description": expense_data.get('Description'),
-                "name": expense_data.get('Name')
-            })
-
-        return jsonify({"expenses": expenses_list}), 200
+        return jsonify({key: [serialize(entry) for entry in entries]}), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    
-@app.route('/api/all_expenses', methods=['GET'])
-def get_all_expenses():
-    try:
-        # Get the 'userid' from the query parameters
-        userid = request.args.get('userid')
-
-        if not userid:
-            return jsonify({"error": "Missing 'userid' in query parameters"}), 400
-
-        # Get the current date
-        now = datetime.now()
 
-        # Query Firestore for all expenses up to the current date
-        expenses_ref = db.collection('users').document(userid).collection('expenses')
-        expenses_query = expenses_ref.where('Date', '<=', now).order_by('Date', direction=firestore.Query.DESCENDING)
-        expenses = expenses_query.stream()
-
-        # Collect expenses into a list
-        expenses_list = []
-        for expense in expenses:
-            expense_data = expense.to_dict()
-            expenses_list.append({
-                "id": expense.id,  # Include the document ID
-                "amount": expense_data.get('Amount'),
-                "category": expense_data.get('Category'),
-                "date": expense_data.get('Date').strftime("%Y-%m-%d %H:%M:%S"),
-                "description": expense_data.get('Description'),
-                "name": expense_data.get('Name')
-            })
-
-        return jsonify({"expenses": expenses_list}), 200
+# Expenses filtered by ?since=&until=&category=, paginated with ?limit=&cursor=
+@api.route('/api/expenses', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
+def get_expenses():
+    return expenses_page_response()
+
+# Fixed windows, returned whole unless ?limit= or ?cursor= asks for a page; the frontend
+# reads them without following next_cursor
+@api.route('/api/expense/last7days', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
+def get_last_7_days_expenses():
+    return expenses_page_response(since=datetime.now() - timedelta(days=7), paginate=False)
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+@api.route('/api/expense/last30days', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
+def get_last_30_days_expenses():
+    return expenses_page_response(since=datetime.now() - timedelta(days=30), paginate=False)
 
-@app.route('/api/monthly-income', methods=['GET'])
+@api.route('/api/expense/last24hours', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
+def get_last_24_hours_expenses():
+    return expenses_page_response(since=datetime.now() - timedelta(hours=24), paginate=False)
+    
+@api.route('/api/all_expenses', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
+def get_all_expenses():
+    return entries_list_response(store.expenses, 'expenses', serialize_expense)
+
+def recurring_income(userid, month_keys, now):
+    """Return the income of the user's recurring series not entered in each of the given months."""
+    return recurrence_engine.extra_income(userid, store.recurrence.list_rules(userid), month_keys, now)
+
+# Argument parsing and response bodies shared with the async read endpoints (asgi.py)
+
+def parse_months_arg(args):
+    """Parse the 'months' query parameter of the rollup endpoints (the last 6 months by default)."""
+    error = f"'months' must be between 1 and {MAX_ROLLUP_MONTHS}"
+    months = parse_int_arg(args, 'months', 6, error)
+    if not 1 <= months <= MAX_ROLLUP_MONTHS:
+        raise ValueError(error)
+    return months
+
+def parse_dashboard_args(args):
+    """Parse the 'fields', 'months' and 'days' query parameters of /api/dashboard."""
+    # Field mask: comma-separated sections, all of them by default
+    fields = args.get('fields')
+    sections = set(fields.split(',')) if fields else set(DASHBOARD_SECTIONS)
+    unknown = sections - set(DASHBOARD_SECTIONS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    months = parse_months_arg(args)
+
+    error = "'days' must be a positive number"
+    days = parse_int_arg(args, 'days', 7, error)
+    if days < 1:
+        raise ValueError(error)
+
+    return sections, months, days
+
+def financial_summary(total_income, total_expenses):
+    """Return the totals and savings reported by /api/financial_summary."""
+    return {
+        "total_income": total_income,
+        "total_expenses": total_expenses,
+        "savings": total_income - total_expenses
+    }
+
+def monthly_savings(aggregated, recurring, month_keys):
+    """Return the income, expenses and savings of each month, recurring incomes included."""
+    savings = {}
+    for key in month_keys:
+        month = aggregated.get(key, empty_aggregate(key))
+        income = month["income"] + recurring[key]
+        savings[key] = {
+            "income": income,
+            "expenses": month["expenses"],
+            "savings": income - month["expenses"]
+        }
+    return savings
+
+def build_dashboard(userid, sections, months, now, aggregated=None, rules=None, recent_expenses=None):
+    """Assemble the requested dashboard sections.
+
+    `aggregated` holds every monthly aggregate up to the current month and `rules` the user's
+    recurrence rules, both needed by the aggregate sections; `recent_expenses` is the
+    (page, next_cursor) of the recent expenses section.
+    """
+    current_key = month_key(now)
+    dashboard = {}
+
+    # Every aggregate view is derived from the same single read of the monthly aggregates
+    if 'summary' in sections:
+        total_income = sum(month["income"] for month in aggregated.values())
+        total_income += recurrence_engine.total_extra_income(userid, rules, now)
+        total_expenses = sum(month["expenses"] for month in aggregated.values())
+        dashboard["summary"] = financial_summary(total_income, total_expenses)
+
+    if 'monthly_income' in sections:
+        current_month = aggregated.get(current_key, empty_aggregate(current_key))
+        recurring = recurrence_engine.extra_income(userid, rules, [current_key], now)
+        dashboard["monthly_income"] = {"total_monthly_income": current_month["income"] + recurring[current_key]}
+
+    if 'savings' in sections:
+        month_keys, _, _ = month_window(now, months)
+        recurring = recurrence_engine.extra_income(userid, rules, month_keys, now)
+        dashboard["savings"] = monthly_savings(aggregated, recurring, month_keys)
+
+    if 'recent_expenses' in sections:
+        page, next_cursor = recent_expenses
+        dashboard["recent_expenses"] = {
+            "expenses": [serialize_expense(expense) for expense in page],
+            "next_cursor": next_cursor
+        }
+
+    return dashboard
+
+@api.route('/api/monthly-income', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
 def get_monthly_income():
     try:
         # Get the 'userid' from the query parameters
@@ -186,35 +494,23 @@ def get_monthly_income():
         if not userid:
             return jsonify({"error": "Missing 'userid' in query parameters"}), 400
 
-        # Get the current date
+        # Read the current month's aggregate and add the occurrences of recurring incomes
         now = datetime.now()
-
-        # Get the first and last day of the current month
-        first_day_of_month = datetime(now.year, now.month, 1)
-        last_day_of_month = datetime(now.year, now.month, calendar.monthrange(now.year, now.month)[1])
-
-        # Initialize total for monthly income
-        total_monthly_income = 0
-
-        ### Query Firestore for incomes in the current month
-        income_ref = db.collection('users').document(userid).collection('income')
-        income_query = income_ref.where('Date', '>=', first_day_of_month).where('Date', '<=', last_day_of_month)
-        incomes = income_query.stream()
-
-        # Sum up the total monthly income
-        for income in incomes:
-            income_data = income.to_dict()
-            total_monthly_income += income_data.get('Amount', 0)
+        current_key = month_key(now)
+        current_month = store.aggregates.get_months(userid, [current_key])[current_key]
+        recurring = recurring_income(userid, [current_key], now)
 
         # Return the total income for the current month
         return jsonify({
-            "total_monthly_income": total_monthly_income
+            "total_monthly_income": current_month["income"] + recurring[current_key]
         }), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/monthly-income-last6months', methods=['GET'])
+@api.route('/api/monthly-income-last6months', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
 def get_monthly_income_last_6_months():
     try:
         # Get the 'userid' from the query parameters
@@ -223,43 +519,29 @@ def get_monthly_income_last_6_months():
         if not userid:
             return jsonify({"error": "Missing 'userid' in query parameters"}), 400
 
-        # Initialize a dictionary to store income for the last 6 months
-        monthly_income = {}
+        # Number of months to roll up (defaults to the last 6 months)
+        try:
+            months = parse_months_arg(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        # Get the current date
+        ### Read the monthly aggregates of the window in one batched read
         now = datetime.now()
+        month_keys, _, _ = month_window(now, months)
+        aggregated = store.aggregates.get_months(userid, month_keys)
+        recurring = recurring_income(userid, month_keys, now)
 
-        # Loop through the last 6 months
-        for i in range(6):
-            # Get the first day of the current month (offset by i months)
-            current_month = now - relativedelta(months=i)
-            first_day_of_month = datetime(current_month.year, current_month.month, 1)
-            last_day_of_month = datetime(current_month.year, current_month.month, calendar.monthrange(current_month.year, current_month.month)[1])
+        monthly_income = {key: aggregated[key]["income"] + recurring[key] for key in month_keys}
 
-            # Initialize total for the month's income
-            total_monthly_income = 0
-
-            ### Query Firestore for incomes within the current month
-            income_ref = db.collection('users').document(userid).collection('income')
-            income_query = income_ref.where('Date', '>=', first_day_of_month).where('Date', '<=', last_day_of_month)
-            incomes = income_query.stream()
-
-            # Sum up the total income for the current month
-            for income in incomes:
-                income_data = income.to_dict()
-                total_monthly_income += income_data.get('Amount', 0)
-
-            # Add the total monthly income to the dictionary
-            month_key = f"{current_month.year}-{current_month.month:02d}"  # E.g., "2024-10"
-            monthly_income[month_key] = total_monthly_income
-
-        # Return the aggregated monthly income for the last 6 months
+        # Return the aggregated monthly income for the requested months
         return jsonify(monthly_income), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/monthly-savings-last6months', methods=['GET'])
+@api.route('/api/monthly-savings-last6months', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
 def get_monthly_savings_last_6_months():
     try:
         # Get the 'userid' from the query parameters
@@ -268,62 +550,34 @@ def get_monthly_savings_last_6_months():
         if not userid:
             return jsonify({"error": "Missing 'userid' in query parameters"}), 400
 
-        # Initialize a dictionary to store savings for the last 6 months
-        monthly_savings = {}
+        # Number of months to roll up (defaults to the last 6 months)
+        try:
+            months = parse_months_arg(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        # Get the current date
+        ### Read the monthly aggregates of the window in one batched read
         now = datetime.now()
+        month_keys, _, _ = month_window(now, months)
+        aggregated = store.aggregates.get_months(userid, month_keys)
+        recurring = recurring_income(userid, month_keys, now)
 
-        # Loop through the last 6 months
-        for i in range(6):
-            # Get the first and last days of the current month (offset by i months)
-            current_month = now - relativedelta(months=i)
-            first_day_of_month = datetime(current_month.year, current_month.month, 1)
-            last_day_of_month = datetime(current_month.year, current_month.month, calendar.monthrange(current_month.year, current_month.month)[1])
-
-            # Initialize totals for the month's income and expenses
-            total_monthly_income = 0
-            total_monthly_expenses = 0
-
-            ### Query Firestore for incomes within the current month
-            income_ref = db.collection('users').document(userid).collection('income')
-            income_query = income_ref.where('Date', '>=', first_day_of_month).where('Date', '<=', last_day_of_month)
-            incomes = income_query.stream()
-
-            # Sum up the total income for the current month
-            for income in incomes:
-                income_data = income.to_dict()
-                total_monthly_income += income_data.get('Amount', 0)
-
-            ### Query Firestore for expenses within the current month
-            expenses_ref = db.collection('users').document(userid).collection('expenses')
-            expenses_query = expenses_ref.where('Date', '>=', first_day_of_month).where('Date', '<=', last_day_of_month)
-            expenses = expenses_query.stream()
-
-            # Sum up the total expenses for the current month
-            for expense in expenses:
-                expense_data = expense.to_dict()
-                total_monthly_expenses += expense_data.get('Amount', 0)
-
-            # Calculate monthly savings
-            monthly_savings_value = total_monthly_income - total_monthly_expenses
-
-            # Add the monthly savings to the dictionary
-            month_key = f"{current_month.year}-{current_month.month:02d}"  # E.g., "2024-10"
-            monthly_savings[month_key] = {
-                "income": total_monthly_income,
-                "expenses": total_monthly_expenses,
-                "savings": monthly_savings_value
-            }
-
-        # Return the aggregated monthly savings for the last 6 months
-        return jsonify(monthly_savings), 200
+        # Return the aggregated monthly savings for the requested months
+        return jsonify(monthly_savings(aggregated, recurring, month_keys)), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/all_incomes', methods=['GET'])
+@api.route('/api/all_incomes', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
 def get_all_incomes():
+    return entries_list_response(store.incomes, 'incomes', serialize_income)
+    
+@api.route('/api/financial_summary', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
+def get_financial_summary():
     try:
         # Get the 'userid' from the query parameters
         userid = request.args.get('userid')
@@ -331,34 +585,22 @@ def get_all_incomes():
         if not userid:
             return jsonify({"error": "Missing 'userid' in query parameters"}), 400
 
-        # Get the current date
+        ### Sum the monthly aggregates up to the current month, plus the recurring incomes
         now = datetime.now()
+        totals = store.aggregates.get_totals(userid, month_key(now))
+        totals["income"] += recurrence_engine.total_extra_income(userid, store.recurrence.list_rules(userid), now)
 
-        # Query Firestore for all incomes up to the current date
-        income_ref = db.collection('users').document(userid).collection('income')
-        income_query = income_ref.where('Date', '<=', now).order_by('Date', direction=firestore.Query.DESCENDING)
-        incomes = income_query.stream()
-
-        # Collect incomes into a list
-        income_list = []
-        for income in incomes:
-            income_data = income.to_dict()
-            income_list.append({
-                "id": income.id,  # Include the document ID
-                "amount": income_data.get('Amount'),
-                "category": income_data.get('Category'),
-                "date": income_data.get('Date').strftime("%Y-%m-%d %H:%M:%S"),
-                "frequency": income_data.get('Frequency'),
-                "name": income_data.get('Name')
-            })
-
-        return jsonify({"incomes": income_list}), 200
+        # Return the aggregated totals and savings
+        return jsonify(financial_summary(totals["income"], totals["expenses"])), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    
-@app.route('/api/financial_summary', methods=['GET'])
-def get_financial_summary():
+
+# All dashboard data in one round trip; ?fields= selects the sections to return
+@api.route('/api/dashboard', methods=['GET'])
+@conditional_responses.conditional
+@response_cache.cached
+def get_dashboard():
     try:
         # Get the 'userid' from the query parameters
         userid = request.args.get('userid')
@@ -366,49 +608,43 @@ def get_financial_summary():
         if not userid:
             return jsonify({"error": "Missing 'userid' in query parameters"}), 400
 
-        # Get the current date
-        now = datetime.now()
-
-        # Initialize totals for income and expenses
-        total_income = 0
-        total_expenses = 0
-
-        ### Query Firestore for all incomes up to the current date
-        income_ref = db.collection('users').document(userid).collection('income')
-        income_query = income_ref.where('Date', '<=', now).order_by('Date', direction=firestore.Query.DESCENDING)
-        incomes = income_query.stream()
-
-        # Sum up the total income
-        for income in incomes:
-            income_data = income.to_dict()
-            total_income += income_data.get('Amount', 0)
+        try:
+            sections, months, days = parse_dashboard_args(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        ### Query Firestore for all expenses up to the current date
-        expenses_ref = db.collection('users').document(userid).collection('expenses')
-        expenses_query = expenses_ref.where('Date', '<=', now).order_by('Date', direction=firestore.Query.DESCENDING)
-        expenses = expenses_query.stream()
+        now = datetime.now()
 
-        # Sum up the total expenses
-        for expense in expenses:
-            expense_data = expense.to_dict()
-            total_expenses += expense_data.get('Amount', 0)
+        ### Run the aggregate read, the rules read and the recent expenses query concurrently
+        aggregates_future = rules_future = None
+        if sections & {'summary', 'monthly_income', 'savings'}:
+            aggregates_future = query_executor.submit(store.aggregates.list_months, userid, month_key(now))
+            rules_future = query_executor.submit(store.recurrence.list_rules, userid)
+
+        expenses_future = None
+        if 'recent_expenses' in sections:
+            expenses_future = query_executor.submit(
+                store.expenses.page, userid, since=now - timedelta(days=days), limit=DEFAULT_PAGE_SIZE
+            )
+
+        dashboard = build_dashboard(
+            userid,
+            sections,
+            months,
+            now,
+            aggregated=aggregates_future.result() if aggregates_future is not None else None,
+            rules=rules_future.result() if rules_future is not None else None,
+            recent_expenses=expenses_future.result() if expenses_future is not None else None,
+        )
 
-        # Calculate savings
-        savings = total_income - total_expenses
-
-        # Return the aggregated totals and savings
-        return jsonify({
-            "total_income": total_income,
-            "total_expenses": total_expenses,
-            "savings": savings
-        }), 200
+        return jsonify(dashboard), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # api to add income to the database
 # Needs {'uid', 'Amount', 'Category', 'Date', 'Frequency', 'Name']} in the request body
-@app.route('/api/add_income', methods=['POST'])
+@api.route('/api/add_income', methods=['POST'])
 def add_income():
     print("Income req received")
     try:
@@ -424,31 +660,28 @@ def add_income():
         # Verify that the required fields are in the income object
         required_fields = ['Amount', 'Category', 'Date', 'Frequency', 'Name']
         for field in required_fields:
-            if field not in field:
+            if field not in data:
                 return jsonify({"error": f"Missing '{field}' in income data"}), 400
 
         # Convert the date string to a Firestore timestamp
-        data['Date'] = datetime.datetime.strptime(income['Date'], "%d %B %Y at %H:%M:%S %Z")
+        data['Date'] = datetime.strptime(data['Date'], "%d %B %Y at %H:%M:%S %Z")
 
-        # Create a reference to the Firestore document path: users/{userid}/income/{auto_generated_id}
-        income_ref = db.collection('users').document(userid).collection('income').document()
-
-        # Add the income data to Firestore
-        income_ref.set({
-            "Amount": data['Amount'],
+        # Add the income and update its monthly aggregate
+        return add_entry_response(store.incomes, userid, {
+            "Amount": float(data['Amount']),
             "Category": data['Category'],
             "Date": data['Date'],
             "Frequency": data['Frequency'],
             "Name": data['Name']
-        })
-
-        # Return success response
-        return jsonify({"success": True, "message": "Income added successfully"}), 201
+        }, "Income added successfully")
 
+    except HTTPException:
+        # Oversized (413) or malformed (400) request bodies keep their status
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
-@app.route('/api/add_expense', methods=['POST'])
+@api.route('/api/add_expense', methods=['POST'])
 def add_expense():
     try:
         # Get the data from the request
@@ -467,34 +700,382 @@ def add_expense():
                 return jsonify({"error": f"Missing '{field}' in expense data"}), 400
 
         # Convert the Date string to a Firestore timestamp
-        data['Date'] = datetime.datetime.strptime(data['Date'], "%d %B %Y")
-
-        # Create a reference to the Firestore document path: users/{userid}/expenses/{auto_generated_id}
-        expense_ref = db.collection('users').document(userid).collection('expenses').document()
+        data['Date'] = datetime.strptime(data['Date'], "%d %B %Y")
 
-        # Add the expense data to Firestore
-        expense_ref.set({
-            "Amount": data['Amount'],
+        # Add the expense and update its monthly aggregate
+        return add_entry_response(store.expenses, userid, {
+            "Amount": float(data['Amount']),
             "Category": data['Category'],
             "Date": data['Date'],
             "Description": data['Description'],
             "Name": data['Name']
+        }, "Expense added successfully")
+
+    except HTTPException:
+        # Oversized (413) or malformed (400) request bodies keep their status
+        raise
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Stop projecting a recurring income series, e.g. when a job ended: occurrences from the
+# optional ISO 8601 'End' (defaults to now) on are no longer counted. Needs {'uid', 'Name',
+# 'Category', 'Frequency'} of the series' incomes; a later income of the series resumes it
+@api.route('/api/incomes/recurring/stop', methods=['POST'])
+def stop_recurring_income():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get('uid'):
+        return jsonify({"error": "Missing 'uid' in request"}), 400
+    for field in ('Name', 'Category'):
+        if field not in data:
+            return jsonify({"error": f"Missing '{field}' in request"}), 400
+    if frequency_of(data) is None:
+        return jsonify({"error": f"'Frequency' must be one of {', '.join(FREQUENCIES)}"}), 400
+    try:
+        end = datetime.fromisoformat(data['End']) if data.get('End') else datetime.now()
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid 'End', expected an ISO 8601 date such as 2024-10-01"}), 400
+
+    userid = data['uid']
+    try:
+        rule = store.recurrence.stop(userid, rule_id(data), end)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if rule is None:
+        return jsonify({"error": "No recurring income with this Name, Category and Frequency"}), 404
+
+    data_changed(userid)
+    return jsonify({"success": True, "id": rule["id"], "end": rule["end"].isoformat()}), 200
+
+# Export a user's expenses or incomes (?kind=expenses|incomes) in [from, to) as a CSV, XLSX
+# or Parquet download, streamed from the datastore without building the dataset in memory
+@api.route('/api/export', methods=['GET'])
+def export_entries():
+    """Export the entries dated from 'from' (inclusive) up to 'to' (exclusive).
+
+    Both bounds are optional ISO 8601 dates or datetimes: ?from=2024-01-01&to=2024-02-01
+    exports January, and a date-only 'to' excludes that day.
+    """
+    userid = request.args.get('userid')
+    if not userid:
+        return jsonify({"error": "Missing 'userid' in query parameters"}), 400
+
+    kind = request.args.get('kind', 'expenses')
+    export_format = request.args.get('format', 'csv')
+    if kind not in EXPORT_KINDS:
+        return jsonify({"error": "'kind' must be 'expenses' or 'incomes'"}), 400
+    if export_format not in exporter.FORMATS:
+        return jsonify({"error": f"'format' must be one of {', '.join(exporter.FORMATS)}"}), 400
+
+    try:
+        since = parse_datetime_arg('from')
+        until = parse_datetime_arg('to')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    repository_name, serialize = EXPORT_KINDS[kind]
+    repository = getattr(store, repository_name)
+    columns = list(serialize(EXPORT_SAMPLE_ENTRY))
+    rows = (exporter.export_row(entry, serialize) for entry in repository.stream(userid, since, until))
+
+    try:
+        if export_format == 'csv':
+            body = exporter.iter_csv(rows, columns)
+        elif export_format == 'xlsx':
+            body = exporter.iter_file(exporter.write_xlsx(rows, columns, kind))
+        else:
+            body = exporter.iter_file(exporter.write_parquet(rows, columns))
+    except exporter.FormatUnavailable as e:
+        # A server configuration fault, not a bad request
+        return jsonify({"error": str(e)}), 501
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    filename = f"{kind}-{datetime.now().strftime('%Y%m%d')}.{export_format}"
+    return Response(
+        stream_with_context(body),
+        mimetype=exporter.FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+def add_entry_response(repository, userid, entry, message):
+    """Add an entry and respond with 201, honouring an optional Idempotency-Key header.
+
+    A retry with the same key replays the first response instead of adding the entry again,
+    and a key reused for a different entry is rejected with 422.
+    """
+    key = request.headers.get('Idempotency-Key')
+    if key is None:
+        entry_id = repository.add(userid, entry)
+        if repository is store.incomes:
+            record_recurrence(userid, [entry])
+        # Drop the user's cached responses so the next read sees the new entry
+        data_changed(userid)
+        return jsonify({"success": True, "message": message, "id": entry_id}), 201
+
+    if not 0 < len(key) <= idempotency.MAX_KEY_LENGTH:
+        return jsonify({"error": f"'Idempotency-Key' must be 1 to {idempotency.MAX_KEY_LENGTH} characters"}), 400
+
+    scope = f"{userid}:{repository.kind}:{key}"
+    request_fingerprint = idempotency.fingerprint(entry)
+    record = idempotency_store.get(scope)
+    if record is None:
+        # Deterministic id: a retry the store has forgotten still finds the entry it wrote
+        entry_id = idempotency.entry_id(userid, repository.kind, key)
+        if repository.add_if_absent(userid, entry_id, entry):
+            if repository is store.incomes:
+                record_recurrence(userid, [entry])
+            data_changed(userid)
+        record = idempotency_store.put(scope, {
+            "fingerprint": request_fingerprint,
+            "body": {"success": True, "message": message, "id": entry_id},
         })
+        replayed = False
+    else:
+        replayed = True
+
+    if record["fingerprint"] != request_fingerprint:
+        return jsonify({"error": "'Idempotency-Key' was already used for a different request"}), 422
+
+    response = jsonify(record["body"])
+    response.headers['Idempotent-Replayed'] = 'true' if replayed else 'false'
+    return response, 201
+
+# Bulk imports of expenses or incomes as JSON, NDJSON or CSV. All rows are validated first;
+# with any invalid row nothing is written, unless ?partial=true asks to store the valid rows
+@api.route('/api/expenses/bulk', methods=['POST'])
+@body_limit(BULK_MAX_BYTES)
+def add_expenses_bulk():
+    return bulk_add_response(store.expenses)
+
+@api.route('/api/incomes/bulk', methods=['POST'])
+@body_limit(BULK_MAX_BYTES)
+def add_incomes_bulk():
+    return bulk_add_response(store.incomes)
+
+def bulk_add_response(repository):
+    try:
+        rows, body_userid = bulk.parse_rows(request.get_data(as_text=True), request.content_type)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    userid = request.args.get('uid') or body_userid
+    if not userid:
+        return jsonify({"error": "Missing 'uid' in request"}), 400
+    if not rows:
+        return jsonify({"error": "No entries provided"}), 400
+    if len(rows) > BULK_MAX_ROWS:
+        return jsonify({"error": f"Bulk imports are limited to {BULK_MAX_ROWS} entries"}), 400
+
+    entries, errors = bulk.validate_rows(repository.kind, rows)
+    if errors and request.args.get('partial', 'false').lower() != 'true':
+        return jsonify({"error": "Invalid entries, nothing was added", "errors": errors}), 400
+
+    try:
+        # Chunked batch writes, each updating the monthly aggregates once
+        ids = repository.add_many(userid, entries) if entries else []
+        if repository is store.incomes:
+            record_recurrence(userid, entries)
 
-        # Return success response
-        return jsonify({"success": True, "message": "Expense added successfully"}), 201
+        return jsonify({"success": True, "added": len(ids), "ids": ids, "errors": errors}), 201
+
+    except PartialWrite as e:
+        # The entries of the committed chunks are stored: report them, so a retry sends only the rest
+        if repository is store.incomes:
+            record_recurrence(userid, entries[:len(e.ids)])
+        return jsonify({"error": str(e), "added": len(e.ids), "ids": e.ids, "errors": errors}), 500
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-UPLOAD_FOLDER = './uploads'
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    finally:
+        # Drop the user's cached responses once for the whole import, also after a partial write
+        data_changed(userid)
+
+# Import a CSV or XLSX bank statement in the background. Form fields: 'file', 'uid', 'kind'
+# ('statement' splits rows by the sign of the amount, or 'expenses'/'income'), an optional
+# JSON 'mapping' of entry field (or 'Debit'/'Credit' instead of 'Amount') -> column header and
+# an optional strptime 'date_format'
+@api.route('/api/import', methods=['POST'])
+@body_limit(IMPORT_MAX_BYTES + MULTIPART_OVERHEAD_BYTES)
+def import_file():
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({"error": "No file provided"}), 400
+    if not file.filename.lower().endswith(IMPORT_EXTENSIONS):
+        return jsonify({"error": f"Only {', '.join(IMPORT_EXTENSIONS)} files can be imported"}), 400
+
+    userid = request.form.get('uid')
+    if not userid:
+        return jsonify({"error": "Missing 'uid' in request"}), 400
 
-# Ensure the uploads folder exists
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+    kind = request.form.get('kind', 'statement')
+    if kind not in importer.KINDS:
+        return jsonify({"error": f"'kind' must be one of {', '.join(importer.KINDS)}"}), 400
 
-@app.route('/api/upload', methods=['POST'])
+    try:
+        mapping = json.loads(request.form['mapping']) if request.form.get('mapping') else None
+    except ValueError:
+        return jsonify({"error": "'mapping' must be a JSON object"}), 400
+    if mapping is not None and not isinstance(mapping, dict):
+        return jsonify({"error": "'mapping' must be a JSON object"}), 400
+
+    try:
+        _, statement = spool_upload(file, IMPORT_MAX_BYTES, spool_bytes=UPLOAD_SPOOL_BYTES)
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+
+    try:
+        job_id = import_jobs.submit(
+            userid, statement, file.filename, kind, mapping, request.form.get('date_format') or None
+        )
+    except (jobs.QueueFull, jobs.JobStoreUnavailable) as e:
+        statement.close()
+        return retry_later(e)
+
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/api/import/{job_id}"}), 202
+
+# Status of an import job; 'result' holds the row counts and the first row errors once done
+@api.route('/api/import/<job_id>', methods=['GET'])
+def get_import_job(job_id):
+    try:
+        job = import_jobs.get(job_id)
+    except jobs.JobStoreUnavailable as e:
+        return retry_later(e)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    return jsonify(job), 200
+
+def run_import(userid, statement, filename, kind, mapping, date_format):
+    """Job handler: stream a spooled statement into the datastore in batched writes."""
+    rows = importer.iter_rows(statement, filename)
+    try:
+        result = importer.import_statement(
+            store, userid, rows, kind, mapping=mapping, date_format=date_format, chunk_rows=IMPORT_CHUNK_ROWS
+        )
+    finally:
+        rows.close()
+        statement.close()
+        # Entries of earlier chunks may be committed even if a later one failed
+        data_changed(userid)
+
+    logging.info(f"Imported {filename} for user {userid}: {result['added']}, {result['error_count']} invalid row(s)")
+    return result
+
+# Statement imports run on their own small pool, so they never delay receipt extractions
+import_jobs = jobs.JobQueue(
+    run_import,
+    workers=IMPORT_WORKERS,
+    max_queue=IMPORT_QUEUE_SIZE,
+    result_ttl=OCR_RESULT_TTL_SECONDS,
+    name='import',
+    store=create_job_store('import'),
+)
+
+@api.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    return jsonify({
+        "response_cache": response_cache.stats(),
+        "conditional": conditional_responses.stats(),
+        "ocr_jobs": ocr_jobs.stats(),
+        "import_jobs": import_jobs.stats(),
+        "receipt_cache": receipt_cache.stats(),
+        "preprocessing": preprocess_stats.stats(),
+        "mistral": mistral.stats(),
+        "extraction": extraction_pipeline.stats(),
+        "recurrence": recurrence_engine.stats(),
+        "mistral_rate_limit": mistral_rate_limiter.stats()
+    }), 200
+
+@api.cli.command('rebuild-aggregates')
+@click.argument('userids', nargs=-1)
+def rebuild_aggregates(userids):
+    """Backfill the monthly aggregates of the given users (all users if none are given)."""
+    if userids:
+        for userid in userids:
+            store.aggregates.rebuild_user(userid)
+            store.recurrence.rebuild_user(userid)
+        click.echo(f"Rebuilt monthly aggregates for {len(userids)} user(s)")
+    else:
+        rebuilt = store.aggregates.rebuild_all()
+        store.recurrence.rebuild_all()
+        click.echo(f"Rebuilt monthly aggregates for {rebuilt} user(s)")
+
+# Retention of the persisted uploads, enforced at most once per interval
+upload_retention = UploadRetention(UPLOAD_FOLDER, UPLOAD_RETENTION_SECONDS)
+
+@api.app_errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"Requests are limited to {request.max_content_length // (1024 * 1024)} MB"}), 413
+
+@api.cli.command('cleanup-uploads')
+@click.option('--max-age', type=int, default=None, help="Maximum age in seconds (defaults to UPLOAD_RETENTION_SECONDS)")
+def cleanup_uploads_command(max_age):
+    """Delete persisted uploads older than the retention period."""
+    removed = cleanup_uploads(current_app.config['UPLOAD_FOLDER'], max_age if max_age is not None else UPLOAD_RETENTION_SECONDS)
+    click.echo(f"Removed {removed} expired upload(s)")
+
+@api.cli.command('benchmark-extractor')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--extractor', 'name', type=click.Choice(['local', 'mistral', 'pipeline']), default='local')
+def benchmark_extractor(paths, name):
+    """Run an extractor over receipt images and report the results and latencies."""
+    extractor = {
+        'local': local_extractor,
+        'mistral': extraction_pipeline.primary,
+        'pipeline': extraction_pipeline,
+    }[name]
+
+    timings = []
+    for path in paths:
+        image_bytes, mime_type, _ = preprocess_image(
+            path,
+            max_edge=PREPROCESS_MAX_EDGE,
+            grayscale=PREPROCESS_GRAYSCALE,
+            image_format=PREPROCESS_FORMAT,
+            target_bytes=PREPROCESS_TARGET_BYTES,
+        )
+        started = time.perf_counter()
+        try:
+            result = extractor.extract(image_bytes, mime_type)
+        except Exception as e:
+            result = {"error": str(e)}
+        timings.append((time.perf_counter() - started) * 1000)
+        click.echo(f"{path}: {timings[-1]:.1f} ms {json.dumps(result)}")
+
+    timings.sort()
+    click.echo(f"{len(timings)} image(s), median {timings[len(timings) // 2]:.1f} ms, max {timings[-1]:.1f} ms")
+
+@api.cli.command('benchmark-json')
+@click.option('--rows', type=int, default=10000, help="Number of entries per list response")
+@click.option('--repeat', type=int, default=7, help="Runs per measurement; the median is reported")
+def benchmark_json(rows, repeat):
+    """Measure the cost of serializing and encoding the all_expenses and all_incomes responses."""
+    generated = repositories.InMemoryDataStore()
+    generated.seed('benchmark', rows)
+    expenses = list(generated.expenses.stream('benchmark'))
+    incomes = [{**expense, 'Frequency': 'monthly'} for expense in expenses]
+
+    # Flask's stock provider for reference, and the one the application uses
+    providers = {
+        'DefaultJSONProvider': DefaultJSONProvider(current_app._get_current_object()),
+        type(current_app.json).__name__: current_app.json,
+    }
+    for key, entries, serialize in (('expenses', expenses, serialize_expense), ('incomes', incomes, serialize_income)):
+        timings = {}
+        for _ in range(repeat):
+            started = time.perf_counter()
+            serialized = [serialize(entry) for entry in entries]
+            timings.setdefault('serialize', []).append(time.perf_counter() - started)
+            for name, provider in providers.items():
+                started = time.perf_counter()
+                provider.response({key: serialized}).get_data()
+                timings.setdefault(f"encode ({name})", []).append(time.perf_counter() - started)
+
+        report = ', '.join(f"{stage} {sorted(samples)[len(samples) // 2] * 1000:.1f} ms" for stage, samples in timings.items())
+        click.echo(f"{len(entries)} {key}: {report}")
+
+@api.route('/api/upload', methods=['POST'])
+@body_limit(UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD_BYTES)
 def upload_file():
     if 'file' not in request.files:
         return jsonify({"error": "No file provided"}), 400
@@ -504,105 +1085,220 @@ def upload_file():
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
 
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
-
-    # Process the image to extract text and return structured data in JSON format using Mistral API
-    extracted_data = process_image(file_path)
-
-    return jsonify(extracted_data)
-
-def process_image(image_path):
-    try:
-        # Step 1: Resize and compress the image
-        # resized_image_path = resize_and_compress_image(image_path)
-
-        # if resized_image_path is None:
-        #     return {"error": "Failed to process image"}
-
-        # Step 2: Convert the image to Base64
-        base64_image = encode_image(image_path)
-
-        if base64_image is None:
-            return {"error": "Failed to encode image"}
-
-        # Step 3: Prepare the messages for Mistral API
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": """
-                        Extract the following information from the provided image of a bill:
-                        1. Total price or total amount of expense as a number!
-                        2. Name of the expense
-                        3. Date of the bill in the format "YYYY-MM-DD"
-                        4. A short description of the expense
-                        5. Category of the bill with the options: ['Utility', 'Rent', 'Groceries', 'Entertainment', 'Other']
-
-                        Return the extracted information with the following JSON fields:
-                        "amount", "name", "date", "description", "category"
-                        """
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": f"data:image/jpeg;base64,{base64_image}"
-                    }
-                ]
-            }
-        ]
-
-        # Step 4: Call the Mistral API
-        response = call_mistral_api(messages)
+    # Read the upload once into memory (spilling to an anonymous temp file past the spool size)
+    try:
+        digest, image = spool_upload(file, UPLOAD_MAX_BYTES, spool_bytes=UPLOAD_SPOOL_BYTES)
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+
+    # Identical bytes were already extracted: answer right away without calling the model
+    cached_result = receipt_cache.get(digest)
+    if cached_result is not None:
+        image.close()
+        return jsonify({
+            "job_id": None,
+            "status": "done",
+            "result": cached_result,
+            "cached": True
+        }), 200
 
-        if 'error' in response:
-            return {"error": "Failed to get response from Mistral"}
+    # Only keep a copy on disk when configured to
+    if UPLOAD_PERSIST:
+        persist_upload(image, digest, file.filename, current_app.config['UPLOAD_FOLDER'])
+        upload_retention.maybe_cleanup()
 
-        # Return the response as is since it will already be in JSON format
-        return response
+    # Queue the extraction instead of blocking this request thread on the Mistral API;
+    # the job owns the spooled image from here on
+    try:
+        job_id = ocr_jobs.submit(image, digest)
+    except (jobs.QueueFull, jobs.JobStoreUnavailable) as e:
+        image.close()
+        return retry_later(e)
+
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/api/upload/{job_id}"
+    }), 202
+
+# Extract many receipts at once: 'files' holds images and/or ZIP archives of images.
+# Results are streamed as NDJSON (or SSE with ?format=sse) in completion order
+@api.route('/api/upload/batch', methods=['POST'])
+@body_limit(BATCH_MAX_BYTES + MULTIPART_OVERHEAD_BYTES)
+def upload_batch():
+    files = request.files.getlist('files') + request.files.getlist('file')
+    files = [file for file in files if file.filename]
+    if not files:
+        return jsonify({"error": "No files provided"}), 400
+
+    stream_format = request.args.get('format', 'ndjson')
+    if stream_format not in ('ndjson', 'sse'):
+        return jsonify({"error": "'format' must be 'ndjson' or 'sse'"}), 400
+
+    # Spool every image before responding; the extractions then run while results stream out.
+    # The limits are enforced while archives are unpacked, so a zip bomb is rejected early
+    images = []
+    limits = BatchLimits(BATCH_MAX_FILES, BATCH_MAX_UNPACKED_BYTES)
+    try:
+        for file in files:
+            if is_zip_upload(file):
+                images.extend(spool_zip(file, UPLOAD_MAX_BYTES, spool_bytes=UPLOAD_SPOOL_BYTES, limits=limits))
+            else:
+                limits.add()
+                images.append((file.filename, *spool_upload(file, UPLOAD_MAX_BYTES, spool_bytes=UPLOAD_SPOOL_BYTES)))
+    except UploadTooLarge as e:
+        close_images(images)
+        return jsonify({"error": str(e)}), 413
+    except (ValueError, zipfile.BadZipFile) as e:
+        close_images(images)
+        return jsonify({"error": str(e)}), 400
+
+    mimetype = 'text/event-stream' if stream_format == 'sse' else 'application/x-ndjson'
+    return Response(stream_with_context(batch_results(images, stream_format)), mimetype=mimetype)
+
+def batch_results(images, stream_format):
+    """Extract the spooled images on a bounded pool and yield each result as soon as it completes."""
+    executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch-extract')
+    try:
+        futures = [
+            executor.submit(extract_batch_item, index, filename, digest, image)
+            for index, (filename, digest, image) in enumerate(images)
+        ]
+        for future in as_completed(futures):
+            line = json.dumps(future.result())
+            yield f"data: {line}\n\n" if stream_format == 'sse' else f"{line}\n"
+    finally:
+        # Stop pending extractions if the client went away
+        executor.shutdown(wait=False, cancel_futures=True)
+        close_images(images)
+
+def extract_batch_item(index, filename, digest, image):
+    """Extract one image of a batch, answering from the receipt cache when possible."""
+    item = {"index": index, "filename": filename}
+    try:
+        cached_result = receipt_cache.get(digest)
+        if cached_result is not None:
+            return {**item, "status": "done", "result": cached_result, "cached": True}
 
+        return {**item, "status": "done", "result": extract_receipt(image, digest), "cached": False}
     except Exception as e:
-        return {"error": str(e)}
+        return {**item, "status": "failed", "error": str(e)}
+    finally:
+        image.close()
 
-def call_mistral_api(messages):
-    """Call Mistral API with the given messages to extract bill info."""
+def close_images(images):
+    for _, _, image in images:
+        image.close()
+
+# Status of an extraction job; 'result' holds the extracted data once 'status' is 'done'
+@api.route('/api/upload/<job_id>', methods=['GET'])
+def get_upload_job(job_id):
     try:
-        chat_response = client.chat.complete(
-            model=MODEL_ID,
-            messages=messages,
-            response_format={"type": "json_object"}  # This ensures the response is in JSON format
-        )
+        job = ocr_jobs.get(job_id)
+    except jobs.JobStoreUnavailable as e:
+        return retry_later(e)
 
-        # Return the extracted JSON from Mistral response
-        return chat_response.choices[0].message.content
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
 
-    except Exception as e:
-        logging.error(f"Error during Mistral API call: {e}")
-        return {"error": str(e)}
+    return jsonify(job), 200
 
-def resize_and_compress_image(image_path, max_size=(800, 800), quality=80):
-    """Resize and compress image to reduce file size, converting RGBA to RGB if necessary."""
+def extract_receipt(image, digest):
+    """Job handler: extract the bill data of a spooled upload, raising on failure."""
     try:
-        with Image.open(image_path) as img:
-            img.thumbnail(max_size)
-            if img.mode == 'RGBA':
-                img = img.convert('RGB')
-            img.save(image_path, format='JPEG', quality=quality)
-        return image_path
-    except Exception as e:
-        logging.error(f"Error processing image {image_path}: {e}")
-        return None
-    
-def encode_image(image_path):
-    """Encode the image to Base64."""
+        extracted_data = process_image(image)
+    finally:
+        image.close()
+    if isinstance(extracted_data, dict) and 'error' in extracted_data:
+        raise RuntimeError(extracted_data['error'])
+
+    # Remember the result so re-uploads of the same bytes skip the model call. Results of
+    # the local extractor are not kept, so a later upload gets another chance at the model
+    if extracted_data.get('extractor') != local_extractor.name:
+        receipt_cache.set(digest, extracted_data)
+    return extracted_data
+
+# Totals of the image preprocessing reports
+preprocess_stats = PreprocessStats()
+
+# Extraction results of previous uploads, keyed by the SHA-256 of the image bytes
+receipt_cache = ReceiptCache(RECEIPT_CACHE_DIR, max_bytes=RECEIPT_CACHE_MAX_BYTES)
+
+# Worker pool running the receipt extractions, with a bounded queue for backpressure
+ocr_jobs = jobs.JobQueue(
+    extract_receipt,
+    workers=OCR_WORKERS,
+    max_queue=OCR_QUEUE_SIZE,
+    result_ttl=OCR_RESULT_TTL_SECONDS,
+    name='ocr',
+    store=create_job_store('ocr'),
+)
+
+def process_image(image):
+    """Extract the bill data of an image given as a file path or a seekable file object."""
     try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    except FileNotFoundError:
-        logging.error(f"Error: The file {image_path} was not found.")
-        return None
+        # Step 1: Preprocess the image in memory (orientation, size, contrast, byte budget)
+        try:
+            if hasattr(image, 'seek'):
+                image.seek(0)
+            image_bytes, mime_type, report = preprocess_image(
+                image,
+                max_edge=PREPROCESS_MAX_EDGE,
+                grayscale=PREPROCESS_GRAYSCALE,
+                image_format=PREPROCESS_FORMAT,
+                target_bytes=PREPROCESS_TARGET_BYTES,
+            )
+            preprocess_stats.record(report)
+            logging.info(f"Preprocessed image: {report}")
+        except Exception as e:
+            # Formats Pillow can't decode are sent to the model unchanged
+            logging.warning(f"Preprocessing failed, sending the original image: {e}")
+            mime_type = 'image/jpeg'
+            image_bytes = read_image(image)
+
+        # Step 2: Extract the bill data with the model, or the local extractor when the
+        # model fails or exceeds the latency budget
+        return extraction_pipeline.extract(image_bytes, mime_type)
+
+    except Exception as e:
+        logging.error(f"Receipt extraction failed: {e}")
+        return {"error": str(e)}
+
+def read_image(image):
+    """Read the bytes of an image given as a file path or a file object."""
+    if isinstance(image, str):
+        with open(image, 'rb') as image_file:
+            return image_file.read()
+    image.seek(0)
+    return image.read()
+
+def create_app():
+    """Create the application (see wsgi.py and gunicorn.conf.py).
+
+    Cheap: the datastore and the Mistral client are created on first use, in the process
+    that uses them, so workers forked afterwards never share their connections.
+    """
+    app = Flask(__name__)
+    app.json = JSONProvider(app)
+    CORS(app)  # Enable CORS for the entire app
+
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    # Reject oversized requests before they are read. The upload, import and bulk endpoints
+    # raise the limit for themselves (body_limit); files are also capped while they are spooled
+    app.config['MAX_CONTENT_LENGTH'] = REQUEST_MAX_BYTES
+
+    app.register_blueprint(api)
+    return app
+
+def shutdown(timeout):
+    """Finish the background work of this process within `timeout` seconds before it exits."""
+    deadline = time.monotonic() + timeout
+    for queue in (ocr_jobs, import_jobs):
+        if not queue.drain(max(deadline - time.monotonic(), 0)):
+            logging.warning(f"Shutting down with unfinished {queue.name} jobs")
+    query_executor.shutdown(wait=False, cancel_futures=True)
+    mistral.close()
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=True)
+    # Development server only; production runs under gunicorn (gunicorn.conf.py)
+    create_app().run(host="0.0.0.0", debug=DEBUG)
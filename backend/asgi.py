@@ -0,0 +1,274 @@
+"""ASGI entry point: gunicorn -c gunicorn.conf.py (uvicorn workers), or uvicorn asgi:app
+
+The aggregate read endpoints and the dashboard are served by async handlers. Each handler
+awaits its independent datastore queries concurrently with asyncio.gather, through the
+Firestore AsyncClient, so a single process serves many concurrent dashboard loads while
+their queries are in flight. Every other request (writes, uploads, lists, exports) is
+passed to the WSGI application of app.py and runs on a thread pool, so one server serves
+the whole API. Both halves share the response cache: a write invalidates the async
+endpoints' cached responses too.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from functools import wraps
+
+from a2wsgi import WSGIMiddleware
+from quart import Blueprint, Quart, Response, jsonify, make_response, request
+
+import app as wsgi
+import async_repositories
+import cache
+from conditional import is_not_modified, set_validators, validators
+from aggregates import month_key, month_window
+from config import ASGI_WSGI_THREADS, DATA_BACKEND, FIREBASE_CREDENTIALS
+from jsonprovider import JSONProvider
+
+# Seconds the background jobs of the WSGI application get to finish on shutdown
+SHUTDOWN_TIMEOUT = 30
+
+# Same blueprint and endpoint names as app.py, so both halves share their cached responses
+api = Blueprint('api', __name__)
+
+# Async repositories, created on startup within the event loop of each process
+store = None
+
+def cached(view):
+    """Cache the successful responses of an async GET handler per user and parameters."""
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        userid = request.args.get('userid')
+        if not userid:
+            return await view(*args, **kwargs)
+
+        # Cache backends may block on Redis, so they are called off the event loop
+        key = cache.cache_key(request.endpoint, userid, request.args)
+        cached_response = await asyncio.to_thread(wsgi.response_cache.backend.get, key)
+        if cached_response is not None:
+            body, mimetype = cached_response
+            return Response(body, status=200, mimetype=mimetype)
+
+        # Read before computing the response; a write meanwhile keeps it out of the cache
+        generation = await asyncio.to_thread(wsgi.response_cache.backend.generation, userid)
+        response, status = await view(*args, **kwargs)
+        if status == 200 and generation is not None:
+            body = await response.get_data()
+            await asyncio.to_thread(
+                wsgi.response_cache.backend.set, key, userid, body, response.mimetype, generation
+            )
+        return response, status
+
+    return wrapper
+
+def conditional(view):
+    """Send validators from the user's data version and answer current ones with 304 (see conditional.py)."""
+    responses = wsgi.conditional_responses
+
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        userid = request.args.get('userid')
+        if not userid:
+            return await view(*args, **kwargs)
+
+        try:
+            version, updated_at = await store.versions.get(userid)
+        except Exception as e:
+            logging.warning(f"Reading the data version of user {userid} failed: {e}")
+            responses.count('errors')
+            return await view(*args, **kwargs)
+
+        etag, last_modified = validators(version, updated_at, responses.window)
+        if is_not_modified(request, etag, last_modified):
+            responses.count('not_modified')
+            return set_validators(Response(b'', status=304), etag, last_modified)
+
+        responses.count('full_responses')
+        response = await make_response(await view(*args, **kwargs))
+        if response.status_code == 200:
+            set_validators(response, etag, last_modified)
+        return response
+
+    return wrapper
+
+@api.route('/api/monthly-income', methods=['GET'])
+@conditional
+@cached
+async def get_monthly_income():
+    try:
+        userid = request.args.get('userid')
+
+        if not userid:
+            return jsonify({"error": "Missing 'userid' in query parameters"}), 400
+
+        # Read the current month's aggregate and the recurrence rules concurrently
+        now = datetime.now()
+        current_key = month_key(now)
+        aggregated, rules = await asyncio.gather(
+            store.aggregates.get_months(userid, [current_key]),
+            store.recurrence.list_rules(userid),
+        )
+        recurring = wsgi.recurrence_engine.extra_income(userid, rules, [current_key], now)
+
+        return jsonify({
+            "total_monthly_income": aggregated[current_key]["income"] + recurring[current_key]
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+async def read_window(userid, months):
+    """Read the aggregates of the last `months` months and the recurring income of each of them."""
+    now = datetime.now()
+    month_keys, _, _ = month_window(now, months)
+    aggregated, rules = await asyncio.gather(
+        store.aggregates.get_months(userid, month_keys),
+        store.recurrence.list_rules(userid),
+    )
+    return month_keys, aggregated, wsgi.recurrence_engine.extra_income(userid, rules, month_keys, now)
+
+@api.route('/api/monthly-income-last6months', methods=['GET'])
+@conditional
+@cached
+async def get_monthly_income_last_6_months():
+    try:
+        userid = request.args.get('userid')
+
+        if not userid:
+            return jsonify({"error": "Missing 'userid' in query parameters"}), 400
+
+        try:
+            months = wsgi.parse_months_arg(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        month_keys, aggregated, recurring = await read_window(userid, months)
+        return jsonify({key: aggregated[key]["income"] + recurring[key] for key in month_keys}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/monthly-savings-last6months', methods=['GET'])
+@conditional
+@cached
+async def get_monthly_savings_last_6_months():
+    try:
+        userid = request.args.get('userid')
+
+        if not userid:
+            return jsonify({"error": "Missing 'userid' in query parameters"}), 400
+
+        try:
+            months = wsgi.parse_months_arg(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        month_keys, aggregated, recurring = await read_window(userid, months)
+        return jsonify(wsgi.monthly_savings(aggregated, recurring, month_keys)), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/financial_summary', methods=['GET'])
+@conditional
+@cached
+async def get_financial_summary():
+    try:
+        userid = request.args.get('userid')
+
+        if not userid:
+            return jsonify({"error": "Missing 'userid' in query parameters"}), 400
+
+        # Sum the monthly aggregates while the recurrence rules are read
+        now = datetime.now()
+        totals, rules = await asyncio.gather(
+            store.aggregates.get_totals(userid, month_key(now)),
+            store.recurrence.list_rules(userid),
+        )
+        totals["income"] += wsgi.recurrence_engine.total_extra_income(userid, rules, now)
+
+        return jsonify(wsgi.financial_summary(totals["income"], totals["expenses"])), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/dashboard', methods=['GET'])
+@conditional
+@cached
+async def get_dashboard():
+    try:
+        userid = request.args.get('userid')
+
+        if not userid:
+            return jsonify({"error": "Missing 'userid' in query parameters"}), 400
+
+        try:
+            sections, months, days = wsgi.parse_dashboard_args(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        now = datetime.now()
+
+        # Only the queries the requested sections need, all in flight at once
+        queries = {}
+        if sections & {'summary', 'monthly_income', 'savings'}:
+            queries["aggregated"] = store.aggregates.list_months(userid, month_key(now))
+            queries["rules"] = store.recurrence.list_rules(userid)
+        if 'recent_expenses' in sections:
+            queries["recent_expenses"] = store.expenses.page(
+                userid, since=now - timedelta(days=days), limit=wsgi.DEFAULT_PAGE_SIZE
+            )
+        results = dict(zip(queries, await asyncio.gather(*queries.values())))
+
+        return jsonify(wsgi.build_dashboard(userid, sections, months, now, **results)), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def create_async_store():
+    """Create the async repositories of the datastore selected by DATA_BACKEND."""
+    if DATA_BACKEND == 'firestore':
+        client = async_repositories.create_async_firestore_client(FIREBASE_CREDENTIALS)
+        return async_repositories.AsyncFirestoreDataStore(client)
+    # The in-memory datastore has no async client; share the WSGI application's
+    return async_repositories.ThreadedDataStore(wsgi.store)
+
+def create_async_app():
+    """Create the Quart application serving the async read endpoints."""
+    async_app = Quart(__name__)
+    async_app.json = JSONProvider(async_app)
+
+    @async_app.before_serving
+    async def open_store():
+        global store
+        store = create_async_store()
+
+    @async_app.after_serving
+    async def finish_background_jobs():
+        await asyncio.to_thread(wsgi.shutdown, SHUTDOWN_TIMEOUT)
+
+    @async_app.after_request
+    async def allow_cross_origin(response):
+        # Matches flask_cors' defaults on the WSGI application
+        response.headers.setdefault('Access-Control-Allow-Origin', '*')
+        return response
+
+    async_app.register_blueprint(api)
+    return async_app
+
+def create_app():
+    """Create the ASGI application: async read endpoints, the rest of the API over WSGI."""
+    async_app = create_async_app()
+    # Request bodies are streamed to the WSGI application, so uploads are still spooled
+    wsgi_app = WSGIMiddleware(wsgi.create_app(), workers=ASGI_WSGI_THREADS)
+    async_paths = {rule.rule for rule in async_app.url_map.iter_rules() if rule.endpoint != 'static'}
+
+    async def dispatch(scope, receive, send):
+        # Lifespan events go to the async application, which opens and closes the store
+        if scope['type'] == 'http' and not (scope['method'] == 'GET' and scope['path'] in async_paths):
+            await wsgi_app(scope, receive, send)
+        else:
+            await async_app(scope, receive, send)
+
+    return dispatch
+
+app = create_app()
@@ -0,0 +1,139 @@
+"""Async, read-only access to the datastore for the ASGI read endpoints (see asgi.py).
+
+The Firestore repositories here issue the same queries as their synchronous counterparts
+in repositories.py through the Firestore AsyncClient. A handler can therefore await several
+independent queries at once with asyncio.gather while the event loop keeps serving other
+requests. ThreadedDataStore exposes a synchronous DataStore, such as the in-memory one,
+through the same async interface by running its calls on the event loop's thread pool.
+"""
+import asyncio
+
+import aggregates
+import recurrence
+from aggregates import empty_aggregate
+from repositories import (DEFAULT_PAGE_SIZE, VERSION_FIELDS, DataStore, entries_query, page_query, snapshot_entry,
+                          split_page, version_of)
+
+class AsyncFirestoreEntryRepository:
+    """Reads entries stored under users/{userid}/{kind}/{id} with the Firestore AsyncClient."""
+
+    def __init__(self, db, kind):
+        if kind not in aggregates.KINDS:
+            raise ValueError(f"Unknown entry kind '{kind}'")
+        self.db = db
+        self.kind = kind
+
+    async def page(self, userid, since=None, until=None, category=None, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        """Return one newest-first page of entries in [since, until) and the next page's cursor."""
+        query = page_query(entries_query(self.db, userid, self.kind, since, until, category), limit, cursor)
+        return split_page([snapshot_entry(snapshot) async for snapshot in query.stream()], limit)
+
+class AsyncFirestoreAggregateRepository:
+    """Reads the monthly aggregates with the Firestore AsyncClient."""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def get_months(self, userid, keys):
+        """Return the aggregates of the given months in a single batched read, keyed by month."""
+        collection = aggregates.aggregates_ref(self.db, userid)
+        months = {key: empty_aggregate(key) for key in keys}
+
+        async for snapshot in self.db.get_all([collection.document(key) for key in keys]):
+            if snapshot.exists:
+                months[snapshot.id].update(snapshot.to_dict())
+
+        return months
+
+    async def list_months(self, userid, until_key):
+        """Return every aggregate up to and including `until_key`, keyed by month."""
+        months = {}
+
+        query = aggregates.aggregates_ref(self.db, userid).where('month', '<=', until_key)
+        async for snapshot in query.stream():
+            months[snapshot.id] = {**empty_aggregate(snapshot.id), **snapshot.to_dict()}
+
+        return months
+
+    async def get_totals(self, userid, until_key):
+        """Return the income and expense totals up to and including `until_key`."""
+        totals = {"income": 0, "expenses": 0}
+
+        query = aggregates.aggregates_ref(self.db, userid).where('month', '<=', until_key).select(['income', 'expenses'])
+        async for snapshot in query.stream():
+            data = snapshot.to_dict()
+            totals["income"] += data.get('income', 0)
+            totals["expenses"] += data.get('expenses', 0)
+
+        return totals
+
+class AsyncFirestoreRecurrenceRepository:
+    """Reads the recurrence rules with the Firestore AsyncClient."""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def list_rules(self, userid):
+        """Return every recurrence rule of a user."""
+        return [recurrence.load_rule(snapshot.to_dict())
+                async for snapshot in recurrence.rules_ref(self.db, userid).stream()]
+
+class AsyncFirestoreVersionRepository:
+    """Reads the data versions with the Firestore AsyncClient."""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, userid):
+        """Return the (version, updated_at) of a user's data, (0, None) before their first write."""
+        return version_of(await self.db.collection('users').document(userid).get(VERSION_FIELDS))
+
+class AsyncFirestoreDataStore(DataStore):
+    """Async repositories backed by a Firestore AsyncClient."""
+
+    def __init__(self, db):
+        super().__init__(
+            AsyncFirestoreEntryRepository(db, 'expenses'),
+            AsyncFirestoreEntryRepository(db, 'income'),
+            AsyncFirestoreAggregateRepository(db),
+            AsyncFirestoreRecurrenceRepository(db),
+            AsyncFirestoreVersionRepository(db),
+        )
+
+class ThreadedRepository:
+    """Exposes the methods of a synchronous repository as coroutines run in a thread."""
+
+    def __init__(self, repository):
+        self._repository = repository
+
+    def __getattr__(self, name):
+        method = getattr(self._repository, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+
+        return call
+
+class ThreadedDataStore(DataStore):
+    """Async view of a synchronous DataStore, for datastores without an async client."""
+
+    def __init__(self, store):
+        super().__init__(
+            ThreadedRepository(store.expenses),
+            ThreadedRepository(store.incomes),
+            ThreadedRepository(store.aggregates),
+            ThreadedRepository(store.recurrence),
+            ThreadedRepository(store.versions),
+        )
+
+def create_async_firestore_client(credentials_path):
+    """Create a Firestore AsyncClient from a service account key file.
+
+    Its gRPC channel is bound to the running event loop, so it is created from within the
+    loop, once per process.
+    """
+    from firebase_admin import credentials
+    from google.cloud import firestore
+
+    cred = credentials.Certificate(credentials_path)
+    return firestore.AsyncClient(project=cred.project_id, credentials=cred.get_credential())
@@ -0,0 +1,124 @@
+"""Parsing and validation of bulk income and expense imports.
+
+A bulk request carries its rows as a JSON array (or an object with an 'entries' array),
+as NDJSON with one object per line, or as CSV with a header row. Every row is validated
+before anything is written, and the errors are reported per row.
+"""
+import csv
+import io
+import json
+import math
+from datetime import datetime, timezone
+
+# Required fields per entry kind, matching add_income and add_expense
+REQUIRED_FIELDS = {
+    'income': ('Amount', 'Category', 'Date', 'Frequency', 'Name'),
+    'expenses': ('Amount', 'Category', 'Date', 'Description', 'Name'),
+}
+
+# Accepted date formats besides ISO 8601; the first two are those of the single-entry endpoints
+DATE_FORMATS = (
+    "%d %B %Y at %H:%M:%S %Z",
+    "%d %B %Y",
+    "%d.%m.%Y",
+    "%m/%d/%Y",
+)
+
+CONTENT_TYPES = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv',
+}
+
+def parse_rows(body, content_type):
+    """Parse a request body into a list of row dicts according to its content type.
+
+    Returns the rows and the 'uid' of a JSON object body, if any. Raises ValueError for
+    unsupported content types and malformed bodies.
+    """
+    body_format = CONTENT_TYPES.get((content_type or '').split(';')[0].strip().lower())
+    if body_format is None:
+        raise ValueError(f"Unsupported content type '{content_type}', use JSON, NDJSON or CSV")
+
+    if body_format == 'json':
+        data = json.loads(body)
+        if isinstance(data, dict):
+            return _check_rows(data.get('entries')), data.get('uid')
+        return _check_rows(data), None
+
+    if body_format == 'ndjson':
+        rows = []
+        for line_number, line in enumerate(body.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError as e:
+                raise ValueError(f"Invalid JSON on line {line_number}: {e}")
+        return _check_rows(rows), None
+
+    return list(csv.DictReader(io.StringIO(body))), None
+
+def _check_rows(rows):
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError("Expected an array of entry objects")
+    return rows
+
+def parse_date(value):
+    """Parse an entry date given as ISO 8601 or one of DATE_FORMATS.
+
+    Dates with a UTC offset are converted to naive UTC, like every date the API stores.
+    """
+    if isinstance(value, datetime):
+        return _naive_utc(value)
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid date {value!r}")
+
+    value = value.strip()
+    try:
+        return _naive_utc(datetime.fromisoformat(value))
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid date {value!r}")
+
+def _naive_utc(date):
+    if date.tzinfo is not None:
+        return date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+def validate_entry(kind, row):
+    """Return the entry to store for a row, or raise ValueError describing what is wrong."""
+    missing = [field for field in REQUIRED_FIELDS[kind] if row.get(field) in (None, '')]
+    if missing:
+        raise ValueError(f"Missing {', '.join(repr(field) for field in missing)}")
+
+    try:
+        amount = float(row['Amount'])
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid amount {row['Amount']!r}")
+    if not math.isfinite(amount):
+        raise ValueError(f"Invalid amount {row['Amount']!r}")
+
+    entry = {field: str(row[field]).strip() for field in REQUIRED_FIELDS[kind]}
+    entry["Amount"] = amount
+    entry["Date"] = parse_date(row['Date'])
+    return entry
+
+def validate_rows(kind, rows):
+    """Validate every row; return the valid entries and a list of {row, error} for the others.
+
+    Row numbers count from 1 in the order the rows were given.
+    """
+    entries, errors = [], []
+    for row_number, row in enumerate(rows, start=1):
+        try:
+            entries.append(validate_entry(kind, row))
+        except ValueError as e:
+            errors.append({"row": row_number, "error": str(e)})
+    return entries, errors
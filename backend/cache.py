@@ -0,0 +1,444 @@
+"""Response cache for the per-user read endpoints.
+
+Responses are cached by (endpoint, userid, query parameters). Writes for a user invalidate
+exactly that user's entries, so repeated dashboard loads are served without any Firestore
+reads. Each invalidation also moves the user to a new cache generation: a response computed
+while a write was committed is only stored if the user's generation is still the one read
+before computing it, so a read racing a write cannot cache its stale body. Storage is pluggable: MemoryCacheBackend keeps entries in the current process, while
+RedisCacheBackend shares them between every worker and container and broadcasts
+invalidations to all of them.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, make_response, request
+
+class CacheBackend:
+    """Storage interface of the response cache."""
+
+    def get(self, key):
+        """Return the cached (body, mimetype) for a key, or None on a miss."""
+        raise NotImplementedError
+
+    def generation(self, userid):
+        """Return the user's current cache generation, or None if it cannot be read."""
+        raise NotImplementedError
+
+    def set(self, key, userid, body, mimetype, generation=None):
+        """Cache a response body for a user, unless their generation is no longer `generation`."""
+        raise NotImplementedError
+
+    def invalidate_user(self, userid):
+        """Drop every cached response of a user."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Drop every cached response."""
+        raise NotImplementedError
+
+    def stats(self):
+        """Return the cache counters."""
+        raise NotImplementedError
+
+class MemoryCacheBackend(CacheBackend):
+    """Thread-safe in-process TTL + LRU cache, bounded in entries and bytes."""
+
+    def __init__(self, ttl=60, max_entries=1024, max_bytes=16 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # key -> (expires_at, userid, body, mimetype), oldest first
+        self._entries = OrderedDict()
+        # userid -> set of keys, so a user's entries can be dropped without a full scan
+        self._keys_by_user = {}
+        # userid -> number of invalidations of the user
+        self._generations = {}
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, _, body, mimetype = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body, mimetype
+
+    def generation(self, userid):
+        with self._lock:
+            return self._generations.get(userid, 0)
+
+    def set(self, key, userid, body, mimetype, generation=None):
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            if generation is not None and self._generations.get(userid, 0) != generation:
+                # The user's data changed while the response was computed
+                return
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + self.ttl, userid, body, mimetype)
+            self._keys_by_user.setdefault(userid, set()).add(key)
+            self._bytes += len(body)
+
+            # Evict the least recently used entries to stay in bounds
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def invalidate_user(self, userid):
+        with self._lock:
+            self._generations[userid] = self._generations.get(userid, 0) + 1
+            for key in list(self._keys_by_user.get(userid, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, key):
+        # Caller must hold the lock
+        _, userid, body, _ = self._entries.pop(key)
+        self._bytes -= len(body)
+        user_keys = self._keys_by_user.get(userid)
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._keys_by_user[userid]
+
+class RedisCacheBackend(CacheBackend):
+    """Cache shared by every worker through a Redis-protocol server.
+
+    Entries expire through Redis TTLs, and the memory bound is the server's maxmemory with
+    the volatile-lru policy, which only evicts keys with a TTL. Each user has an index set of
+    their keys so invalidation deletes exactly their entries, and a generation counter without
+    a TTL that invalidation increments. Every entry records the generation it was computed
+    under and is only served while that is still the user's generation, so an evicted index
+    set cannot leave stale entries behind. Invalidations are also published on a channel so
+    every worker drops its optional near cache (a small MemoryCacheBackend in front of Redis).
+    """
+
+    def __init__(self, client, ttl=60, max_bytes=16 * 1024 * 1024, prefix='cachemoney:cache', near_cache=None):
+        self.client = client
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.channel = f"{prefix}:invalidate"
+        self.near_cache = near_cache
+
+        self._lock = threading.Lock()
+        self._subscriber = None
+        self._subscriber_pid = None
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """Create a backend connected to the Redis server at `url`."""
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The 'redis' package is required for the Redis cache backend")
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        self._ensure_subscribed()
+
+        near_generation = None
+        if self.near_cache is not None:
+            cached = self.near_cache.get(key)
+            if cached is not None:
+                self._count('hits')
+                return cached
+            # Read before Redis, so an invalidation broadcast meanwhile keeps the body out of the near cache
+            near_generation = self.near_cache.generation(key[1])
+
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hmget(self._entry_key(key), 'body', 'mimetype', 'generation')
+            pipe.get(self._generation_key(key[1]))
+            (body, mimetype, entry_generation), generation = pipe.execute()
+        except Exception as e:
+            # A cache outage must not fail the request; fall through to Firestore
+            logging.warning(f"Redis cache read failed: {e}")
+            self._count('errors')
+            return None
+
+        if body is None or int(entry_generation or 0) != int(generation or 0):
+            self._count('misses')
+            return None
+
+        self._count('hits')
+        mimetype = mimetype.decode('utf-8')
+        if self.near_cache is not None:
+            self.near_cache.set(key, key[1], body, mimetype, near_generation)
+        return body, mimetype
+
+    def generation(self, userid):
+        try:
+            return int(self.client.get(self._generation_key(userid)) or 0)
+        except Exception as e:
+            logging.warning(f"Redis cache read failed: {e}")
+            self._count('errors')
+            return None
+
+    def set(self, key, userid, body, mimetype, generation=None):
+        if len(body) > self.max_bytes:
+            return
+
+        # The client is a redis-py client, so the package is installed
+        from redis.exceptions import WatchError
+
+        near_generation = self.near_cache.generation(userid) if self.near_cache is not None else None
+        entry_key = self._entry_key(key)
+        user_key = self._user_key(userid)
+        generation_key = self._generation_key(userid)
+        try:
+            with self.client.pipeline() as pipe:
+                # The write is discarded if an invalidation increments the generation before it runs
+                pipe.watch(generation_key)
+                current = int(pipe.get(generation_key) or 0)
+                if generation is not None and current != generation:
+                    return
+                pipe.multi()
+                pipe.hset(entry_key, mapping={'body': body, 'mimetype': mimetype, 'generation': current})
+                pipe.expire(entry_key, self.ttl)
+                pipe.sadd(user_key, entry_key)
+                pipe.expire(user_key, self.ttl)
+                pipe.execute()
+        except WatchError:
+            return
+        except Exception as e:
+            logging.warning(f"Redis cache write failed: {e}")
+            self._count('errors')
+            return
+
+        if self.near_cache is not None:
+            self.near_cache.set(key, userid, body, mimetype, near_generation)
+
+    def invalidate_user(self, userid):
+        user_key = self._user_key(userid)
+        try:
+            entry_keys = self.client.smembers(user_key)
+            pipe = self.client.pipeline()
+            if entry_keys:
+                pipe.delete(*entry_keys)
+            pipe.delete(user_key)
+            # No TTL, so it is never evicted and never starts over at a generation already used
+            pipe.incr(self._generation_key(userid))
+            pipe.publish(self.channel, userid)
+            pipe.execute()
+        except Exception as e:
+            logging.warning(f"Redis cache invalidation failed: {e}")
+            self._count('errors')
+
+        self._count('invalidations')
+        if self.near_cache is not None:
+            self.near_cache.invalidate_user(userid)
+
+    def clear(self):
+        try:
+            # Entries and index sets only: the generations must keep counting up
+            generations = f"{self.prefix}:generation:".encode('utf-8')
+            keys = [key for key in self.client.scan_iter(match=f"{self.prefix}:*") if not key.startswith(generations)]
+            if keys:
+                self.client.delete(*keys)
+        except Exception as e:
+            logging.warning(f"Redis cache clear failed: {e}")
+            self._count('errors')
+
+        if self.near_cache is not None:
+            self.near_cache.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "backend": "redis",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "errors": self.errors,
+                "invalidations": self.invalidations,
+            }
+
+        try:
+            server = self.client.info()
+            stats["evictions"] = server.get('evicted_keys', 0)
+            stats["expirations"] = server.get('expired_keys', 0)
+            stats["bytes"] = server.get('used_memory', 0)
+        except Exception as e:
+            logging.debug(f"Redis cache stats unavailable: {e}")
+
+        if self.near_cache is not None:
+            stats["near_cache"] = self.near_cache.stats()
+        return stats
+
+    def _ensure_subscribed(self):
+        # Subscribe lazily, again after a fork so every worker process has its own listener,
+        # and again if the listener thread died
+        if self.near_cache is None or self._subscribed():
+            return
+
+        with self._lock:
+            if self._subscribed():
+                return
+            if self._subscriber is not None:
+                # Invalidations published since the previous listener stopped were missed
+                self.near_cache.clear()
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.channel: self._on_invalidate})
+                self._subscriber = pubsub.run_in_thread(
+                    sleep_time=1, daemon=True, exception_handler=self._on_subscriber_error
+                )
+                self._subscriber_pid = os.getpid()
+            except Exception as e:
+                logging.warning(f"Redis cache subscription failed: {e}")
+                # Invalidations published meanwhile are missed
+                self.near_cache.clear()
+
+    def _subscribed(self):
+        return (
+            self._subscriber_pid == os.getpid()
+            and self._subscriber is not None
+            and self._subscriber.is_alive()
+        )
+
+    def _on_subscriber_error(self, error, pubsub, thread):
+        # The listener keeps running and redis-py reconnects and resubscribes on its next
+        # read, but invalidations published while disconnected are lost
+        logging.warning(f"Redis cache subscription failed, dropping the near cache: {error}")
+        self._count('errors')
+        self.near_cache.clear()
+        time.sleep(1)
+
+    def _on_invalidate(self, message):
+        userid = message['data']
+        if isinstance(userid, bytes):
+            userid = userid.decode('utf-8')
+        self.near_cache.invalidate_user(userid)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _entry_key(self, key):
+        endpoint, userid, params = key
+        digest = hashlib.sha1(repr((endpoint, params)).encode('utf-8')).hexdigest()
+        return f"{self.prefix}:{userid}:{digest}"
+
+    def _user_key(self, userid):
+        return f"{self.prefix}:user:{userid}"
+
+    def _generation_key(self, userid):
+        return f"{self.prefix}:generation:{userid}"
+
+class ResponseCache:
+    """Caches the successful responses of GET handlers in a CacheBackend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def invalidate_user(self, userid):
+        """Drop every cached response of a user, in every worker sharing the backend."""
+        self.backend.invalidate_user(userid)
+
+    def clear(self):
+        """Drop every cached response."""
+        self.backend.clear()
+
+    def stats(self):
+        """Return the backend's cache counters."""
+        return self.backend.stats()
+
+    def cached(self, view):
+        """Decorate a GET handler so its successful responses are cached per user and parameters."""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            userid = request.args.get('userid')
+            if not userid:
+                return view(*args, **kwargs)
+
+            key = cache_key(request.endpoint, userid, request.args)
+            cached = self.backend.get(key)
+            if cached is not None:
+                body, mimetype = cached
+                return Response(body, status=200, mimetype=mimetype)
+
+            # Read before computing the response; a write meanwhile keeps it out of the cache
+            generation = self.backend.generation(userid)
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed and generation is not None:
+                self.backend.set(key, userid, response.get_data(), response.mimetype, generation)
+            return response
+
+        return wrapper
+
+def cache_key(endpoint, userid, args):
+    """Build the cache key of a request from its endpoint, user and remaining query parameters."""
+    params = tuple(sorted(
+        (name, tuple(values)) for name, values in args.lists() if name != 'userid'
+    ))
+    return (endpoint, userid, params)
+
+def create_backend(name, ttl=60, max_entries=1024, max_bytes=16 * 1024 * 1024, redis_url=None, near_cache_ttl=0):
+    """Create the cache backend selected by `name` ('memory' or 'redis')."""
+    if name == 'memory':
+        return MemoryCacheBackend(ttl=ttl, max_entries=max_entries, max_bytes=max_bytes)
+
+    if name == 'redis':
+        near_cache = None
+        if near_cache_ttl:
+            near_cache = MemoryCacheBackend(ttl=near_cache_ttl, max_entries=max_entries, max_bytes=max_bytes)
+        return RedisCacheBackend.from_url(redis_url, ttl=ttl, max_bytes=max_bytes, near_cache=near_cache)
+
+    raise ValueError(f"Unknown cache backend '{name}'")
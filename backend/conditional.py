@@ -0,0 +1,96 @@
+"""HTTP conditional requests (ETag / Last-Modified / 304) for the per-user read endpoints.
+
+Every write of a user's entries bumps that user's data version (VersionRepository). The
+read endpoints send validators derived from it, and a request whose If-None-Match or
+If-Modified-Since still matches is answered with 304 Not Modified after reading only the
+version: the handler, the response cache and the datastore queries are all skipped.
+
+Responses also depend on the current time (recent expenses, month boundaries, recurring
+occurrences), so the validators change every `window` seconds even without writes.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import Response, make_response, request
+
+def validators(version, updated_at, window, now=None):
+    """Return the (etag, last_modified) of a user's responses at data version `version`."""
+    bucket = int((now if now is not None else time.time()) // window)
+    bucket_start = datetime.fromtimestamp(bucket * window, timezone.utc)
+    last_modified = max(updated_at, bucket_start) if updated_at is not None else bucket_start
+    return f"{version}.{bucket}", last_modified
+
+def is_not_modified(request, etag, last_modified):
+    """Return whether the validators a request sends are current, so it can be answered with 304."""
+    # If-None-Match takes precedence over If-Modified-Since
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+def set_validators(response, etag, last_modified):
+    """Add the validators to a response, requiring clients to revalidate before reusing it."""
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # Without it, browsers may reuse the response unchecked based on its Last-Modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+class ConditionalResponses:
+    """Answers conditional GET requests from the user's data version."""
+
+    def __init__(self, get_version, window=300):
+        self.get_version = get_version
+        self.window = window
+
+        self._lock = threading.Lock()
+        self.full_responses = 0
+        self.not_modified = 0
+        self.errors = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "window_seconds": self.window,
+                "full_responses": self.full_responses,
+                "not_modified": self.not_modified,
+                "errors": self.errors,
+            }
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def conditional(self, view):
+        """Decorate a GET handler so it sends validators and answers current ones with 304."""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            userid = request.args.get('userid')
+            if not userid:
+                return view(*args, **kwargs)
+
+            try:
+                version, updated_at = self.get_version(userid)
+            except Exception as e:
+                # Serve the request unconditionally rather than failing it
+                logging.warning(f"Reading the data version of user {userid} failed: {e}")
+                self.count('errors')
+                return view(*args, **kwargs)
+
+            etag, last_modified = validators(version, updated_at, self.window)
+            if is_not_modified(request, etag, last_modified):
+                self.count('not_modified')
+                return set_validators(Response(status=304), etag, last_modified)
+
+            self.count('full_responses')
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                set_validators(response, etag, last_modified)
+            return response
+
+        return wrapper
@@ -1,2 +1,110 @@
+import os
+
+# Debug mode of the development server, and the log level
+DEBUG = os.environ.get("FLASK_DEBUG", "1") == "1"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+
 API_KEY = ""
 MODEL_ID = "pixtral-12b-2409"
+
+# Response cache of the read endpoints: 'memory' (per process) or 'redis' (shared by all workers)
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory")
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+# Redis of the job and idempotency records, which must not be evicted like cache entries:
+# point it at a server with maxmemory-policy noeviction (defaults to the cache's server)
+STATE_REDIS_URL = os.environ.get("STATE_REDIS_URL", CACHE_REDIS_URL)
+CACHE_TTL_SECONDS = 60
+CACHE_MAX_ENTRIES = 1024
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+# TTL of the per-worker near cache in front of Redis (0 disables it)
+CACHE_NEAR_TTL_SECONDS = 5
+
+# Lifetime of the ETag / Last-Modified validators of the read endpoints when the user's data
+# does not change: bounds how long time-dependent views (recent expenses, month boundaries,
+# recurring occurrences) can be revalidated as unchanged
+ETAG_WINDOW_SECONDS = int(os.environ.get("ETAG_WINDOW_SECONDS", "300"))
+
+# Recurring incomes are projected at most this many occurrences past their latest entry,
+# e.g. a year for a monthly salary (0 projects them until they are stopped)
+RECURRENCE_MAX_MISSED_PERIODS = int(os.environ.get("RECURRENCE_MAX_MISSED_PERIODS", "12"))
+
+# Datastore behind the repositories: 'firestore', or 'memory' for offline load tests and profiling
+DATA_BACKEND = os.environ.get("DATA_BACKEND", "firestore")
+# Users to fill with generated data when the in-memory datastore starts, e.g. "demo,bench"
+DATA_SEED_USERS = [userid for userid in os.environ.get("DATA_SEED_USERS", "").split(",") if userid]
+DATA_SEED_ENTRIES = int(os.environ.get("DATA_SEED_ENTRIES", "1000"))
+# Service account key of the Firestore datastore
+FIREBASE_CREDENTIALS = os.environ.get("FIREBASE_CREDENTIALS", "./cachemoney-95b14-e8ba240701ef.json")
+
+# Receipt extraction job queue: worker threads, maximum queued jobs and how long results are kept
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", "4"))
+OCR_QUEUE_SIZE = int(os.environ.get("OCR_QUEUE_SIZE", "32"))
+OCR_RESULT_TTL_SECONDS = 600
+OCR_RETRY_AFTER_SECONDS = 5
+
+# On-disk cache of receipt extraction results, keyed by the SHA-256 of the uploaded image
+RECEIPT_CACHE_DIR = os.environ.get("RECEIPT_CACHE_DIR", "./receipt_cache")
+RECEIPT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Receipt image preprocessing before the vision model call
+PREPROCESS_MAX_EDGE = 1600
+PREPROCESS_GRAYSCALE = True
+PREPROCESS_FORMAT = "JPEG"  # or "WEBP"
+PREPROCESS_TARGET_BYTES = 350 * 1024
+
+# Receipt uploads: maximum size, in-memory spool size before spilling to a temp file, and
+# whether (and for how long) to keep a copy in the uploads folder
+UPLOAD_FOLDER = "./uploads"
+UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+UPLOAD_SPOOL_BYTES = 1024 * 1024
+UPLOAD_PERSIST = os.environ.get("UPLOAD_PERSIST", "false").lower() == "true"
+UPLOAD_RETENTION_SECONDS = 7 * 24 * 3600
+
+# Batch uploads: concurrent extractions per batch, images per batch, request size and the
+# total uncompressed size of the images in its ZIP archives
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_FILES = 100
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+BATCH_MAX_UNPACKED_BYTES = 200 * 1024 * 1024
+
+# Mistral API calls per second across the process (0 disables the limit) and burst size
+MISTRAL_RATE_LIMIT = float(os.environ.get("MISTRAL_RATE_LIMIT", "5"))
+MISTRAL_RATE_BURST = 5
+
+# Mistral API client: overall deadline per call, retries with exponential backoff starting
+# at MISTRAL_BACKOFF_SECONDS, circuit breaker and HTTP connection pool size.
+# MISTRAL_SERVER_URL points the client at another server, such as a local mock
+MISTRAL_SERVER_URL = os.environ.get("MISTRAL_SERVER_URL") or None
+MISTRAL_TIMEOUT_SECONDS = float(os.environ.get("MISTRAL_TIMEOUT_SECONDS", "30"))
+MISTRAL_MAX_RETRIES = 3
+MISTRAL_BACKOFF_SECONDS = 0.5
+MISTRAL_BREAKER_THRESHOLD = 5
+MISTRAL_BREAKER_RESET_SECONDS = 30
+MISTRAL_MAX_CONNECTIONS = 20
+
+# Receipt extraction: 'remote' (model only), 'fallback' (local OCR once the model fails or
+# exceeds the latency budget) or 'race' (both at once, the model wins within the budget)
+EXTRACTION_MODE = os.environ.get("EXTRACTION_MODE", "fallback")
+EXTRACTION_LATENCY_BUDGET_SECONDS = float(os.environ.get("EXTRACTION_LATENCY_BUDGET_SECONDS", "20"))
+LOCAL_OCR_LANGUAGES = os.environ.get("LOCAL_OCR_LANGUAGES", "eng")
+
+# Request body limit of the endpoints without a limit of their own; the upload, import and
+# bulk endpoints accept larger bodies (see body_limit in app.py)
+REQUEST_MAX_BYTES = 1024 * 1024
+
+# Maximum number of entries and body size per bulk import request
+BULK_MAX_ROWS = 10000
+BULK_MAX_BYTES = 8 * 1024 * 1024
+
+# Statement imports: file size cap, entries written per chunk, import workers and queue depth
+IMPORT_MAX_BYTES = 50 * 1024 * 1024
+IMPORT_CHUNK_ROWS = 2000
+IMPORT_WORKERS = 2
+IMPORT_QUEUE_SIZE = 8
+IMPORT_EXTENSIONS = ('.csv', '.txt', '.xlsx', '.xlsm')
+
+# How long the response of a write sent with an Idempotency-Key is replayed to retries
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+
+# ASGI server (asgi.py): threads running the requests passed on to the WSGI application
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", "16"))
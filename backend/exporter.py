@@ -0,0 +1,102 @@
+"""Streaming export of a user's entries as CSV, XLSX or Parquet.
+
+Entries are consumed one at a time from EntryRepository.stream. CSV is generated directly
+into the response in small chunks. XLSX (openpyxl write-only mode) and Parquet (pyarrow,
+written in row groups) need a seekable file, so they are written to an anonymous temporary
+file that is then streamed out and deleted. Server memory stays constant either way.
+"""
+import csv
+import io
+import tempfile
+from datetime import timezone
+
+FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+# Bytes per chunk of the streamed response
+CHUNK_SIZE = 64 * 1024
+
+# Date format of the CSV export, as in the JSON API
+CSV_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Rows per Parquet row group
+PARQUET_BATCH_ROWS = 10000
+
+class FormatUnavailable(Exception):
+    """Raised when an export format needs an optional package that is not installed."""
+
+def export_row(entry, serialize):
+    """Serialize an entry for export, keeping its date as a naive UTC datetime."""
+    row = serialize(entry)
+    date = entry['Date']
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    row["date"] = date
+    return row
+
+def iter_csv(rows, columns):
+    """Yield CSV text in chunks of about CHUNK_SIZE, starting with the header row."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({**row, "date": row["date"].strftime(CSV_DATE_FORMAT)})
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def write_xlsx(rows, columns, title):
+    """Write the rows to a temporary XLSX file and return it, rewound."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    sheet.append(columns)
+    for row in rows:
+        sheet.append([row.get(column) for column in columns])
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+def write_parquet(rows, columns):
+    """Write the rows to a temporary Parquet file in row groups and return it, rewound."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise FormatUnavailable("Parquet exports are not available: the 'pyarrow' package is not installed")
+
+    schema = pyarrow.schema([
+        (column, pyarrow.float64() if column == 'amount'
+         else pyarrow.timestamp('us') if column == 'date'
+         else pyarrow.string())
+        for column in columns
+    ])
+
+    output = tempfile.TemporaryFile()
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= PARQUET_BATCH_ROWS:
+                writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+                batch = []
+        if batch:
+            writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+    output.seek(0)
+    return output
+
+def iter_file(output):
+    """Yield a file's content in chunks and close it at the end."""
+    try:
+        for chunk in iter(lambda: output.read(CHUNK_SIZE), b''):
+            yield chunk
+    finally:
+        output.close()
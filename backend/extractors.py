@@ -0,0 +1,274 @@
+"""Pluggable receipt extractors and the pipeline choosing between them.
+
+An extractor turns preprocessed image bytes into the bill fields the app stores: amount,
+name, date, description and category. MistralExtractor asks the vision model and gives the
+best results; LocalExtractor runs Tesseract OCR and a heuristic parser on the text, which
+is far less accurate but fast and independent of the network.
+
+ExtractionPipeline bounds the latency of an extraction. In 'fallback' mode the local
+extractor only runs once the model has failed or used up the latency budget; in 'race'
+mode both start together, so the local result is ready the moment the budget runs out.
+The model's answer is preferred whenever it arrives within the budget.
+"""
+import base64
+import io
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+
+from PIL import Image
+
+try:
+    import pytesseract
+except ImportError:  # Only needed for the local extractor
+    pytesseract = None
+
+CATEGORIES = ['Utility', 'Rent', 'Groceries', 'Entertainment', 'Other']
+
+EXTRACTION_PROMPT = f"""
+Extract the following information from the provided image of a bill:
+1. Total price or total amount of expense as a number!
+2. Name of the expense
+3. Date of the bill in the format "YYYY-MM-DD"
+4. A short description of the expense
+5. Category of the bill with the options: {CATEGORIES}
+
+Return the extracted information with the following JSON fields:
+"amount", "name", "date", "description", "category"
+"""
+
+class ExtractionFailed(Exception):
+    """Raised when an extractor cannot extract a receipt."""
+
+class ReceiptExtractor:
+    """Interface of the receipt extractors."""
+
+    name = None
+
+    def extract(self, image_bytes, mime_type):
+        """Return the extracted bill fields of an image, or raise ExtractionFailed."""
+        raise NotImplementedError
+
+class MistralExtractor(ReceiptExtractor):
+    """Extracts receipts with the Mistral vision model."""
+
+    name = 'mistral'
+
+    def __init__(self, client):
+        # A ResilientMistralClient, which bounds every call with a deadline
+        self.client = client
+
+    def extract(self, image_bytes, mime_type):
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": EXTRACTION_PROMPT},
+                    {
+                        "type": "image_url",
+                        "image_url": f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+                    }
+                ]
+            }
+        ]
+        try:
+            return self.client.complete_json(messages)
+        except Exception as e:
+            raise ExtractionFailed(f"Mistral extraction failed: {e}") from e
+
+class LocalExtractor(ReceiptExtractor):
+    """Extracts receipts with Tesseract OCR and parse_receipt_text."""
+
+    name = 'local'
+
+    def __init__(self, languages='eng'):
+        self.languages = languages
+
+    @property
+    def available(self):
+        return pytesseract is not None
+
+    def extract(self, image_bytes, mime_type):
+        if pytesseract is None:
+            raise ExtractionFailed("The 'pytesseract' package is required for local extraction")
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                text = pytesseract.image_to_string(image, lang=self.languages)
+        except Exception as e:
+            raise ExtractionFailed(f"Local OCR failed: {e}") from e
+        return parse_receipt_text(text)
+
+# Amounts such as 1,234.56 / 1.234,56 / 12.50 / 12,50
+_AMOUNT = r'(\d{1,3}(?:[.,\s]\d{3})*[.,]\d{2}|\d+[.,]\d{2})'
+_AMOUNT_RE = re.compile(_AMOUNT)
+_TOTAL_RE = re.compile(
+    r'\b(?:grand\s+total|total\s+due|amount\s+due|balance\s+due|total|summe|gesamt|betrag|to\s+pay)\b'
+    r'[^\d\n]{0,20}' + _AMOUNT,
+    re.IGNORECASE,
+)
+_SUBTOTAL_RE = re.compile(r'\bsub\s*-?\s*total\b', re.IGNORECASE)
+_DATE_PATTERNS = [
+    (re.compile(r'\b(\d{4})-(\d{1,2})-(\d{1,2})\b'), ('%Y.%m.%d',)),
+    (re.compile(r'\b(\d{1,2})[./](\d{1,2})[./](\d{4})\b'), ('%d.%m.%Y', '%m.%d.%Y')),
+    (re.compile(r'\b(\d{1,2})[./](\d{1,2})[./](\d{2})\b'), ('%d.%m.%y', '%m.%d.%y')),
+]
+_CATEGORY_KEYWORDS = {
+    'Groceries': ('grocery', 'market', 'supermarket', 'aldi', 'lidl', 'rewe', 'edeka', 'walmart', 'tesco', 'bakery'),
+    'Utility': ('electric', 'energy', 'water', 'gas', 'internet', 'telecom', 'mobile', 'utility'),
+    'Rent': ('rent', 'lease', 'landlord', 'miete'),
+    'Entertainment': ('cinema', 'movie', 'theater', 'theatre', 'concert', 'restaurant', 'bar', 'cafe', 'ticket'),
+}
+
+def parse_receipt_text(text):
+    """Pull the bill fields out of OCR text with heuristics.
+
+    The amount is the value on the last 'total' line (ignoring subtotals), or else the
+    largest amount on the receipt; the name is the first line with letters, which is
+    usually the merchant. Fields that cannot be found are None.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+
+    amount = None
+    for line in lines:
+        if _SUBTOTAL_RE.search(line):
+            continue
+        match = _TOTAL_RE.search(line)
+        if match:
+            amount = _parse_amount(match.group(1))
+    if amount is None:
+        amounts = [_parse_amount(value) for value in _AMOUNT_RE.findall(text)]
+        amounts = [value for value in amounts if value is not None]
+        amount = max(amounts) if amounts else None
+
+    name = next((line for line in lines if re.search(r'[A-Za-z]{3}', line)), None)
+    lowered = text.lower()
+    category = next(
+        (category for category, keywords in _CATEGORY_KEYWORDS.items() if any(word in lowered for word in keywords)),
+        'Other',
+    )
+
+    return {
+        "amount": amount,
+        "name": name[:80] if name else None,
+        "date": _parse_date(text),
+        "description": f"Receipt from {name[:80]}" if name else None,
+        "category": category,
+    }
+
+def _parse_amount(value):
+    digits = re.sub(r'\s', '', value)
+    # The last separator is the decimal separator, any others group the thousands
+    integer, decimals = digits[:-3], digits[-2:]
+    try:
+        return float(re.sub(r'[.,]', '', integer) + '.' + decimals)
+    except ValueError:
+        return None
+
+def _parse_date(text):
+    for pattern, formats in _DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            for date_format in formats:
+                try:
+                    return datetime.strptime('.'.join(match.groups()), date_format).strftime('%Y-%m-%d')
+                except ValueError:
+                    continue
+    return None
+
+class ExtractionPipeline:
+    """Runs a primary extractor under a latency budget, with a fallback extractor.
+
+    `mode` is 'remote' (primary only), 'fallback' or 'race'.
+    """
+
+    MODES = ('remote', 'fallback', 'race')
+
+    def __init__(self, primary, fallback=None, mode='fallback', latency_budget=20, workers=8):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown extraction mode '{mode}'")
+        self.primary = primary
+        self.fallback = fallback if mode != 'remote' else None
+        self.mode = mode
+        self.latency_budget = latency_budget
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extract')
+        # Racing fallbacks get their own pool, so they never queue behind slow model calls
+        self._fallback_executor = (
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extract-fallback')
+            if mode == 'race' else None
+        )
+
+        self._lock = threading.Lock()
+        # extractor name -> counters
+        self._stats = {}
+
+    def extract(self, image_bytes, mime_type):
+        """Extract an image, returning the fields plus the name of the extractor used."""
+        if self.fallback is None:
+            return self._run(self.primary, image_bytes, mime_type)
+
+        primary = self._executor.submit(self._run, self.primary, image_bytes, mime_type)
+        fallback = None
+        if self.mode == 'race':
+            fallback = self._fallback_executor.submit(self._run, self.fallback, image_bytes, mime_type)
+
+        # The executor is shared by every extraction in the process, so time spent queued behind
+        # other extractions counts toward the budget: a slow model is when the budget matters most
+        done, _ = wait([primary], timeout=self.latency_budget)
+        if primary in done and primary.exception() is None:
+            if fallback is not None:
+                fallback.cancel()
+            return primary.result()
+
+        # The model failed or is too slow. A call still queued is dropped; a running one keeps
+        # running, but its answer is not awaited
+        primary.cancel()
+        reason = 'failed' if primary in done else 'timed out'
+        logging.warning(f"{self.primary.name} extraction {reason}, using the {self.fallback.name} extractor")
+        with self._lock:
+            self._counters(self.fallback.name)["fallbacks"] += 1
+
+        if fallback is None:
+            return self._run(self.fallback, image_bytes, mime_type)
+        return fallback.result()
+
+    def stats(self):
+        """Return the calls, failures, fallbacks and average latency per extractor."""
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "latency_budget": self.latency_budget,
+                "extractors": {
+                    name: {
+                        "calls": counters["calls"],
+                        "failures": counters["failures"],
+                        "fallbacks": counters["fallbacks"],
+                        "avg_ms": round(counters["total_ms"] / counters["calls"], 2) if counters["calls"] else 0.0,
+                    }
+                    for name, counters in self._stats.items()
+                },
+            }
+
+    def _run(self, extractor, image_bytes, mime_type):
+        started = time.perf_counter()
+        failed = False
+        try:
+            result = extractor.extract(image_bytes, mime_type)
+            if not isinstance(result, dict):
+                raise ExtractionFailed(f"{extractor.name} extraction returned {type(result).__name__}")
+            return {**result, "extractor": extractor.name}
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                counters = self._counters(extractor.name)
+                counters["calls"] += 1
+                counters["failures"] += failed
+                counters["total_ms"] += elapsed
+
+    def _counters(self, name):
+        # Caller must hold the lock
+        return self._stats.setdefault(name, {"calls": 0, "failures": 0, "fallbacks": 0, "total_ms": 0.0})
@@ -0,0 +1,72 @@
+"""Production gunicorn settings: gunicorn -c gunicorn.conf.py
+
+By default the ASGI application of asgi.py is served by uvicorn workers: the aggregate
+read endpoints and the dashboard run as async handlers, the rest of the API on each
+worker's thread pool. GUNICORN_INTERFACE=wsgi serves the WSGI application of wsgi.py
+instead, where requests mostly wait on Firestore and the Mistral API, so the default
+worker class is gthread: a few processes, each serving many requests on threads. 'gevent'
+serves even more concurrent requests per process (requires `pip install gevent`), and
+'sync' runs one request per process. Every setting can be overridden through the environment.
+"""
+import multiprocessing
+import os
+import sys
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+
+# Job statuses, idempotency records and the response cache are only shared between workers
+# through Redis (CACHE_BACKEND=redis). With the in-process defaults, polling an upload or
+# import job on another worker, or after its worker was recycled, answers 404, so a single
+# worker is run and never recycled; its threads still serve requests concurrently
+shared_state = os.environ.get("CACHE_BACKEND", "memory") == "redis"
+
+interface = os.environ.get("GUNICORN_INTERFACE", "asgi")
+if interface not in ("asgi", "wsgi"):
+    raise ValueError(f"GUNICORN_INTERFACE must be 'asgi' or 'wsgi', not {interface!r}")
+wsgi_app = "asgi:app" if interface == "asgi" else "wsgi:app"
+
+default_worker_class = "uvicorn_worker.UvicornWorker" if interface == "asgi" else "gthread"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", default_worker_class)
+default_workers = min(multiprocessing.cpu_count() * 2 + 1, 8) if shared_state else 1
+workers = int(os.environ.get("GUNICORN_WORKERS", default_workers))
+# Threads per gthread worker; I/O-bound handlers spend most of their time waiting. Under
+# ASGI, the WSGI half of the API runs on ASGI_WSGI_THREADS threads per worker instead
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+# Concurrent connections per gevent worker
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# Covers the slowest requests: streamed exports and batch extractions
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+# Time a worker gets on shutdown or reload to finish its requests and background jobs
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "60"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Recycle workers periodically, with jitter so they do not all restart at once (0 disables it)
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "2000" if shared_state else "0"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "200"))
+
+# The app is imported in each worker: the Firestore gRPC channel and the worker threads
+# of the job queues must not be created before the fork
+preload_app = False
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-")
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+# config.py defaults to the development server's settings; both interfaces run with production ones
+os.environ.setdefault("LOG_LEVEL", "INFO")
+os.environ.setdefault("FLASK_DEBUG", "0")
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # Let the gRPC calls of the Firestore client cooperate with gevent's event loop
+        from grpc.experimental import gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+
+def worker_exit(server, worker):
+    # Runs once the worker has stopped accepting requests: let queued extractions and
+    # imports finish within the graceful timeout. Under ASGI, the lifespan shutdown of
+    # asgi.py already did
+    if interface == "asgi":
+        return
+    app = sys.modules.get('app')
+    if app is not None:
+        app.shutdown(graceful_timeout)
@@ -0,0 +1,93 @@
+"""Idempotency keys for the write endpoints.
+
+A client sends the same Idempotency-Key header when it retries a write. The first request
+stores its response under the key for `ttl` seconds, and retries within that time replay
+it without touching the datastore. Entries created with a key also get a document id
+derived from it, so a retry arriving after the TTL or on another worker finds the existing
+document with a single existence check instead of writing a duplicate.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+MAX_KEY_LENGTH = 255
+
+def entry_id(userid, kind, key):
+    """Return the deterministic document id of the entry written with an idempotency key."""
+    return hashlib.sha256(f"{userid}:{kind}:{key}".encode('utf-8')).hexdigest()[:20]
+
+def fingerprint(payload):
+    """Return a digest of a request payload, to detect a key reused for a different request."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class MemoryIdempotencyStore:
+    """Process-local TTL store of the responses recorded per idempotency key."""
+
+    def __init__(self, ttl=24 * 3600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        # key -> (expires_at, record)
+        self._records = OrderedDict()
+
+    def get(self, key):
+        """Return the record stored under a key, or None."""
+        with self._lock:
+            stored = self._records.get(key)
+            if stored is None:
+                return None
+            if stored[0] <= time.monotonic():
+                del self._records[key]
+                return None
+            return stored[1]
+
+    def put(self, key, record):
+        """Store a record under a key unless one is stored already; return the stored record."""
+        now = time.monotonic()
+        with self._lock:
+            stored = self._records.get(key)
+            if stored is not None and stored[0] > now:
+                return stored[1]
+
+            self._records[key] = (now + self.ttl, record)
+            self._records.move_to_end(key)
+            while len(self._records) > self.max_entries:
+                self._records.popitem(last=False)
+            return record
+
+class RedisIdempotencyStore:
+    """TTL store shared by every worker through Redis."""
+
+    def __init__(self, client, ttl=24 * 3600, prefix='idempotency:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The 'redis' package is required for the Redis idempotency store")
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        return json.loads(data) if data is not None else None
+
+    def put(self, key, record):
+        # SET NX: the first writer wins, later ones get its record back
+        if self.client.set(self.prefix + key, json.dumps(record), nx=True, ex=self.ttl):
+            return record
+        return self.get(key) or record
+
+def create_store(name, ttl=24 * 3600, redis_url=None):
+    """Create the idempotency store matching the cache backend `name` ('memory' or 'redis')."""
+    if name == 'memory':
+        return MemoryIdempotencyStore(ttl=ttl)
+    if name == 'redis':
+        return RedisIdempotencyStore.from_url(redis_url, ttl=ttl)
+    raise ValueError(f"Unknown idempotency store '{name}'")
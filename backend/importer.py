@@ -0,0 +1,218 @@
+"""Streaming import of CSV and XLSX bank statements.
+
+Rows are read one at a time (csv.DictReader over the spooled upload, openpyxl in read-only
+mode for XLSX), mapped onto entry fields, validated and written in chunks through
+EntryRepository.add_many. Memory use therefore depends on the chunk size, not on the size
+of the statement.
+
+Columns are matched by name: an explicit mapping of entry field -> column header wins,
+otherwise the usual bank-statement headers are recognized. A statement either has one
+signed Amount column or a Debit/Credit pair, where the amount is the credit minus the debit
+and an empty cell counts as 0. With kind 'statement', rows are split by the sign of the
+amount: negative rows (debits) become expenses and positive rows (credits) incomes.
+"""
+import csv
+import io
+import re
+from datetime import datetime
+
+import bulk
+
+# Known column headers per entry field, compared case-insensitively
+COLUMN_SYNONYMS = {
+    'Amount': ('amount', 'value', 'betrag', 'umsatz', 'amount (eur)', 'amount (usd)'),
+    # Unsigned money out / money in, used when the statement has no Amount column
+    'Debit': ('debit', 'debit amount', 'withdrawal', 'withdrawals', 'paid out', 'money out', 'soll'),
+    'Credit': ('credit', 'credit amount', 'deposit', 'deposits', 'paid in', 'money in', 'haben'),
+    'Date': ('date', 'booking date', 'transaction date', 'value date', 'posting date', 'buchungstag', 'datum'),
+    'Name': ('name', 'payee', 'merchant', 'counterparty', 'beneficiary', 'empfänger', 'auftraggeber'),
+    'Description': ('description', 'memo', 'reference', 'details', 'purpose', 'verwendungszweck'),
+    'Category': ('category', 'kategorie'),
+    'Frequency': ('frequency',),
+}
+
+# Values of the optional fields when the statement has no such column
+DEFAULTS = {'Category': 'Other', 'Frequency': 'onetime'}
+
+KINDS = ('expenses', 'income', 'statement')
+
+# Keep the first errors only, so a statement full of bad rows cannot exhaust memory
+MAX_REPORTED_ERRORS = 100
+
+def iter_rows(stream, filename):
+    """Yield the rows of a CSV or XLSX file as dicts keyed by the header row."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        return _iter_xlsx_rows(stream)
+    return _iter_csv_rows(stream)
+
+def _iter_csv_rows(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        sample = text.read(4096)
+        text.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.DictReader(text, dialect=dialect)
+    finally:
+        # Leave the underlying file to the caller
+        text.detach()
+
+def _iter_xlsx_rows(stream):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(cell).strip() if cell is not None else '' for cell in header]
+        for values in rows:
+            if all(value is None for value in values):
+                continue
+            yield dict(zip(columns, values))
+    finally:
+        workbook.close()
+
+def resolve_mapping(columns, mapping=None):
+    """Return entry field -> column for the given headers, from `mapping` and the known synonyms."""
+    by_name = {column.strip().lower(): column for column in columns if column}
+    resolved = {}
+    for field, synonyms in COLUMN_SYNONYMS.items():
+        if mapping and field in mapping:
+            if mapping[field] not in columns:
+                raise ValueError(f"Column '{mapping[field]}' mapped to {field} is not in the file")
+            resolved[field] = mapping[field]
+            continue
+        column = next((by_name[name] for name in synonyms if name in by_name), None)
+        if column is not None:
+            resolved[field] = column
+
+    if 'Date' not in resolved:
+        raise ValueError("No column found for Date, pass a column mapping")
+
+    # One signed Amount column or a Debit/Credit pair; explicitly mapped columns win
+    explicit = set(mapping or ()) & {'Amount', 'Debit', 'Credit'}
+    if 'Amount' in explicit and explicit & {'Debit', 'Credit'}:
+        raise ValueError("Map either Amount or Debit/Credit, not both")
+    if explicit & {'Debit', 'Credit'} or 'Amount' not in resolved:
+        resolved.pop('Amount', None)
+        if 'Debit' not in resolved and 'Credit' not in resolved:
+            raise ValueError("No column found for Amount (or Debit/Credit), pass a column mapping")
+    else:
+        resolved.pop('Debit', None)
+        resolved.pop('Credit', None)
+    return resolved
+
+def parse_amount(value):
+    """Parse an amount such as 1234.5, '-1.234,56', '€ 12,00' or '(12.00)' into a float."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"Invalid amount {value!r}")
+
+    text = value.strip()
+    negative = (text.startswith('(') and text.endswith(')')) or '-' in text
+    digits = re.sub(r'[^\d.,]', '', text)
+    if not digits:
+        raise ValueError(f"Invalid amount {value!r}")
+
+    # The last separator followed by one or two digits is the decimal separator
+    match = re.search(r'[.,](\d{1,2})$', digits)
+    if match:
+        number = re.sub(r'[.,]', '', digits[:match.start()]) + '.' + match.group(1)
+    else:
+        number = re.sub(r'[.,]', '', digits)
+    return -float(number) if negative else float(number)
+
+def debit_credit_amount(debit, credit):
+    """Return the signed amount of a Debit/Credit pair of cells: credit minus debit, empty cells count as 0."""
+    def parse(value):
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return None
+        # Some banks sign their debits, others do not
+        return abs(parse_amount(value))
+
+    debit, credit = parse(debit), parse(credit)
+    if debit is None and credit is None:
+        raise ValueError("Invalid amount: no debit or credit")
+    return (credit or 0.0) - (debit or 0.0)
+
+def map_row(row, columns, date_format=None):
+    """Map a statement row onto entry fields, parsing its amount and date."""
+    mapped = {field: row.get(column) for field, column in columns.items()}
+    if 'Amount' in columns:
+        amount = parse_amount(mapped['Amount'])
+    else:
+        amount = debit_credit_amount(mapped.get('Debit'), mapped.get('Credit'))
+
+    date = mapped['Date']
+    if date_format and isinstance(date, str):
+        date = datetime.strptime(date.strip(), date_format)
+    mapped['Date'] = bulk.parse_date(date)
+
+    if not mapped.get('Name'):
+        mapped['Name'] = mapped.get('Description') or 'Imported entry'
+    if not mapped.get('Description'):
+        mapped['Description'] = mapped['Name']
+    for field, default in DEFAULTS.items():
+        if mapped.get(field) in (None, ''):
+            mapped[field] = default
+    return mapped, amount
+
+def import_statement(store, userid, rows, kind, mapping=None, date_format=None, chunk_rows=2000):
+    """Validate and write statement rows in chunks; return the counts and the first errors.
+
+    `kind` is 'expenses', 'income' or 'statement' (split by the sign of the amount, so debits
+    become expenses and credits incomes).
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown import kind '{kind}'")
+
+    repositories = {'expenses': store.expenses, 'income': store.incomes}
+    pending = {'expenses': [], 'income': []}
+    added = {'expenses': 0, 'income': 0}
+    errors, error_count, row_count = [], 0, 0
+
+    def flush(target):
+        if pending[target]:
+            added[target] += len(repositories[target].add_many(userid, pending[target]))
+            if target == 'income':
+                store.recurrence.record(userid, pending[target])
+            pending[target] = []
+
+    columns = None
+    # Data rows start on line 2, below the header
+    for line_number, row in enumerate(rows, start=2):
+        if columns is None:
+            columns = resolve_mapping(list(row), mapping)
+        row_count += 1
+        try:
+            mapped, amount = map_row(row, columns, date_format)
+            if kind == 'statement':
+                target = 'expenses' if amount < 0 else 'income'
+            else:
+                target = kind
+            mapped['Amount'] = abs(amount)
+            entry = bulk.validate_entry(target, mapped)
+        except ValueError as e:
+            error_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"row": line_number, "error": str(e)})
+            continue
+
+        pending[target].append(entry)
+        if len(pending[target]) >= chunk_rows:
+            flush(target)
+
+    for target in pending:
+        flush(target)
+
+    return {
+        "rows": row_count,
+        "added": added,
+        "error_count": error_count,
+        "errors": errors,
+    }
@@ -0,0 +1,241 @@
+"""Background job queue for slow work such as receipt extraction.
+
+Requests enqueue a job and return its id immediately; a fixed pool of worker threads runs
+the jobs. The queue has a bounded depth, so when the workers cannot keep up, submit() raises
+QueueFull and the caller can answer with 503 instead of holding request threads hostage.
+
+A job runs in the process that accepted it, but its record lives in a job store. With
+RedisJobStore every worker can answer a status poll, whichever worker ran the job and even
+after that worker was recycled; MemoryJobStore only serves the polls of its own process.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at its maximum depth."""
+
+class JobStoreUnavailable(Exception):
+    """Raised when the job store cannot record or return a job, e.g. while Redis is unreachable."""
+
+class MemoryJobStore:
+    """Job records of the current process; finished ones are kept for `ttl` seconds."""
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # job id -> job record
+        self._jobs = {}
+
+    def put(self, job):
+        """Store a copy of a job record, replacing any previous one."""
+        with self._lock:
+            self._purge_expired()
+            self._jobs[job["id"]] = dict(job)
+
+    def get(self, job_id):
+        """Return a copy of a job record, or None if the job is unknown or expired."""
+        with self._lock:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _purge_expired(self):
+        # Caller must hold the lock. Drop finished jobs whose results have been kept for longer than the TTL
+        cutoff = time.time() - self.ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] is not None and job["finished_at"] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+class RedisJobStore:
+    """Job records shared by every worker through Redis, expiring `ttl` seconds after their last update."""
+
+    def __init__(self, client, ttl=600, prefix='cachemoney:jobs'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The 'redis' package is required for the Redis job store")
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def put(self, job):
+        # Only the worker running a job updates it, so whole records are written without a race
+        self.client.set(self._key(job["id"]), json.dumps(job), ex=self.ttl)
+
+    def get(self, job_id):
+        data = self.client.get(self._key(job_id))
+        return json.loads(data) if data is not None else None
+
+    def delete(self, job_id):
+        self.client.delete(self._key(job_id))
+
+    def _key(self, job_id):
+        return f"{self.prefix}:{job_id}"
+
+def create_store(name, ttl=600, redis_url=None, prefix='cachemoney:jobs'):
+    """Create the job store matching the cache backend `name` ('memory' or 'redis')."""
+    if name == 'memory':
+        return MemoryJobStore(ttl=ttl)
+    if name == 'redis':
+        return RedisJobStore.from_url(redis_url, ttl=ttl, prefix=prefix)
+    raise ValueError(f"Unknown job store '{name}'")
+
+class JobQueue:
+    """Runs `handler(*args)` for submitted jobs on a pool of worker threads."""
+
+    def __init__(self, handler, workers=4, max_queue=32, result_ttl=600, name='jobs', store=None):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.name = name
+        self.store = store if store is not None else MemoryJobStore(ttl=result_ttl)
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, *args):
+        """Enqueue a job and return its id.
+
+        Raises QueueFull when the queue is at capacity and JobStoreUnavailable when the job
+        cannot be recorded; the job is not run then.
+        """
+        self._ensure_started()
+
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "result": None,
+            "error": None,
+            "created_at": time.time(),
+            "finished_at": None,
+        }
+
+        try:
+            self.store.put(job)
+        except Exception as e:
+            logging.error(f"Recording {self.name} job {job_id} failed: {e}")
+            raise JobStoreUnavailable(f"The {self.name} jobs are unavailable, try again later") from e
+        try:
+            self._queue.put_nowait((job, args))
+        except queue.Full:
+            self._delete(job_id)
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull(f"The {self.name} queue is full, try again later")
+
+        with self._lock:
+            self.submitted += 1
+        return job_id
+
+    def get(self, job_id):
+        """Return a copy of a job record, or None if the job is unknown or expired.
+
+        Raises JobStoreUnavailable when the job store cannot be read.
+        """
+        try:
+            return self.store.get(job_id)
+        except Exception as e:
+            logging.error(f"Reading {self.name} job {job_id} failed: {e}")
+            raise JobStoreUnavailable(f"The {self.name} jobs are unavailable, try again later") from e
+
+    def stats(self):
+        """Return the queue counters and current depth."""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": self._queue.qsize(),
+                "max_queue": self.max_queue,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+    def drain(self, timeout):
+        """Wait up to `timeout` seconds for the queued and running jobs; return whether all finished."""
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _ensure_started(self):
+        # Start the workers lazily, and again after a fork, since threads do not survive one
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = [
+                threading.Thread(target=self._work, name=f"{self.name}-worker-{index}", daemon=True)
+                for index in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            job, args = self._queue.get()
+            job["status"] = "running"
+            self._save(job)
+
+            try:
+                result = self.handler(*args)
+                status, error = "done", None
+            except Exception as e:
+                logging.error(f"Job {job['id']} failed: {e}")
+                result, status, error = None, "failed", str(e)
+
+            job.update(status=status, result=result, error=error, finished_at=time.time())
+            self._save(job)
+            with self._lock:
+                if status == "done":
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            self._queue.task_done()
+
+    def _save(self, job):
+        # A store outage must not kill the worker thread; the job's status is lost instead
+        try:
+            self.store.put(job)
+        except Exception as e:
+            logging.error(f"Saving the status of {self.name} job {job['id']} failed: {e}")
+
+    def _delete(self, job_id):
+        # A rejected job's record expires with the TTL if it cannot be deleted
+        try:
+            self.store.delete(job_id)
+        except Exception as e:
+            logging.warning(f"Deleting the record of rejected {self.name} job {job_id} failed: {e}")
@@ -0,0 +1,55 @@
+"""JSON encoding of the API responses with orjson.
+
+OrjsonProvider replaces Flask's json provider on both the WSGI and the ASGI application.
+Its documents decode to the same values as those of Flask's provider and keep its layout
+(sorted keys, compact unless debugging, dates in Flask's format), but large entry lists
+encode several times faster. The bytes differ in one respect: orjson writes non-ASCII
+characters as raw UTF-8 ("Café €"), where Flask's provider escapes them ("Caf\\u00e9 \\u20ac").
+Both are valid JSON for any client. Without orjson installed, Flask's own provider is used.
+"""
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Falls back to Flask's json provider
+    orjson = None
+
+def format_datetime(date):
+    """Format an entry date as 'YYYY-MM-DD HH:MM:SS', ignoring any time zone.
+
+    Same result as strftime("%Y-%m-%d %H:%M:%S") for the dates the API handles, at a
+    fraction of its cost.
+    """
+    return date.isoformat(' ', 'seconds')[:19]
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider encoding with orjson."""
+
+    def _options(self, indent=False):
+        # Datetimes are passed to Flask's default handler, so they keep the format of jsonify
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            # Options only the json module supports
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = not self.compact if self.compact is not None else self._app.debug
+        body = orjson.dumps(obj, default=self.default, option=self._options(indent)) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+# Provider class the applications use
+JSONProvider = OrjsonProvider if orjson is not None else DefaultJSONProvider
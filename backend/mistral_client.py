@@ -0,0 +1,241 @@
+"""Resilient wrapper around the Mistral chat client.
+
+Every call gets an overall deadline, split across its attempts. Rate limiting (429) and
+server errors (5xx), as well as timeouts and connection errors, are retried with jittered
+exponential backoff, honouring Retry-After when the upstream sends one. A circuit breaker
+counts consecutive failed calls and, once the upstream looks degraded, fails fast for a
+cool-down period instead of tying up workers on requests that are bound to fail. HTTP
+connections are pooled and kept alive across calls and threads.
+
+The SDK is imported and the HTTP client created on the first call, in every process: the
+import is slow, and a connection pool must not be shared across a fork.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+class MistralUnavailable(Exception):
+    """Raised when a call fails after its retries, or its deadline runs out."""
+
+class CircuitOpen(MistralUnavailable):
+    """Raised without calling the upstream while the circuit breaker is open."""
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and lets a single trial call
+    through once `reset_seconds` have passed; its outcome closes or re-opens the circuit."""
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def allow(self):
+        """Return whether a call may go to the upstream now."""
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.opened += 1
+            self._trial_running = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self._state(time.monotonic()),
+                "consecutive_failures": self._failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+    def _state(self, now):
+        # Caller must hold the lock
+        if self._opened_at is None:
+            return "closed"
+        if now - self._opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+class ResilientMistralClient:
+    """Calls the Mistral chat API with deadlines, retries and a circuit breaker."""
+
+    def __init__(self, api_key, model, server_url=None, timeout_seconds=30, max_retries=3,
+                 backoff_base=0.5, backoff_max=8, breaker_threshold=5, breaker_reset_seconds=30,
+                 max_connections=20, rate_limiter=None):
+        self.api_key = api_key
+        self.model = model
+        self.server_url = server_url
+        self.max_connections = max_connections
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = rate_limiter
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_seconds)
+
+        self._lock = threading.Lock()
+        self._client = None
+        self._http_client = None
+        self._pid = None
+
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def complete_json(self, messages, timeout_seconds=None):
+        """Run a JSON-mode chat completion and return the parsed JSON object.
+
+        Raises CircuitOpen while the upstream is considered degraded, and MistralUnavailable
+        when the call fails after its retries or exceeds its deadline.
+        """
+        from mistralai.models import MistralError
+
+        if not self.breaker.allow():
+            raise CircuitOpen("The Mistral API is unavailable, failing fast")
+
+        deadline = time.monotonic() + (timeout_seconds or self.timeout_seconds)
+        with self._lock:
+            self.calls += 1
+
+        attempt = 0
+        while True:
+            try:
+                content = self._complete(messages, deadline)
+            except MistralUnavailable:
+                self._record_failure()
+                raise
+            except MistralError as e:
+                if e.status_code < 500 and e.status_code not in RETRYABLE_STATUS_CODES:
+                    # The upstream is healthy but rejected this request; retrying will not help
+                    self.breaker.record_success()
+                    raise MistralUnavailable(f"Mistral API rejected the request: {e}") from e
+                retry_after = self._retry_delay(e, attempt)
+                if attempt >= self.max_retries or time.monotonic() + retry_after >= deadline:
+                    self._record_failure()
+                    raise MistralUnavailable(f"Mistral API call failed: {e}") from e
+            except Exception as e:
+                retry_after = self._retry_delay(e, attempt)
+                if retry_after is None or attempt >= self.max_retries or time.monotonic() + retry_after >= deadline:
+                    self._record_failure()
+                    raise MistralUnavailable(f"Mistral API call failed: {e}") from e
+            else:
+                self.breaker.record_success()
+                # A malformed answer is not an upstream failure, so it is not retried
+                return json.loads(content)
+
+            logging.warning(f"Mistral API call failed, retrying in {retry_after:.2f}s (attempt {attempt + 1})")
+            with self._lock:
+                self.retries += 1
+            time.sleep(retry_after)
+            attempt += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "circuit": self.breaker.stats(),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._http_client is not None and self._pid == os.getpid():
+                self._http_client.close()
+            self._client = self._http_client = self._pid = None
+
+    def _get_client(self):
+        if self._pid == os.getpid():
+            return self._client
+
+        import httpx
+        from mistralai import Mistral
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # One pooled keep-alive client shared by every thread; the per-attempt timeout
+                # is passed on each call, so the default here only bounds the connection pool wait
+                self._http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=self.max_connections,
+                                        max_keepalive_connections=self.max_connections),
+                    timeout=httpx.Timeout(self.timeout_seconds),
+                )
+                self._client = Mistral(api_key=self.api_key, server_url=self.server_url, client=self._http_client)
+                self._pid = os.getpid()
+            return self._client
+
+    def _complete(self, messages, deadline):
+        if self.rate_limiter is not None:
+            if not self.rate_limiter.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                raise MistralUnavailable("Timed out waiting for the Mistral API rate limit")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise MistralUnavailable("The Mistral API call deadline was exceeded")
+
+        chat_response = self._get_client().chat.complete(
+            model=self.model,
+            messages=messages,
+            response_format={"type": "json_object"},
+            timeout_ms=int(remaining * 1000),
+        )
+        return chat_response.choices[0].message.content
+
+    def _retry_delay(self, error, attempt):
+        # Seconds to wait before retrying `error`, or None if it is not worth retrying
+        import httpx
+        from mistralai.models import MistralError
+
+        if isinstance(error, MistralError):
+            retry_after = _parse_retry_after(error.headers.get('retry-after'))
+            if retry_after is not None:
+                return min(retry_after, self.backoff_max)
+        elif not isinstance(error, (httpx.TimeoutException, httpx.TransportError)):
+            return None
+
+        # Full jitter: spreads out the retries of concurrent callers
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _record_failure(self):
+        self.breaker.record_failure()
+        with self._lock:
+            self.failures += 1
+
+def _parse_retry_after(value):
+    try:
+        return max(float(value), 0) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,52 @@
+"""Token-bucket rate limiting for calls to rate-limited upstream APIs."""
+import threading
+import time
+
+class RateLimiter:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `burst`.
+
+    A rate of 0 or less disables limiting.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+        self.waited_seconds = 0.0
+
+    def acquire(self, timeout=None):
+        """Block until a token is available; return False if that takes longer than `timeout`."""
+        if self.rate <= 0:
+            return True
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.waited_seconds += now - started
+                    return True
+
+                wait = (1 - self._tokens) / self.rate
+
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def stats(self):
+        """Return the configuration and the total time callers spent waiting."""
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "waited_seconds": round(self.waited_seconds, 3),
+            }
@@ -0,0 +1,113 @@
+"""Persistent cache of receipt extraction results, keyed by the SHA-256 of the uploaded bytes.
+
+Each result is stored as {digest}.json in the cache directory. Reads refresh the file's
+modification time, and when the directory grows past its byte budget the least recently
+used results are deleted first. Re-uploading an identical image therefore returns the
+earlier extraction instantly, without another model call.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+
+class ReceiptCache:
+    """Size-bounded on-disk LRU cache of extracted receipt data."""
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # The directory is created by the first write, so importing the app creates nothing
+        self._lock = threading.Lock()
+        self._bytes = sum(size for _, size, _ in self._files())
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, digest):
+        """Return the cached extraction of an image digest, or None on a miss."""
+        path = self._path(digest)
+        try:
+            with open(path, 'r', encoding='utf-8') as cached_file:
+                result = json.load(cached_file)
+            # Refresh the modification time, which orders the LRU eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def set(self, digest, result):
+        """Store the extraction of an image digest and evict old results beyond the byte budget."""
+        data = json.dumps(result).encode('utf-8')
+        path = self._path(digest)
+
+        # Write to a temporary file first so readers never see a partial result
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        except OSError as e:
+            logging.error(f"Failed to cache receipt extraction {digest}: {e}")
+            return
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Failed to cache receipt extraction {digest}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            self._bytes += len(data) - previous_size
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def stats(self):
+        """Return the cache counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _evict(self):
+        # Caller must hold the lock. Rescan the directory, since other workers share it
+        files = sorted(self._files(), key=lambda file: file[2])
+        self._bytes = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if self._bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._bytes -= size
+            self.evictions += 1
+
+    def _files(self):
+        # (path, size, modification time) of every cached result; none before the first write
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _path(self, digest):
+        return os.path.join(self.directory, f"{digest}.json")
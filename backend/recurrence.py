@@ -0,0 +1,342 @@
+"""Recurring incomes, expanded from one stored rule per series.
+
+An income whose Frequency is weekly, biweekly, monthly, quarterly or yearly belongs to a
+series identified by its Name, Category and Frequency. Every series has a single rule
+document at users/{userid}/recurrence_rules/{rule id}. The rule records when the series
+started, its amount over time and how many literal entries each month already holds.
+
+The monthly aggregates only count literal entries. When a window is aggregated, each rule
+is expanded into the occurrences the series should have had in each month. Occurrences not
+covered by a literal entry are added as extra income, so recurring salaries count every
+month without being entered again, and series that are entered by hand every month are not
+counted twice.
+
+A series is only projected while it is alive: until its end date, and at most
+`max_missed_periods` occurrences past its latest literal entry, so an income entered once as
+monthly is not counted forever, and a series renamed by hand stops being counted once its old
+name is no longer entered. To stop a series right away (a job ended, a salary now arrives
+under another name), set its end date with stop_rule (POST /api/incomes/recurring/stop);
+a literal entry of the series on or after the end date resumes it, without projecting the
+months in between. Rebuilding the rules from the incomes keeps their end dates.
+
+Expanding a month is memoized per (rule version, month) for months that are over; only the
+current month, whose occurrences depend on today's date, is recomputed.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from dateutil.relativedelta import relativedelta
+from aggregates import BATCH_LIMIT, firestore_sdk, month_key
+
+RULES_COLLECTION = 'recurrence_rules'
+
+# Frequency -> interval between occurrences
+FREQUENCIES = {
+    'weekly': relativedelta(weeks=1),
+    'biweekly': relativedelta(weeks=2),
+    'monthly': relativedelta(months=1),
+    'quarterly': relativedelta(months=3),
+    'yearly': relativedelta(years=1),
+    'annually': relativedelta(years=1),
+}
+
+def frequency_of(entry):
+    """Return the normalized recurring frequency of an income, or None if it is one-time."""
+    frequency = str(entry.get('Frequency') or '').strip().lower()
+    return frequency if frequency in FREQUENCIES else None
+
+def rule_id(entry):
+    """Return the id of the rule of the series an income belongs to."""
+    series = '|'.join(str(entry.get(field) or '').strip().lower() for field in ('Name', 'Category'))
+    return hashlib.sha256(f"{series}|{frequency_of(entry)}".encode('utf-8')).hexdigest()[:20]
+
+def _naive_utc(date):
+    if date.tzinfo is not None:
+        return date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+def new_rule(entry):
+    """Return the rule of a series, before any of its entries is applied."""
+    return {
+        "id": rule_id(entry),
+        "name": entry.get('Name'),
+        "category": entry.get('Category') or 'Other',
+        "frequency": frequency_of(entry),
+        "start": None,
+        # Date of the latest literal entry
+        "last": None,
+        # Occurrences from this date on are not projected; None while the series is running
+        "end": None,
+        # Stopped spans of a resumed series, [{"from": date, "to": date}], not projected either
+        "gaps": [],
+        # month key -> amount of the latest literal entry in that month
+        "amounts": {},
+        # month key -> number of literal entries in that month
+        "counts": {},
+        "version": 0,
+    }
+
+def apply_entry(rule, entry):
+    """Record a literal entry of the series in its rule, in place."""
+    date = _naive_utc(entry['Date'])
+    key = month_key(date)
+    if rule["start"] is None or date < rule["start"]:
+        rule["start"] = date
+    if rule.get("last") is None or date > rule["last"]:
+        rule["last"] = date
+    if rule.get("end") is not None and date >= rule["end"]:
+        # The series was stopped, but it goes on after all
+        rule.setdefault("gaps", []).append({"from": rule["end"], "to": date})
+        rule["end"] = None
+    rule["amounts"][key] = entry.get('Amount', 0)
+    rule["counts"][key] = rule["counts"].get(key, 0) + 1
+    rule["version"] += 1
+    return rule
+
+def stop_rule(rule, end):
+    """Stop projecting a series from `end` on, in place."""
+    rule["end"] = _naive_utc(end)
+    rule["version"] += 1
+    return rule
+
+def rules_from_entries(entries, previous=None):
+    """Build the rules of every recurring series among the given incomes, keyed by rule id.
+
+    The end dates and gaps of the `previous` rules (rule id -> rule) are kept, unless a
+    literal entry resumed the series.
+    """
+    rules = {}
+    for entry in entries:
+        if frequency_of(entry) is None or entry.get('Date') is None:
+            continue
+        rule = rules.setdefault(rule_id(entry), new_rule(entry))
+        apply_entry(rule, entry)
+
+    for series_id, rule in rules.items():
+        previous_rule = (previous or {}).get(series_id, {})
+        rule["gaps"] = list(previous_rule.get("gaps") or [])
+        end = previous_rule.get("end")
+        if end is not None and rule["last"] < end:
+            rule["end"] = end
+    return rules
+
+def projection_end(rule, max_missed_periods=None):
+    """Return the date from which a rule's occurrences are no longer projected, or None.
+
+    That is its end date, or the occurrence after `max_missed_periods` occurrences without a
+    literal entry, whichever comes first.
+    """
+    ends = [rule["end"]] if rule.get("end") is not None else []
+    if max_missed_periods and rule.get("last") is not None:
+        ends.append(rule["last"] + FREQUENCIES[rule["frequency"]] * (max_missed_periods + 1))
+    return min(ends) if ends else None
+
+def _amount_at(rule, key):
+    # The series' amount is that of its latest literal entry up to the month
+    keys = [month for month in rule["amounts"] if month <= key]
+    return rule["amounts"][max(keys)] if keys else 0
+
+def _occurrences(rule, month_start, month_end, now, max_missed_periods=None):
+    # Number of occurrences of the series in [month_start, month_end), up to now and while it is projected
+    step = FREQUENCIES[rule["frequency"]]
+    start = rule["start"]
+    end = min(month_end, now)
+    stop = projection_end(rule, max_missed_periods)
+    if stop is not None:
+        end = min(end, stop)
+    if start >= end:
+        return 0
+
+    # Skip close to the month first, then step through it; stepping from the start date
+    # each time keeps monthly occurrences on their day instead of drifting after short months
+    index = 0
+    if month_start > start:
+        if step.days:
+            index = max((month_start - start).days // step.days - 1, 0)
+        else:
+            elapsed_months = (month_start.year - start.year) * 12 + month_start.month - start.month
+            index = max(elapsed_months // (step.months + 12 * step.years) - 1, 0)
+
+    count = 0
+    while True:
+        occurrence = start + step * index
+        if occurrence >= end:
+            return count
+        if occurrence >= month_start and not _in_gap(rule, occurrence):
+            count += 1
+        index += 1
+
+def _in_gap(rule, date):
+    return any(gap["from"] <= date < gap["to"] for gap in rule.get("gaps") or ())
+
+def extra_income(rule, key, now, max_missed_periods=None):
+    """Return the income of a rule's occurrences in a month that no literal entry covers."""
+    month_start = datetime.strptime(key, '%Y-%m')
+    occurrences = _occurrences(rule, month_start, month_start + relativedelta(months=1), now, max_missed_periods)
+    missing = occurrences - rule["counts"].get(key, 0)
+    return missing * _amount_at(rule, key) if missing > 0 else 0
+
+class RecurrenceEngine:
+    """Expands rules into the extra income per month, memoizing months that are over.
+
+    Series are projected at most `max_missed_periods` occurrences past their latest literal
+    entry (0 projects them until they are stopped).
+    """
+
+    def __init__(self, max_entries=100000, max_missed_periods=12):
+        self.max_entries = max_entries
+        self.max_missed_periods = max_missed_periods
+
+        self._lock = threading.Lock()
+        # (userid, rule id, rule version, month key) -> extra income
+        self._memo = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def extra_income(self, userid, rules, keys, now=None):
+        """Return the extra recurring income of each of the given months."""
+        now = _naive_utc(now or datetime.now())
+        current_key = month_key(now)
+        extra = {key: 0 for key in keys}
+        for rule in rules:
+            if rule["start"] is None:
+                continue
+            start_key = month_key(rule["start"])
+            for key in keys:
+                if start_key <= key <= current_key:
+                    extra[key] += self._expand(userid, rule, key, now, memoize=key < current_key)
+        return extra
+
+    def total_extra_income(self, userid, rules, now=None):
+        """Return the extra recurring income of every month up to and including the current one."""
+        now = _naive_utc(now or datetime.now())
+        total = 0
+        for rule in rules:
+            if rule["start"] is None:
+                continue
+            month = datetime(rule["start"].year, rule["start"].month, 1)
+            keys = []
+            while month <= now:
+                keys.append(month_key(month))
+                month += relativedelta(months=1)
+            total += sum(self.extra_income(userid, [rule], keys, now).values())
+        return total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "memoized_months": len(self._memo),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _expand(self, userid, rule, key, now, memoize):
+        memo_key = (userid, rule["id"], rule["version"], key)
+        if memoize:
+            with self._lock:
+                if memo_key in self._memo:
+                    self._memo.move_to_end(memo_key)
+                    self.hits += 1
+                    return self._memo[memo_key]
+                self.misses += 1
+
+        value = extra_income(rule, key, now, self.max_missed_periods)
+
+        if memoize:
+            with self._lock:
+                self._memo[memo_key] = value
+                while len(self._memo) > self.max_entries:
+                    self._memo.popitem(last=False)
+        return value
+
+# Firestore storage of the rules
+
+def rules_ref(db, userid):
+    """Return the collection holding the recurrence rules of a user."""
+    return db.collection('users').document(userid).collection(RULES_COLLECTION)
+
+def list_rules(db, userid):
+    """Return every recurrence rule of a user."""
+    return [load_rule(snapshot.to_dict()) for snapshot in rules_ref(db, userid).stream()]
+
+def load_rule(data):
+    """Return a rule read from Firestore, with its dates as naive UTC datetimes."""
+    for field in ("start", "last", "end"):
+        data[field] = _naive_utc(data[field]) if data.get(field) else None
+    data["gaps"] = [{"from": _naive_utc(gap["from"]), "to": _naive_utc(gap["to"])} for gap in data.get("gaps") or ()]
+    if data["last"] is None and data.get("counts"):
+        # Rules stored before the latest entry was recorded: the start of its month
+        month = datetime.strptime(max(data["counts"]), '%Y-%m')
+        data["last"] = max(month, data["start"]) if data["start"] else month
+    return data
+
+def _record_in_transaction(transaction, rule_ref, entries):
+    snapshot = rule_ref.get(transaction=transaction)
+    rule = load_rule(snapshot.to_dict()) if snapshot.exists else new_rule(entries[0])
+    for entry in entries:
+        apply_entry(rule, entry)
+    transaction.set(rule_ref, rule)
+
+def record_entries(db, userid, entries):
+    """Update the rules of the recurring series among newly added incomes."""
+    series = {}
+    for entry in entries:
+        if frequency_of(entry) is not None:
+            series.setdefault(rule_id(entry), []).append(entry)
+
+    collection = rules_ref(db, userid)
+    for series_id, series_entries in series.items():
+        firestore_sdk().transactional(_record_in_transaction)(
+            db.transaction(), collection.document(series_id), series_entries
+        )
+    return len(series)
+
+def _stop_in_transaction(transaction, rule_ref, end):
+    snapshot = rule_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    rule = stop_rule(load_rule(snapshot.to_dict()), end)
+    transaction.set(rule_ref, rule)
+    return rule
+
+def stop_series(db, userid, series_id, end):
+    """Stop projecting a user's series from `end` on; return its rule, or None if there is no such series."""
+    return firestore_sdk().transactional(_stop_in_transaction)(
+        db.transaction(), rules_ref(db, userid).document(series_id), end
+    )
+
+def rebuild_user(db, userid):
+    """Recompute the recurrence rules of a user from their incomes, keeping their end dates."""
+    query = db.collection('users').document(userid).collection('income').select(
+        ['Amount', 'Category', 'Date', 'Frequency', 'Name']
+    )
+    collection = rules_ref(db, userid)
+    previous = {rule["id"]: rule for rule in list_rules(db, userid)}
+    rules = rules_from_entries((snapshot.to_dict() for snapshot in query.stream()), previous)
+
+    # Overwrite the rules and drop series that no longer have incomes
+    writes = [(collection.document(series_id), None) for series_id in previous if series_id not in rules]
+    writes += [(collection.document(series_id), rule) for series_id, rule in rules.items()]
+
+    for start in range(0, len(writes), BATCH_LIMIT):
+        batch = db.batch()
+        for doc_ref, rule in writes[start:start + BATCH_LIMIT]:
+            if rule is None:
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, rule)
+        batch.commit()
+    return len(rules)
+
+def rebuild_all(db):
+    """Recompute the recurrence rules of every user."""
+    rebuilt = 0
+    for user_ref in db.collection('users').list_documents():
+        rebuild_user(db, user_ref.id)
+        rebuilt += 1
+    return rebuilt
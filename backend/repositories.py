@@ -0,0 +1,556 @@
+"""Data-access layer between the request handlers and the datastore.
+
+Handlers read and write a user's incomes, expenses and monthly aggregates through the
+repositories of a DataStore instead of talking to Firestore directly. FirestoreDataStore is
+the production implementation; InMemoryDataStore keeps everything in process so the same
+endpoints can be load-tested and profiled offline, without network access or credentials.
+
+Entries are returned as plain dicts holding the document fields plus their 'id'.
+"""
+import base64
+import json
+import os
+import random
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import aggregates
+import recurrence
+from aggregates import empty_aggregate, month_key
+
+DEFAULT_PAGE_SIZE = 100
+
+# Firestore's descending sort direction
+DESCENDING = 'DESCENDING'
+
+# Fields of the user document holding the data version
+VERSION_FIELDS = ['data_version', 'data_updated_at']
+
+def encode_cursor(entry):
+    """Encode the (Date, id) position of an entry as an opaque page cursor."""
+    position = {"date": entry['Date'].isoformat(), "id": entry['id']}
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Decode a page cursor into the (Date, id) position to resume after."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(position["date"]), position["id"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid 'cursor'")
+
+class EntryRepository:
+    """Access to one kind of a user's entries ('income' or 'expenses')."""
+
+    def __init__(self, kind):
+        if kind not in aggregates.KINDS:
+            raise ValueError(f"Unknown entry kind '{kind}'")
+        self.kind = kind
+
+    def page(self, userid, since=None, until=None, category=None, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        """Return one newest-first page of entries in [since, until) and the next page's cursor."""
+        raise NotImplementedError
+
+    def stream(self, userid, since=None, until=None):
+        """Yield every entry in [since, until), newest first."""
+        raise NotImplementedError
+
+    def add(self, userid, entry):
+        """Store a new entry, update its monthly aggregate and return its id."""
+        raise NotImplementedError
+
+    def add_if_absent(self, userid, entry_id, entry):
+        """Store an entry under the given id unless that id exists; return whether it was stored."""
+        raise NotImplementedError
+
+    def add_many(self, userid, entries):
+        """Store many entries, update their monthly aggregates once per batch and return their ids.
+
+        Raises aggregates.PartialWrite if it fails after storing some of the entries.
+        """
+        raise NotImplementedError
+
+class AggregateRepository:
+    """Access to the materialized monthly aggregates of a user."""
+
+    def get_months(self, userid, keys):
+        """Return the aggregates of the given months, keyed by month."""
+        raise NotImplementedError
+
+    def list_months(self, userid, until_key):
+        """Return every aggregate up to and including `until_key`, keyed by month."""
+        raise NotImplementedError
+
+    def get_totals(self, userid, until_key):
+        """Return the income and expense totals up to and including `until_key`."""
+        months = self.list_months(userid, until_key)
+        return {
+            "income": sum(month["income"] for month in months.values()),
+            "expenses": sum(month["expenses"] for month in months.values()),
+        }
+
+    def rebuild_user(self, userid):
+        """Recompute every aggregate of a user from their entries."""
+        raise NotImplementedError
+
+    def rebuild_all(self):
+        """Recompute the aggregates of every user and return how many users were rebuilt."""
+        raise NotImplementedError
+
+class RecurrenceRepository:
+    """Access to a user's recurrence rules, one per series of recurring incomes."""
+
+    def list_rules(self, userid):
+        """Return every recurrence rule of a user."""
+        raise NotImplementedError
+
+    def record(self, userid, entries):
+        """Update the rules of the recurring series among newly added incomes."""
+        raise NotImplementedError
+
+    def stop(self, userid, series_id, end):
+        """Stop projecting a series from `end` on; return its rule, or None if the user has no such series."""
+        raise NotImplementedError
+
+    def rebuild_user(self, userid):
+        """Recompute a user's rules from their incomes, keeping their end dates, and return how many there are."""
+        raise NotImplementedError
+
+    def rebuild_all(self):
+        """Recompute the rules of every user and return the number of users."""
+        raise NotImplementedError
+
+class VersionRepository:
+    """A version of each user's data, bumped after every write, that validates their responses."""
+
+    def get(self, userid):
+        """Return the (version, updated_at) of a user's data, (0, None) before their first write."""
+        raise NotImplementedError
+
+    def bump(self, userid):
+        """Record that a user's data changed."""
+        raise NotImplementedError
+
+class DataStore:
+    """The repositories of one datastore."""
+
+    def __init__(self, expenses, incomes, aggregates, recurrence, versions):
+        self.expenses = expenses
+        self.incomes = incomes
+        self.aggregates = aggregates
+        self.recurrence = recurrence
+        self.versions = versions
+
+# Firestore
+
+class FirestoreEntryRepository(EntryRepository):
+    """Entries stored under users/{userid}/{kind}/{id} in Firestore."""
+
+    def __init__(self, db, kind):
+        super().__init__(kind)
+        self.db = db
+
+    def page(self, userid, since=None, until=None, category=None, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        query = page_query(entries_query(self.db, userid, self.kind, since, until, category), limit, cursor)
+        return split_page([snapshot_entry(snapshot) for snapshot in query.stream()], limit)
+
+    def stream(self, userid, since=None, until=None):
+        query = entries_query(self.db, userid, self.kind, since, until).order_by('Date', direction=DESCENDING)
+        for snapshot in query.stream():
+            yield snapshot_entry(snapshot)
+
+    def add(self, userid, entry):
+        return aggregates.add_entry(self.db, userid, self.kind, entry)
+
+    def add_if_absent(self, userid, entry_id, entry):
+        return aggregates.add_entry_if_absent(self.db, userid, self.kind, entry_id, entry)
+
+    def add_many(self, userid, entries):
+        return aggregates.add_entries(self.db, userid, self.kind, entries)
+
+class FirestoreAggregateRepository(AggregateRepository):
+    """Aggregates stored under users/{userid}/monthly_aggregates/{YYYY-MM} in Firestore."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def get_months(self, userid, keys):
+        return aggregates.get_months(self.db, userid, keys)
+
+    def list_months(self, userid, until_key):
+        return aggregates.list_months(self.db, userid, until_key)
+
+    def get_totals(self, userid, until_key):
+        return aggregates.get_totals(self.db, userid, until_key)
+
+    def rebuild_user(self, userid):
+        return aggregates.rebuild_user(self.db, userid)
+
+    def rebuild_all(self):
+        return aggregates.rebuild_all(self.db)
+
+class FirestoreRecurrenceRepository(RecurrenceRepository):
+    """Rules stored under users/{userid}/recurrence_rules/{rule id} in Firestore."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def list_rules(self, userid):
+        return recurrence.list_rules(self.db, userid)
+
+    def record(self, userid, entries):
+        return recurrence.record_entries(self.db, userid, entries)
+
+    def stop(self, userid, series_id, end):
+        return recurrence.stop_series(self.db, userid, series_id, end)
+
+    def rebuild_user(self, userid):
+        return recurrence.rebuild_user(self.db, userid)
+
+    def rebuild_all(self):
+        return recurrence.rebuild_all(self.db)
+
+class FirestoreVersionRepository(VersionRepository):
+    """Versions kept in the data_version and data_updated_at fields of users/{userid}."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, userid):
+        snapshot = self.db.collection('users').document(userid).get(VERSION_FIELDS)
+        return version_of(snapshot)
+
+    def bump(self, userid):
+        firestore = aggregates.firestore_sdk()
+        self.db.collection('users').document(userid).set({
+            "data_version": firestore.Increment(1),
+            "data_updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+def version_of(snapshot):
+    """Return the (version, updated_at) held by a user document snapshot."""
+    data = snapshot.to_dict() or {}
+    return data.get('data_version', 0), data.get('data_updated_at')
+
+def entries_query(db, userid, kind, since=None, until=None, category=None):
+    """Return the query of a user's entries of a kind in [since, until), for the sync or async client."""
+    query = db.collection('users').document(userid).collection(kind)
+    if category:
+        query = query.where('Category', '==', category)
+    if since:
+        query = query.where('Date', '>=', since)
+    if until:
+        query = query.where('Date', '<', until)
+    return query
+
+def page_query(query, limit, cursor=None):
+    """Restrict an entries query to the newest-first page after `cursor`, plus one entry.
+
+    With a category filter, the query needs the composite index (Category, Date desc,
+    __name__ desc) of firestore.indexes.json; without it, Firestore fails the query with
+    FAILED_PRECONDITION. Deploy it with `firebase deploy --only firestore:indexes`.
+    """
+    # Order by document id too, so entries sharing a Date are neither skipped nor repeated
+    query = query.order_by('Date', direction=DESCENDING).order_by('__name__', direction=DESCENDING)
+    if cursor:
+        date, doc_id = decode_cursor(cursor)
+        query = query.start_after({'Date': date, '__name__': doc_id})
+
+    # Fetch one extra document to know whether another page follows
+    return query.limit(limit + 1)
+
+def split_page(entries, limit):
+    """Split the entries fetched by a page query into the page and the next page's cursor."""
+    page = entries[:limit]
+    next_cursor = encode_cursor(page[-1]) if len(entries) > limit else None
+    return page, next_cursor
+
+def snapshot_entry(snapshot):
+    entry = snapshot.to_dict()
+    entry['id'] = snapshot.id
+    return entry
+
+class FirestoreDataStore(DataStore):
+    """Repositories backed by a Firestore client."""
+
+    def __init__(self, db):
+        super().__init__(
+            FirestoreEntryRepository(db, 'expenses'),
+            FirestoreEntryRepository(db, 'income'),
+            FirestoreAggregateRepository(db),
+            FirestoreRecurrenceRepository(db),
+            FirestoreVersionRepository(db),
+        )
+
+# In memory
+
+class InMemoryDatabase:
+    """Process-local storage shared by the in-memory repositories."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (userid, kind) -> {id: entry}
+        self.entries = {}
+        # userid -> {month key: aggregate}
+        self.aggregates = {}
+        # userid -> {rule id: rule}
+        self.rules = {}
+        # userid -> (version, updated_at)
+        self.versions = {}
+
+class InMemoryEntryRepository(EntryRepository):
+    """Entries kept in an InMemoryDatabase, with the same semantics as Firestore."""
+
+    def __init__(self, database, kind):
+        super().__init__(kind)
+        self.database = database
+
+    def _select(self, userid, since=None, until=None, category=None):
+        with self.database.lock:
+            entries = list(self.database.entries.get((userid, self.kind), {}).values())
+
+        selected = [
+            entry for entry in entries
+            if (not category or entry.get('Category') == category)
+            and (since is None or entry['Date'] >= since)
+            and (until is None or entry['Date'] < until)
+        ]
+        selected.sort(key=lambda entry: (entry['Date'], entry['id']), reverse=True)
+        return selected
+
+    def page(self, userid, since=None, until=None, category=None, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        entries = self._select(userid, since, until, category)
+        if cursor:
+            position = decode_cursor(cursor)
+            entries = [entry for entry in entries if (entry['Date'], entry['id']) < position]
+
+        page = [dict(entry) for entry in entries[:limit]]
+        next_cursor = encode_cursor(page[-1]) if len(entries) > limit else None
+        return page, next_cursor
+
+    def stream(self, userid, since=None, until=None):
+        for entry in self._select(userid, since, until):
+            yield dict(entry)
+
+    def add(self, userid, entry):
+        entry_id = uuid.uuid4().hex[:20]
+        key = month_key(entry['Date'])
+
+        with self.database.lock:
+            self.database.entries.setdefault((userid, self.kind), {})[entry_id] = {**entry, 'id': entry_id}
+            months = self.database.aggregates.setdefault(userid, {})
+            aggregates.accumulate(months.setdefault(key, empty_aggregate(key)), self.kind, entry)
+
+        return entry_id
+
+    def add_if_absent(self, userid, entry_id, entry):
+        key = month_key(entry['Date'])
+
+        with self.database.lock:
+            stored = self.database.entries.setdefault((userid, self.kind), {})
+            if entry_id in stored:
+                return False
+            stored[entry_id] = {**entry, 'id': entry_id}
+            months = self.database.aggregates.setdefault(userid, {})
+            aggregates.accumulate(months.setdefault(key, empty_aggregate(key)), self.kind, entry)
+
+        return True
+
+    def add_many(self, userid, entries):
+        ids = [uuid.uuid4().hex[:20] for _ in entries]
+
+        with self.database.lock:
+            stored = self.database.entries.setdefault((userid, self.kind), {})
+            months = self.database.aggregates.setdefault(userid, {})
+            for entry_id, entry in zip(ids, entries):
+                stored[entry_id] = {**entry, 'id': entry_id}
+                key = month_key(entry['Date'])
+                aggregates.accumulate(months.setdefault(key, empty_aggregate(key)), self.kind, entry)
+
+        return ids
+
+class InMemoryAggregateRepository(AggregateRepository):
+    """Aggregates kept in an InMemoryDatabase and maintained on every add."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def get_months(self, userid, keys):
+        with self.database.lock:
+            months = self.database.aggregates.get(userid, {})
+            return {key: _copy_aggregate(months.get(key) or empty_aggregate(key)) for key in keys}
+
+    def list_months(self, userid, until_key):
+        with self.database.lock:
+            months = self.database.aggregates.get(userid, {})
+            return {key: _copy_aggregate(month) for key, month in months.items() if key <= until_key}
+
+    def rebuild_user(self, userid):
+        with self.database.lock:
+            months = {}
+            for kind in aggregates.KINDS:
+                for entry in self.database.entries.get((userid, kind), {}).values():
+                    key = month_key(entry['Date'])
+                    aggregates.accumulate(months.setdefault(key, empty_aggregate(key)), kind, entry)
+            self.database.aggregates[userid] = months
+            return len(months)
+
+    def rebuild_all(self):
+        with self.database.lock:
+            userids = {userid for userid, _ in self.database.entries}
+        for userid in userids:
+            self.rebuild_user(userid)
+        return len(userids)
+
+class InMemoryRecurrenceRepository(RecurrenceRepository):
+    """Rules kept in an InMemoryDatabase."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def list_rules(self, userid):
+        with self.database.lock:
+            return [_copy_rule(rule) for rule in self.database.rules.get(userid, {}).values()]
+
+    def record(self, userid, entries):
+        recorded = set()
+        with self.database.lock:
+            rules = self.database.rules.setdefault(userid, {})
+            for entry in entries:
+                if recurrence.frequency_of(entry) is None:
+                    continue
+                rule = rules.setdefault(recurrence.rule_id(entry), recurrence.new_rule(entry))
+                recurrence.apply_entry(rule, entry)
+                recorded.add(rule["id"])
+        return len(recorded)
+
+    def stop(self, userid, series_id, end):
+        with self.database.lock:
+            rule = self.database.rules.get(userid, {}).get(series_id)
+            if rule is None:
+                return None
+            return _copy_rule(recurrence.stop_rule(rule, end))
+
+    def rebuild_user(self, userid):
+        with self.database.lock:
+            incomes = list(self.database.entries.get((userid, 'income'), {}).values())
+            previous = self.database.rules.get(userid, {})
+            self.database.rules[userid] = recurrence.rules_from_entries(incomes, previous)
+            return len(self.database.rules[userid])
+
+    def rebuild_all(self):
+        with self.database.lock:
+            userids = {userid for userid, _ in self.database.entries}
+        for userid in userids:
+            self.rebuild_user(userid)
+        return len(userids)
+
+class InMemoryVersionRepository(VersionRepository):
+    """Versions kept in an InMemoryDatabase."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def get(self, userid):
+        with self.database.lock:
+            return self.database.versions.get(userid, (0, None))
+
+    def bump(self, userid):
+        with self.database.lock:
+            version, _ = self.database.versions.get(userid, (0, None))
+            self.database.versions[userid] = (version + 1, datetime.now(timezone.utc))
+
+def _copy_rule(rule):
+    return {**rule, "amounts": dict(rule["amounts"]), "counts": dict(rule["counts"]),
+            "gaps": [dict(gap) for gap in rule.get("gaps") or ()]}
+
+def _copy_aggregate(aggregate):
+    categories = {category: dict(sums) for category, sums in aggregate["categories"].items()}
+    return {**aggregate, "categories": categories}
+
+class InMemoryDataStore(DataStore):
+    """Repositories kept entirely in process memory."""
+
+    def __init__(self):
+        self.database = InMemoryDatabase()
+        super().__init__(
+            InMemoryEntryRepository(self.database, 'expenses'),
+            InMemoryEntryRepository(self.database, 'income'),
+            InMemoryAggregateRepository(self.database),
+            InMemoryRecurrenceRepository(self.database),
+            InMemoryVersionRepository(self.database),
+        )
+
+    def seed(self, userid, count, months=12):
+        """Fill a user with `count` deterministic pseudo-random expenses and monthly incomes."""
+        rng = random.Random(userid)
+        now = datetime.now()
+        start = now - timedelta(days=30 * months)
+        categories = ['Utility', 'Rent', 'Groceries', 'Entertainment', 'Other']
+
+        for index in range(count):
+            date = start + timedelta(seconds=rng.randrange(int((now - start).total_seconds())))
+            self.expenses.add(userid, {
+                "Amount": round(rng.uniform(1, 200), 2),
+                "Category": rng.choice(categories),
+                "Date": date,
+                "Description": f"Seeded expense {index}",
+                "Name": f"Expense {index}",
+            })
+
+        for month in range(months):
+            income = {
+                "Amount": 5000.0,
+                "Category": 'Salary',
+                "Date": now - timedelta(days=30 * month),
+                "Frequency": 'monthly',
+                "Name": 'Salary',
+            }
+            self.incomes.add(userid, income)
+            self.recurrence.record(userid, [income])
+
+def create_data_store(backend, db=None):
+    """Create the DataStore selected by `backend` ('firestore' or 'memory')."""
+    if backend == 'firestore':
+        return FirestoreDataStore(db)
+    if backend == 'memory':
+        return InMemoryDataStore()
+    raise ValueError(f"Unknown data backend '{backend}'")
+
+def create_firestore_client(credentials_path):
+    """Create a Firestore client from a service account key file.
+
+    The client is created directly instead of through firebase_admin.initialize_app, whose
+    process-global app and cached client would be shared with processes forked later.
+    """
+    from firebase_admin import credentials
+    from google.cloud import firestore
+
+    cred = credentials.Certificate(credentials_path)
+    return firestore.Client(project=cred.project_id, credentials=cred.get_credential())
+
+class LazyDataStore:
+    """Stands in for a DataStore that is created by `factory` on first use.
+
+    Creating the datastore connects the Firestore gRPC client, which must not be shared
+    across a fork, so the datastore is created again in every process that uses it.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._store = None
+        self._pid = None
+
+    def get(self):
+        """Return the datastore of the current process, creating it if needed."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._store = self._factory()
+                    self._pid = os.getpid()
+        return self._store
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
@@ -0,0 +1,5 @@
+import os
+
+# The app module creates its datastore on import: run it against the in-memory one
+os.environ.setdefault("DATA_BACKEND", "memory")
+os.environ.setdefault("CACHE_BACKEND", "memory")
@@ -0,0 +1,87 @@
+"""Request handling of the WSGI application on the in-memory datastore."""
+import io
+import json
+import sys
+
+import pytest
+
+import app as wsgi
+
+@pytest.fixture
+def client():
+    return wsgi.create_app().test_client()
+
+@pytest.mark.parametrize('path', ['/api/add_expense', '/api/add_income'])
+def test_oversized_entries_are_rejected_with_413(client, path):
+    body = json.dumps({"uid": "alice", "Name": "x" * (wsgi.REQUEST_MAX_BYTES + 1)})
+    response = client.post(path, data=body, content_type='application/json')
+
+    assert response.status_code == 413
+    assert response.get_json() == {"error": "Requests are limited to 1 MB"}
+
+def test_malformed_json_is_a_bad_request(client):
+    response = client.post('/api/add_expense', data='{"uid": ', content_type='application/json')
+
+    assert response.status_code == 400
+
+def test_stopping_a_recurring_income(client):
+    income = {"uid": "carol", "Amount": 3000, "Category": "Work", "Frequency": "monthly", "Name": "Salary"}
+    assert client.post('/api/add_income', json={**income, "Date": "01 January 2024 at 09:00:00 UTC"}).status_code == 201
+
+    response = client.post('/api/incomes/recurring/stop', json={**income, "End": "2024-03-01"})
+    assert response.status_code == 200
+    assert response.get_json()["end"] == "2024-03-01T00:00:00"
+
+    assert client.post('/api/incomes/recurring/stop', json={**income, "Name": "Bonus"}).status_code == 404
+    assert client.post('/api/incomes/recurring/stop', json={**income, "Frequency": "onetime"}).status_code == 400
+    assert client.post('/api/incomes/recurring/stop', json={**income, "End": "March"}).status_code == 400
+
+@pytest.mark.parametrize('query', [
+    'months=abc', 'months=0', 'months=61', 'months=', 'months=2.5',
+])
+def test_invalid_months_are_rejected(client, query):
+    for path in ('/api/monthly-income-last6months', '/api/monthly-savings-last6months', '/api/dashboard'):
+        response = client.get(f'{path}?userid=alice&{query}')
+
+        assert response.status_code == 400
+        assert response.get_json() == {"error": "'months' must be between 1 and 60"}
+
+def test_invalid_page_sizes_and_days_are_rejected(client):
+    assert client.get('/api/expenses?userid=alice&limit=ten').status_code == 400
+    assert client.get('/api/dashboard?userid=alice&days=week').status_code == 400
+    assert client.get('/api/dashboard?userid=alice&months=3&days=14').status_code == 200
+
+class UnreachableStore:
+    def put(self, job):
+        raise ConnectionError("Redis is unreachable")
+
+    get = delete = put
+
+def test_job_store_outages_are_503(client, monkeypatch):
+    monkeypatch.setattr(wsgi.import_jobs, 'store', UnreachableStore())
+    statement = (io.BytesIO(b"Date,Amount,Name\n2024-01-02,-5,Shop\n"), 'statement.csv')
+
+    response = client.post('/api/import', data={"uid": "alice", "file": statement}, content_type='multipart/form-data')
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+
+    response = client.get('/api/import/0123456789abcdef')
+    assert response.status_code == 503
+
+def test_export_bounds_include_from_and_exclude_to(client):
+    for day in ('01', '31'):
+        expense = {"uid": "dave", "Amount": 5, "Category": "Food", "Description": "d", "Name": f"Jan {day}",
+                   "Date": f"{day} January 2024"}
+        assert client.post('/api/add_expense', json=expense).status_code == 201
+
+    response = client.get('/api/export?userid=dave&from=2024-01-01&to=2024-01-31')
+    assert response.status_code == 200
+    assert 'Jan 01' in response.text
+    assert 'Jan 31' not in response.text
+
+def test_parquet_export_without_pyarrow_is_501(client, monkeypatch):
+    # A None entry makes the import fail, as if the package were not installed
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+
+    response = client.get('/api/export?userid=dave&format=parquet')
+    assert response.status_code == 501
@@ -0,0 +1,182 @@
+"""RedisCacheBackend against an in-process fake Redis server (fakeredis)."""
+import time
+
+import fakeredis
+import pytest
+
+from cache import MemoryCacheBackend, RedisCacheBackend
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+def make_backend(server, near_cache_ttl=0, ttl=60):
+    # Each backend gets its own connection to the shared server, like separate workers
+    near_cache = MemoryCacheBackend(ttl=near_cache_ttl) if near_cache_ttl else None
+    return RedisCacheBackend(fakeredis.FakeStrictRedis(server=server), ttl=ttl, near_cache=near_cache)
+
+def key(userid, endpoint='api.get_dashboard', **params):
+    return (endpoint, userid, tuple(sorted((name, (value,)) for name, value in params.items())))
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def test_set_then_get(server):
+    backend = make_backend(server)
+
+    assert backend.get(key('alice')) is None
+    backend.set(key('alice'), 'alice', b'{"total": 1}\n', 'application/json')
+
+    assert backend.get(key('alice')) == (b'{"total": 1}\n', 'application/json')
+    assert backend.get(key('alice', months='12')) is None
+    stats = backend.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+def test_entries_expire_with_the_ttl(server):
+    backend = make_backend(server, ttl=60)
+    backend.set(key('alice'), 'alice', b'body', 'application/json')
+
+    assert 0 < backend.client.ttl(backend._entry_key(key('alice'))) <= 60
+    assert 0 < backend.client.ttl(backend._user_key('alice')) <= 60
+
+def test_invalidation_drops_only_that_users_entries_in_every_backend(server):
+    writer, reader = make_backend(server), make_backend(server)
+    for userid in ('alice', 'bob'):
+        writer.set(key(userid), userid, userid.encode(), 'application/json')
+        writer.set(key(userid, months='12'), userid, userid.encode(), 'application/json')
+
+    writer.invalidate_user('alice')
+
+    assert reader.get(key('alice')) is None
+    assert reader.get(key('alice', months='12')) is None
+    assert reader.get(key('bob')) == (b'bob', 'application/json')
+    assert not reader.client.exists(reader._user_key('alice'))
+
+def test_invalidation_is_broadcast_to_the_near_caches(server):
+    writer, reader = make_backend(server, near_cache_ttl=60), make_backend(server, near_cache_ttl=60)
+    writer.set(key('alice'), 'alice', b'v1', 'application/json')
+    # Fills the reader's near cache and subscribes it to invalidations
+    assert reader.get(key('alice')) == (b'v1', 'application/json')
+
+    # Without the broadcast, the reader would keep serving v1 from its near cache for 60s
+    writer.set(key('alice'), 'alice', b'v2', 'application/json')
+    writer.invalidate_user('alice')
+
+    assert wait_until(lambda: reader.near_cache.get(key('alice')) is None)
+    assert reader.get(key('alice')) is None
+    reader._subscriber.stop()
+
+def test_near_cache_entries_expire_with_their_own_ttl(server):
+    cached = make_backend(server, near_cache_ttl=0.2)
+    other_worker = make_backend(server)
+    cached.set(key('alice'), 'alice', b'v1', 'application/json')
+
+    # Another worker overwrites Redis without an invalidation; the near copy is served until it expires
+    other_worker.set(key('alice'), 'alice', b'v2', 'application/json')
+    assert cached.get(key('alice')) == (b'v1', 'application/json')
+
+    time.sleep(0.3)
+    assert cached.get(key('alice')) == (b'v2', 'application/json')
+    assert cached.near_cache.stats()["expirations"] == 1
+    cached._subscriber.stop()
+
+def test_redis_outage_is_a_miss(server):
+    backend = make_backend(server)
+    backend.set(key('alice'), 'alice', b'body', 'application/json')
+    server.connected = False
+
+    assert backend.get(key('alice')) is None
+    backend.set(key('bob'), 'bob', b'body', 'application/json')
+    assert backend.stats()["errors"] == 2
+
+@pytest.mark.parametrize('backend_name', ['memory', 'redis'])
+def test_response_computed_before_an_invalidation_is_not_cached(server, backend_name):
+    backend = MemoryCacheBackend() if backend_name == 'memory' else make_backend(server)
+    other_worker = backend if backend_name == 'memory' else make_backend(server)
+
+    # A read starts, then a write for the same user commits and invalidates before the read stores its body
+    generation = backend.generation('alice')
+    other_worker.invalidate_user('alice')
+    backend.set(key('alice'), 'alice', b'stale', 'application/json', generation)
+
+    assert backend.get(key('alice')) is None
+    backend.set(key('alice'), 'alice', b'fresh', 'application/json', backend.generation('alice'))
+    assert backend.get(key('alice')) == (b'fresh', 'application/json')
+
+def test_response_cache_skips_the_set_when_a_write_lands_meanwhile(server):
+    from flask import Flask, jsonify
+
+    from cache import ResponseCache
+
+    response_cache = ResponseCache(make_backend(server))
+    app = Flask(__name__)
+    reads = []
+
+    @app.route('/total')
+    @response_cache.cached
+    def total():
+        reads.append(1)
+        if len(reads) == 1:
+            # The write commits while the first read is computing its response
+            response_cache.invalidate_user('alice')
+        return jsonify({"reads": len(reads)}), 200
+
+    client = app.test_client()
+    assert client.get('/total?userid=alice').get_json() == {"reads": 1}
+    assert client.get('/total?userid=alice').get_json() == {"reads": 2}
+    assert client.get('/total?userid=alice').get_json() == {"reads": 2}
+
+def test_entries_of_an_evicted_index_set_are_not_served_after_an_invalidation(server):
+    backend = make_backend(server)
+    backend.set(key('alice'), 'alice', b'v1', 'application/json', backend.generation('alice'))
+
+    # The server evicted the index set, so the invalidation cannot find the entry
+    backend.client.delete(backend._user_key('alice'))
+    backend.invalidate_user('alice')
+
+    assert backend.client.exists(backend._entry_key(key('alice')))
+    assert backend.get(key('alice')) is None
+
+def test_clear_keeps_the_generations_and_survives_an_outage(server):
+    backend = make_backend(server)
+    backend.invalidate_user('alice')
+    backend.set(key('alice'), 'alice', b'body', 'application/json')
+
+    backend.clear()
+    assert backend.get(key('alice')) is None
+    assert backend.generation('alice') == 1
+
+    server.connected = False
+    backend.clear()
+    assert backend.stats()["errors"] >= 1
+
+def test_dead_invalidation_listener_is_restarted(server):
+    writer, reader = make_backend(server), make_backend(server, near_cache_ttl=60)
+    writer.set(key('alice'), 'alice', b'v1', 'application/json')
+    assert reader.get(key('alice')) == (b'v1', 'application/json')
+
+    reader._subscriber.stop()
+    reader._subscriber.join(5)
+
+    # The next read notices the dead listener and subscribes again
+    assert reader.get(key('alice')) == (b'v1', 'application/json')
+    assert reader._subscriber.is_alive()
+    writer.invalidate_user('alice')
+    assert wait_until(lambda: reader.near_cache.get(key('alice')) is None)
+    reader._subscriber.stop()
+
+def test_listener_errors_drop_the_near_cache(server):
+    backend = make_backend(server, near_cache_ttl=60)
+    backend.set(key('alice'), 'alice', b'v1', 'application/json')
+    backend.get(key('bob'))
+
+    # Invalidations published while the listener is disconnected are lost
+    server.connected = False
+    assert wait_until(lambda: backend.near_cache.get(key('alice')) is None)
+    assert backend._subscriber.is_alive()
+    backend._subscriber.stop()
@@ -0,0 +1,45 @@
+"""ExtractionPipeline latency budget under a saturated model."""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from extractors import ExtractionPipeline
+
+class SlowExtractor:
+    name = 'model'
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def extract(self, image_bytes, mime_type):
+        time.sleep(self.delay)
+        return {"amount": 1.0}
+
+class LocalExtractor:
+    name = 'local'
+
+    def extract(self, image_bytes, mime_type):
+        return {"amount": 2.0}
+
+@pytest.mark.parametrize('mode', ['fallback', 'race'])
+def test_queued_callers_fall_back_within_the_budget(mode):
+    pipeline = ExtractionPipeline(SlowExtractor(3), LocalExtractor(), mode=mode, latency_budget=0.2, workers=2)
+
+    def timed_extract(_):
+        started = time.monotonic()
+        result = pipeline.extract(b'image', 'image/png')
+        return result["extractor"], time.monotonic() - started
+
+    # More callers than workers: the queued ones must not wait for the slow model calls
+    with ThreadPoolExecutor(max_workers=6) as callers:
+        results = list(callers.map(timed_extract, range(6)))
+
+    assert all(extractor == 'local' for extractor, _ in results)
+    assert max(elapsed for _, elapsed in results) < 1
+    assert pipeline.stats()["extractors"]["local"]["fallbacks"] == 6
+
+def test_fast_model_answers_within_the_budget():
+    pipeline = ExtractionPipeline(SlowExtractor(0), LocalExtractor(), latency_budget=1, workers=2)
+
+    assert pipeline.extract(b'image', 'image/png') == {"amount": 1.0, "extractor": "model"}
@@ -0,0 +1,50 @@
+"""Statement import of CSV files with a signed Amount column or a Debit/Credit pair."""
+import io
+
+import pytest
+
+import importer
+from repositories import InMemoryDataStore
+
+DEBIT_CREDIT_CSV = b"""Booking Date,Payee,Debit,Credit
+2024-03-01,Rewe,45.10,
+2024-03-02,Employer,,3200.00
+2024-03-03,Landlord,900,
+2024-03-04,Refund shop,,12.50
+"""
+
+def import_csv(data, kind='statement', mapping=None):
+    store = InMemoryDataStore()
+    rows = importer.iter_rows(io.BytesIO(data), 'statement.csv')
+    result = importer.import_statement(store, 'alice', rows, kind, mapping=mapping)
+    return store, result
+
+def amounts(repository):
+    return sorted((entry["Name"], entry["Amount"]) for entry in repository.stream('alice'))
+
+def test_debits_become_expenses_and_credits_incomes():
+    store, result = import_csv(DEBIT_CREDIT_CSV)
+
+    assert result["error_count"] == 0
+    assert result["added"] == {'expenses': 2, 'income': 2}
+    assert amounts(store.expenses) == [('Landlord', 900.0), ('Rewe', 45.1)]
+    assert amounts(store.incomes) == [('Employer', 3200.0), ('Refund shop', 12.5)]
+
+def test_rows_without_debit_or_credit_are_rejected():
+    _, result = import_csv(b"Date,Name,Debit,Credit\n2024-03-01,Nothing,,\n2024-03-02,Rewe,-5,\n")
+
+    assert result["added"] == {'expenses': 1, 'income': 0}
+    assert result["errors"] == [{"row": 2, "error": "Invalid amount: no debit or credit"}]
+
+def test_signed_amount_column_wins_over_a_debit_column():
+    columns = importer.resolve_mapping(['Date', 'Amount', 'Debit'])
+
+    assert columns == {'Amount': 'Amount', 'Date': 'Date'}
+
+def test_debit_credit_columns_can_be_mapped_explicitly():
+    data = b"Date,Name,Out,In\n2024-03-01,Rewe,45.10,\n"
+    store, _ = import_csv(data, mapping={'Debit': 'Out', 'Credit': 'In'})
+
+    assert amounts(store.expenses) == [('Rewe', 45.1)]
+    with pytest.raises(ValueError, match="not both"):
+        importer.resolve_mapping(['Date', 'Amount', 'Out'], {'Amount': 'Amount', 'Debit': 'Out'})
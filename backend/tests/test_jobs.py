@@ -0,0 +1,93 @@
+"""JobQueue with the job records in a store shared by several workers (fakeredis)."""
+import threading
+
+import fakeredis
+import pytest
+
+from jobs import JobQueue, JobStoreUnavailable, MemoryJobStore, QueueFull, RedisJobStore
+
+def redis_store(server):
+    return RedisJobStore(fakeredis.FakeStrictRedis(server=server), ttl=600)
+
+def test_any_worker_answers_the_status_of_a_job():
+    server = fakeredis.FakeServer()
+    release = threading.Event()
+
+    def handler(value):
+        release.wait(5)
+        return {"value": value}
+
+    # Two workers of the same application: the job runs on the first, the polls reach the second
+    running_worker = JobQueue(handler, workers=1, store=redis_store(server))
+    other_worker = JobQueue(handler, workers=1, store=redis_store(server))
+
+    job_id = running_worker.submit(42)
+    assert other_worker.get(job_id)["status"] in ("queued", "running")
+
+    release.set()
+    assert running_worker.drain(5)
+    job = other_worker.get(job_id)
+    assert (job["status"], job["result"], job["error"]) == ("done", {"value": 42}, None)
+    assert job["finished_at"] is not None
+
+def test_failed_jobs_report_their_error():
+    def handler():
+        raise RuntimeError("no text found")
+
+    queue = JobQueue(handler, workers=1, store=redis_store(fakeredis.FakeServer()))
+    job_id = queue.submit()
+    assert queue.drain(5)
+
+    job = queue.get(job_id)
+    assert (job["status"], job["error"]) == ("failed", "no text found")
+    assert queue.stats()["failed"] == 1
+
+def test_records_expire_with_the_ttl():
+    store = redis_store(fakeredis.FakeServer())
+    store.put({"id": "job", "status": "queued", "finished_at": None})
+
+    assert 0 < store.client.ttl(store._key("job")) <= 600
+
+def test_rejected_jobs_leave_no_record():
+    started, release = threading.Event(), threading.Event()
+
+    def handler():
+        started.set()
+        release.wait(5)
+
+    store = MemoryJobStore()
+    queue = JobQueue(handler, workers=1, max_queue=1, store=store)
+
+    # One job running, one queued: the next one is rejected
+    queue.submit()
+    assert started.wait(5)
+    queue.submit()
+    with pytest.raises(QueueFull):
+        queue.submit()
+    release.set()
+    assert queue.drain(5)
+    assert len(store._jobs) == 2
+
+def test_memory_store_drops_finished_jobs_after_the_ttl():
+    store = MemoryJobStore(ttl=60)
+    store.put({"id": "running", "status": "running", "finished_at": None})
+    store.put({"id": "old", "status": "done", "finished_at": 0})
+
+    assert store.get("old") is None
+    # Records are copies, so callers cannot change the stored job
+    store.get("running")["status"] = "done"
+    assert store.get("running")["status"] == "running"
+
+def test_store_outages_surface_as_job_store_unavailable():
+    server = fakeredis.FakeServer()
+    ran = threading.Event()
+    queue = JobQueue(lambda: ran.set(), workers=1, store=redis_store(server))
+    server.connected = False
+
+    with pytest.raises(JobStoreUnavailable):
+        queue.submit()
+    with pytest.raises(JobStoreUnavailable):
+        queue.get('job')
+    # A job that could not be recorded is not run
+    assert queue.drain(5)
+    assert not ran.is_set()
@@ -0,0 +1,212 @@
+"""ResilientMistralClient against a local HTTP stub of the Mistral chat completions API."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mistral_client import CircuitOpen, MistralUnavailable, ResilientMistralClient
+
+MESSAGES = [{"role": "user", "content": "Extract the bill"}]
+
+def completion(content):
+    return {
+        "id": "cmpl-test",
+        "object": "chat.completion",
+        "model": "test-model",
+        "created": 0,
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": json.dumps(content)},
+            "finish_reason": "stop",
+        }],
+    }
+
+class StubServer(ThreadingHTTPServer):
+    """Answers chat completion requests from a script of (status, headers, delay) responses.
+
+    Once the script runs out, every request succeeds. The arrival time of every request is recorded.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.script = []
+        self.arrivals = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def respond_with(self, *responses):
+        self.script.extend(responses)
+
+    def next_response(self):
+        with self.lock:
+            self.arrivals.append(time.monotonic())
+            return self.script.pop(0) if self.script else (200, {}, 0)
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, headers, delay = self.server.next_response()
+        if delay:
+            time.sleep(delay)
+
+        body = completion({"amount": 12.5}) if status == 200 else {"message": f"status {status}"}
+        data = json.dumps(body).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on a delayed response
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def make_client(stub):
+    clients = []
+
+    def make(**kwargs):
+        options = {"timeout_seconds": 5, "max_retries": 3, "backoff_base": 0.01, "backoff_max": 2}
+        options.update(kwargs)
+        client = ResilientMistralClient("test-key", "test-model", server_url=stub.url, **options)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.close()
+
+@pytest.mark.parametrize('status', [500, 502, 503, 429])
+def test_retries_server_errors_and_rate_limiting(stub, make_client, status):
+    stub.respond_with((status, {}, 0), (status, {}, 0))
+    client = make_client()
+
+    assert client.complete_json(MESSAGES) == {"amount": 12.5}
+    assert len(stub.arrivals) == 3
+    assert client.stats()["retries"] == 2
+    assert client.breaker.state == "closed"
+
+def test_gives_up_after_max_retries(stub, make_client):
+    stub.respond_with(*[(503, {}, 0)] * 3)
+    client = make_client(max_retries=2)
+
+    with pytest.raises(MistralUnavailable):
+        client.complete_json(MESSAGES)
+    assert len(stub.arrivals) == 3
+    assert client.stats()["failures"] == 1
+
+def test_does_not_retry_rejected_requests(stub, make_client):
+    stub.respond_with((400, {}, 0))
+    client = make_client()
+
+    with pytest.raises(MistralUnavailable, match="rejected"):
+        client.complete_json(MESSAGES)
+    assert len(stub.arrivals) == 1
+    # A rejected request says nothing about the upstream's health
+    assert client.breaker.stats()["consecutive_failures"] == 0
+
+def test_honours_retry_after(stub, make_client):
+    stub.respond_with((429, {'Retry-After': '0.5'}, 0))
+    client = make_client()
+
+    assert client.complete_json(MESSAGES) == {"amount": 12.5}
+    first, second = stub.arrivals
+    # Far longer than the 10 ms backoff the client would otherwise pick
+    assert second - first >= 0.5
+
+def test_retry_after_beyond_the_deadline_fails_right_away(stub, make_client):
+    stub.respond_with((503, {'Retry-After': '1.5'}, 0))
+    client = make_client(timeout_seconds=1)
+
+    started = time.monotonic()
+    with pytest.raises(MistralUnavailable):
+        client.complete_json(MESSAGES)
+    assert time.monotonic() - started < 0.5
+    assert len(stub.arrivals) == 1
+
+def test_enforces_the_overall_deadline(stub, make_client):
+    # Each attempt would time out on its own; the deadline bounds all of them together
+    stub.respond_with(*[(200, {}, 3)] * 4)
+    client = make_client(timeout_seconds=1)
+
+    started = time.monotonic()
+    with pytest.raises(MistralUnavailable):
+        client.complete_json(MESSAGES)
+    assert time.monotonic() - started < 1.5
+
+def test_deadline_per_call_overrides_the_default(stub, make_client):
+    stub.respond_with((200, {}, 3))
+    client = make_client(timeout_seconds=10)
+
+    started = time.monotonic()
+    with pytest.raises(MistralUnavailable):
+        client.complete_json(MESSAGES, timeout_seconds=0.5)
+    assert time.monotonic() - started < 1
+
+def test_circuit_breaker_opens_half_opens_and_closes(stub, make_client):
+    stub.respond_with(*[(500, {}, 0)] * 2)
+    client = make_client(max_retries=0, breaker_threshold=2, breaker_reset_seconds=0.5)
+
+    for _ in range(2):
+        with pytest.raises(MistralUnavailable):
+            client.complete_json(MESSAGES)
+    assert client.breaker.state == "open"
+
+    # Open: fails fast without calling the upstream
+    with pytest.raises(CircuitOpen):
+        client.complete_json(MESSAGES)
+    assert len(stub.arrivals) == 2
+
+    time.sleep(0.6)
+    assert client.breaker.state == "half_open"
+
+    # The trial call succeeds and closes the circuit
+    assert client.complete_json(MESSAGES) == {"amount": 12.5}
+    assert client.breaker.state == "closed"
+    assert client.breaker.stats() == {"state": "closed", "consecutive_failures": 0, "opened": 1, "rejected": 1}
+
+def test_failed_trial_call_reopens_the_circuit(stub, make_client):
+    stub.respond_with(*[(500, {}, 0)] * 3)
+    client = make_client(max_retries=0, breaker_threshold=2, breaker_reset_seconds=0.5)
+
+    for _ in range(2):
+        with pytest.raises(MistralUnavailable):
+            client.complete_json(MESSAGES)
+    time.sleep(0.6)
+
+    with pytest.raises(MistralUnavailable):
+        client.complete_json(MESSAGES)
+    assert client.breaker.state == "open"
+    assert client.breaker.stats()["opened"] == 2
+
+def test_half_open_circuit_lets_a_single_trial_through(make_client):
+    client = make_client(breaker_threshold=1, breaker_reset_seconds=0)
+    client.breaker.record_failure()
+
+    assert client.breaker.allow()
+    # Further calls are rejected until the trial call reports back
+    assert not client.breaker.allow()
+    client.breaker.record_success()
+    assert client.breaker.allow()
@@ -0,0 +1,19 @@
+"""ReceiptCache creating its directory on the first write."""
+import os
+
+from receipt_cache import ReceiptCache
+
+def test_directory_is_created_by_the_first_write(tmp_path):
+    directory = tmp_path / "receipts"
+    cache = ReceiptCache(str(directory))
+    assert not directory.exists()
+    assert cache.get("abc") is None
+    assert not directory.exists()
+
+    cache.set("abc", {"total": 12.5})
+    assert cache.get("abc") == {"total": 12.5}
+    assert os.listdir(directory) == ["abc.json"]
+
+def test_existing_results_count_toward_the_budget(tmp_path):
+    ReceiptCache(str(tmp_path)).set("abc", {"total": 12.5})
+    assert ReceiptCache(str(tmp_path)).stats()["bytes"] == os.path.getsize(tmp_path / "abc.json")
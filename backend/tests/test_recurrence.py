@@ -0,0 +1,76 @@
+"""Projection of recurring incomes: missed periods, end dates and rebuilds."""
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import recurrence
+from recurrence import RULES_COLLECTION, RecurrenceEngine
+from repositories import InMemoryDataStore
+
+NOW = datetime(2024, 12, 15)
+
+def salary(date, name='Salary', amount=3000):
+    return {"Name": name, "Category": 'Work', "Frequency": 'monthly', "Amount": amount, "Date": date}
+
+def add_income(store, entry):
+    # As the app does: store the income, then update the rule of its series
+    store.incomes.add('alice', entry)
+    store.recurrence.record('alice', [entry])
+
+def monthly_extra(rules, max_missed_periods):
+    keys = [f"2024-{month:02d}" for month in range(1, 13)]
+    return RecurrenceEngine(max_missed_periods=max_missed_periods).extra_income('alice', rules, keys, NOW)
+
+def test_series_stop_after_the_missed_periods():
+    rules = list(recurrence.rules_from_entries([salary(datetime(2024, 1, 1))]).values())
+
+    extra = monthly_extra(rules, max_missed_periods=3)
+    # January is a literal entry, February to April are projected, then the series lapses
+    assert [extra[f"2024-{month:02d}"] for month in range(1, 7)] == [0, 3000, 3000, 3000, 0, 0]
+    assert sum(monthly_extra(rules, max_missed_periods=0).values()) == 11 * 3000
+
+def test_stopped_series_are_not_projected_until_resumed():
+    store = InMemoryDataStore()
+    add_income(store, salary(datetime(2024, 1, 1)))
+    series_id = recurrence.rule_id(salary(None))
+
+    assert store.recurrence.stop('alice', series_id, datetime(2024, 3, 1))["end"] == datetime(2024, 3, 1)
+    assert store.recurrence.stop('alice', 'unknown', datetime(2024, 3, 1)) is None
+    extra = monthly_extra(store.recurrence.list_rules('alice'), max_missed_periods=0)
+    assert sum(extra.values()) == 3000
+
+    # A literal entry on or after the end date resumes the series
+    add_income(store, salary(datetime(2024, 6, 1)))
+    extra = monthly_extra(store.recurrence.list_rules('alice'), max_missed_periods=0)
+    assert extra["2024-05"] == 0
+    assert extra["2024-07"] == 3000
+
+def test_rebuilds_keep_the_end_dates():
+    store = InMemoryDataStore()
+    add_income(store, salary(datetime(2024, 1, 1)))
+    store.recurrence.stop('alice', recurrence.rule_id(salary(None)), datetime(2024, 3, 1))
+
+    store.recurrence.rebuild_user('alice')
+
+    [rule] = store.recurrence.list_rules('alice')
+    assert rule["end"] == datetime(2024, 3, 1)
+
+def snapshot(data):
+    return MagicMock(to_dict=MagicMock(return_value=dict(data)))
+
+def test_firestore_rebuild_commits_in_batches_of_500():
+    incomes = [salary(datetime(2024, 1, 1), name=f"Client {index}") for index in range(700)]
+    stale_rule = {**recurrence.new_rule(salary(None, name='Gone')), "start": datetime(2023, 1, 1)}
+
+    db = MagicMock()
+    collections = {'income': MagicMock(), RULES_COLLECTION: MagicMock()}
+    db.collection.return_value.document.return_value.collection.side_effect = collections.__getitem__
+    collections['income'].select.return_value.stream.return_value = [snapshot(entry) for entry in incomes]
+    collections[RULES_COLLECTION].stream.return_value = [snapshot(stale_rule)]
+    batches = []
+    db.batch.side_effect = lambda: batches.append(MagicMock()) or batches[-1]
+
+    assert recurrence.rebuild_user(db, 'alice') == 700
+
+    writes = [len(batch.set.call_args_list) + len(batch.delete.call_args_list) for batch in batches]
+    assert writes == [500, 201]
+    assert all(batch.commit.called for batch in batches)
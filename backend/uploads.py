@@ -0,0 +1,158 @@
+"""Handling of uploaded receipt images without intermediate copies on disk.
+
+An upload is read from the request stream once, in chunks. The chunks are hashed and
+written into a spooled temporary file, which stays in memory up to `spool_bytes` and only
+rolls over to an anonymous temporary file beyond that. Images are persisted to the uploads
+directory only when configured, and cleanup_uploads enforces a retention period on that
+directory.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import zipfile
+
+from werkzeug.utils import secure_filename
+
+# Read size of the request stream
+CHUNK_SIZE = 3 * 64 * 1024
+
+ZIP_MIME_TYPES = ('application/zip', 'application/x-zip-compressed')
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the maximum upload size."""
+
+def spool_upload(file, max_bytes, spool_bytes=1024 * 1024):
+    """Read an uploaded FileStorage into a spooled temporary file while hashing it.
+
+    Returns the SHA-256 hex digest and the spooled file, rewound to its start. Raises
+    UploadTooLarge as soon as more than `max_bytes` have been read.
+    """
+    return spool_stream(file.stream, max_bytes, spool_bytes)
+
+def spool_stream(stream, max_bytes, spool_bytes=1024 * 1024):
+    """Read a binary stream into a spooled temporary file while hashing it; see spool_upload."""
+    sha256 = hashlib.sha256()
+    spooled = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    size = 0
+
+    try:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"Uploads are limited to {max_bytes // (1024 * 1024)} MB")
+            sha256.update(chunk)
+            spooled.write(chunk)
+    except Exception:
+        spooled.close()
+        raise
+
+    spooled.seek(0)
+    return sha256.hexdigest(), spooled
+
+def is_zip_upload(file):
+    """Return whether an uploaded FileStorage is a ZIP archive."""
+    return file.mimetype in ZIP_MIME_TYPES or file.filename.lower().endswith('.zip')
+
+class BatchLimits:
+    """Number of images and uncompressed archive bytes a batch upload may hold, across its files."""
+
+    def __init__(self, max_files, max_unpacked_bytes):
+        self.max_files = max_files
+        self.max_unpacked_bytes = max_unpacked_bytes
+        self.files = 0
+        self.unpacked_bytes = 0
+
+    def add(self, unpacked_bytes=0):
+        """Count an image, and the bytes it unpacks to if it comes from an archive; raise UploadTooLarge past a limit."""
+        self.files += 1
+        self.unpacked_bytes += unpacked_bytes
+        if self.files > self.max_files:
+            raise UploadTooLarge(f"Batches are limited to {self.max_files} images")
+        if self.unpacked_bytes > self.max_unpacked_bytes:
+            raise UploadTooLarge(f"Archives are limited to {self.max_unpacked_bytes // (1024 * 1024)} MB uncompressed")
+
+def spool_zip(file, max_bytes, spool_bytes=1024 * 1024, limits=None):
+    """Spool every image of an uploaded ZIP archive.
+
+    Returns a list of (member name, digest, spooled file); raises zipfile.BadZipFile for
+    invalid archives and UploadTooLarge for members larger than `max_bytes`, or once the
+    images exceed `limits` (a BatchLimits). Members are counted by their declared size
+    before anything is decompressed; zipfile never reads a member past that size.
+    """
+    images = []
+    try:
+        with zipfile.ZipFile(file.stream) as archive:
+            for member in archive.infolist():
+                name = member.filename
+                if member.is_dir() or name.startswith('__MACOSX/') or os.path.basename(name).startswith('.'):
+                    continue
+                if member.file_size > max_bytes:
+                    raise UploadTooLarge(f"{name} exceeds the {max_bytes // (1024 * 1024)} MB upload limit")
+                if limits is not None:
+                    limits.add(member.file_size)
+                with archive.open(member) as member_stream:
+                    images.append((name, *spool_stream(member_stream, max_bytes, spool_bytes)))
+    except Exception:
+        for _, _, spooled in images:
+            spooled.close()
+        raise
+    return images
+
+def persist_upload(spooled, digest, filename, directory):
+    """Copy a spooled upload to `directory`, content-addressed by its digest, and return the path."""
+    os.makedirs(directory, exist_ok=True)
+    extension = os.path.splitext(secure_filename(filename))[1].lower()
+    file_path = os.path.join(directory, f"{digest}{extension}")
+
+    # Write to a temporary name first so a half-written file never carries the final name
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    with os.fdopen(fd, 'wb') as saved_file:
+        spooled.seek(0)
+        for chunk in iter(lambda: spooled.read(CHUNK_SIZE), b''):
+            saved_file.write(chunk)
+    os.replace(tmp_path, file_path)
+
+    spooled.seek(0)
+    return file_path
+
+def cleanup_uploads(directory, max_age_seconds):
+    """Delete uploads (and abandoned partial writes) older than `max_age_seconds`; return how many."""
+    if not os.path.isdir(directory):
+        return 0
+
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except OSError as e:
+            logging.warning(f"Failed to remove expired upload {entry.path}: {e}")
+
+    if removed:
+        logging.info(f"Removed {removed} expired upload(s) from {directory}")
+    return removed
+
+class UploadRetention:
+    """Runs cleanup_uploads at most once per `interval` seconds, whichever request triggers it."""
+
+    def __init__(self, directory, max_age_seconds, interval=3600):
+        self.directory = directory
+        self.max_age_seconds = max_age_seconds
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._last_run = 0
+
+    def maybe_cleanup(self):
+        """Clean the uploads directory if the last cleanup is older than the interval."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_run < self.interval:
+                return 0
+            self._last_run = now
+        return cleanup_uploads(self.directory, self.max_age_seconds)
@@ -0,0 +1,4 @@
+"""WSGI entry point: GUNICORN_INTERFACE=wsgi gunicorn -c gunicorn.conf.py"""
+from app import create_app
+
+app = create_app()
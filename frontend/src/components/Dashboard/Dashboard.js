@@ -17,6 +17,9 @@ import { motion } from "framer-motion";
 // Add this line to get User Data
 import { UserContext } from "../Auth/UserContext"; // Import UserContext
 
+// Days of recent expenses shown for each time range
+const RANGE_DAYS = { "24 Hours": 1, "7 Days": 7, "30 Days": 30 };
+
 function Dashboard({
   monthlyTarget = 500,
 }) {
@@ -32,91 +35,36 @@ function Dashboard({
   const user = useContext(UserContext);
 
   useEffect(() => {
-    // Fetch the latest month data from the new API
-    const fetchMonthlyData = async () => {
+    // Fetch this month's income and expenses and the recent expenses in one round trip
+    const fetchDashboard = async () => {
       setIsLoading(true);
       setError(null);
       try {
-        console.log("Fetching data from /api/monthly-savings-last6months...");
-        const response = await fetch(`/api/monthly-savings-last6months?userid=${user.uid}`);
-        
-        // Debug the response status
-        console.log("Response status: ", response.status);
-
+        const days = RANGE_DAYS[timeRange] || 30;
+        const response = await fetch(
+          `/api/dashboard?userid=${user.uid}&fields=savings,recent_expenses&months=1&days=${days}`
+        );
         if (!response.ok) {
-          throw new Error('Failed to fetch financial summary');
+          throw new Error('Failed to fetch the dashboard');
         }
-
         const data = await response.json();
-        
-        // Debug the fetched data
-        console.log("Fetched data: ", data);
-
-        // Assuming the data is in the format provided in the image (sorted by month)
-        const months = Object.keys(data).sort();
-        console.log("Sorted months: ", months);
-
-        const latestMonth = months.pop();  // Get the latest month key
-        console.log("Latest month: ", latestMonth);
-
-        const latestData = data[latestMonth];  // Get the income and expenses for the latest month
-
-        // Debug the latest month data
-        console.log("Latest month data: ", latestData);
 
+        // A single month: the current one
+        const latestData = Object.values(data.savings)[0];
         setFinancialSummary({
           total_income: latestData.income,
           total_expenses: latestData.expenses,
         });
-
-        // Debug final financial summary state
-        console.log("Updated financialSummary: ", {
-          total_income: latestData.income,
-          total_expenses: latestData.expenses,
-        });
-
-      } catch (err) {
-        console.error("Error fetching financial summary: ", err);
-        setError(err.message);
-      } finally {
-        setIsLoading(false);
-      }
-    };
-
-    fetchMonthlyData();
-  }, [user.uid]);
-
-  useEffect(() => {
-    const fetchExpenses = async () => {
-      setIsLoading(true);
-      setError(null);
-      try {
-        let endpoint;
-        switch (timeRange) {
-          case "24 Hours":
-            endpoint = `/api/expense/last24hours?userid=${user.uid}`;
-            break;
-          case "7 Days":
-            endpoint = `/api/expense/last7days?userid=${user.uid}`;
-            break;
-          default:
-            endpoint = `/api/expense/last30days?userid=${user.uid}`;
-        }
-        
-        const response = await fetch(endpoint);
-        if (!response.ok) {
-          throw new Error('Failed to fetch expenses');
-        }
-        const data = await response.json();
-        setExpenses(data.expenses); // Accessing 'expenses' key from response
+        setExpenses(data.recent_expenses.expenses);
       } catch (err) {
+        console.error("Error fetching the dashboard: ", err);
         setError(err.message);
       } finally {
         setIsLoading(false);
       }
     };
 
-    fetchExpenses();
+    fetchDashboard();
   }, [timeRange, user.uid]);
 
   // Calculate savings from the income and expenses
@@ -42,9 +42,10 @@ function Expenses() {
     // Fetch expenses and savings data from APIs
     const fetchExpenseAndSavingsData = async () => {
       try {
-        // Fetch expenses for the last 6 months
-        const expenseResponse = await fetch(`/api/monthly-savings-last6months?userid=YuwRGr2aNKQMu4LCN3sZcGNqg8g2`);
-        const expenseData = await expenseResponse.json();
+        // Fetch the last 6 months and the financial summary in one round trip
+        const dashboardResponse = await fetch(`/api/dashboard?userid=YuwRGr2aNKQMu4LCN3sZcGNqg8g2&fields=savings,summary`);
+        const dashboardData = await dashboardResponse.json();
+        const expenseData = dashboardData.savings;
         console.log("Expense data for the last 6 months: ", expenseData);
 
         // Sort the months and get the most recent one
@@ -56,9 +57,8 @@ function Expenses() {
         setMonthlyExpense(latestMonthData.expenses);
         setMonthlySavings(latestMonthData.income - latestMonthData.expenses); // Calculate savings manually
 
-        // Fetch total financial summary
-        const summaryResponse = await fetch(`/api/financial_summary?userid=YuwRGr2aNKQMu4LCN3sZcGNqg8g2`);
-        const summaryData = await summaryResponse.json();
+        // Total financial summary
+        const summaryData = dashboardData.summary;
         console.log("Financial summary data: ", summaryData);
         setTotalSavings(summaryData.total_income - summaryData.total_expenses); // Set total savings
 
@@ -245,11 +245,44 @@ function Expenses() {
     setErrorMessage(null);
     setSuccessMessage(null);
   
+    // The upload returns a job id right away; poll the job until the extraction finishes
+    // Poll once a second, for about two minutes at most, so a lost job does not spin forever
+    const maxJobPolls = 120;
+    const waitForJob = (statusUrl, polls = 0) => {
+      if (polls >= maxJobPolls) {
+        return Promise.resolve({ error: 'Processing the bill took too long, please try again' });
+      }
+      return new Promise(resolve => setTimeout(resolve, 1000))
+        .then(() => fetch(statusUrl))
+        .then(response => {
+          // The job store is briefly unavailable: keep polling
+          if (response.status === 503) {
+            return waitForJob(statusUrl, polls + 1);
+          }
+          return response.json().then(job => {
+            if (job.status === 'done') {
+              return job.result;
+            }
+            if (job.status === 'failed' || job.error) {
+              return { error: job.error || 'Failed to process the bill' };
+            }
+            return waitForJob(statusUrl, polls + 1);
+          });
+        });
+    };
+
     fetch('/api/upload', {
       method: 'POST',
       body: formData,
     })
       .then(response => response.json())
+      .then(job => {
+        if (job.error) {
+          return job;
+        }
+        // Previously extracted receipts come back immediately
+        return job.status === 'done' ? job.result : waitForJob(job.status_url);
+      })
       .then(data => {
         setIsLoading(false);
         if (data.error) {
@@ -33,11 +33,12 @@ function Incomes() {
     // Fetch the income data from the last 6 months and total income from the financial summary API
     const fetchIncomesData = async () => {
       try {
-        // Fetch the last 6 months of savings data (which includes income)
+        // Fetch the last 6 months of savings data (which includes income) and the summary in one round trip
         const response = await fetch(
-          `/api/monthly-savings-last6months?userid=YuwRGr2aNKQMu4LCN3sZcGNqg8g2`
+          `/api/dashboard?userid=YuwRGr2aNKQMu4LCN3sZcGNqg8g2&fields=savings,summary`
         );
-        const data = await response.json();
+        const dashboardData = await response.json();
+        const data = dashboardData.savings;
         console.log("Last 6 months data: ", data);
 
         // Extract income data from the last 6 months
@@ -53,11 +54,8 @@ function Incomes() {
         }));
         setIncomes(incomeEntries);
 
-        // Fetch the total income from the financial summary API
-        const summaryResponse = await fetch(
-          `/api/financial_summary?userid=YuwRGr2aNKQMu4LCN3sZcGNqg8g2`
-        );
-        const summaryData = await summaryResponse.json();
+        // Total income from the financial summary
+        const summaryData = dashboardData.summary;
         console.log("Financial summary data: ", summaryData);
 
         // Set the total income from the financial summary data
@@ -123,8 +123,9 @@ function Savings() {
   useEffect(() => {
     const fetchSavingsData = async () => {
       try {
-        const savingsResponse = await fetch(`/api/monthly-savings-last6months?userid=YuwRGr2aNKQMu4LCN3sZcGNqg8g2`);
-        const savingsData = await savingsResponse.json();
+        const dashboardResponse = await fetch(`/api/dashboard?userid=YuwRGr2aNKQMu4LCN3sZcGNqg8g2&fields=savings,summary`);
+        const dashboardData = await dashboardResponse.json();
+        const savingsData = dashboardData.savings;
 
         console.log("Last 6 months savings data: ", savingsData);
 
@@ -141,8 +142,7 @@ function Savings() {
         }, {});
         setCurrentSavings(savingsByMonth);
 
-        const summaryResponse = await fetch(`/api/financial_summary?userid=YuwRGr2aNKQMu4LCN3sZcGNqg8g2`);
-        const summaryData = await summaryResponse.json();
+        const summaryData = dashboardData.summary;
 
         console.log("Financial summary data: ", summaryData);
 